@@ -13,185 +13,650 @@
 # mai sus.
 # OUTPUT:
 # Continutul fisierului dupa ce a fost dezarhivat cu success
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
 import zipfile
-from multiprocessing import Process, Queue, Lock, Pipe, Value
-from time import sleep
+from multiprocessing import Process, Lock, Queue, Event
+from queue import Empty
+from threading import Thread
 
-from rarfile import RarFile
+try:
+    import resource
+except ImportError:
+    # Not available on Windows: the peak memory is not reported
+    resource = None
 
-from consumer_producer_model import producer, consumer
-from file_processing import trim_archive, compute_hash_unopened_file, append_bytes_to_file, get_file_extension
-from input_parser import read_input_from_keyboard
+from archive_verifier import ArchiveVerifier, STAGES
+from candidate_sources import select_candidate_source, HintedCandidateSource, RawCandidateSource, TailHints
+from checkpoint_journal import CheckpointJournal
+from consumer_producer_model import consumer, stop_consumers
+from crc_screening import create_crc_screen
+from file_processing import compute_hash_unopened_file, get_file_extension, map_archive_prefix
+from in_memory_archive import TailOverlayFile
+from input_parser import read_input_from_keyboard, accepted_extensions
+from metrics import WorkerMetrics, MetricsReporter
+from profiling import run_profiled, merge_profiles, print_profile_summary
+from shared_state import SearchState, SEARCH_FOUND, SEARCH_WRONG_PASSWORD, SEARCH_TIME_BUDGET, WORKER_DONE
+from work_scheduler import WorkScheduler, MAX_KEYSPACE_SIZE
+from zip_encryption import Cipher, check_password, find_encrypted_members
+from zip_tail_solver import zip_tail_candidates
 
+# How the consumers are run: processes with their own verifier, or threads of the main process that share
+# one verifier. zlib, bz2, lzma and hashlib release the GIL on big buffers, so the threads verify in parallel
+# when the members are big, without the startup and the memory of a process per consumer
+CONSUMER_BACKENDS = {'process': Process, 'thread': Thread}
+# The number of seconds the consumers have to stop once the search is cancelled before they are terminated
+SHUTDOWN_TIMEOUT = 2.0
+# The number of seconds between two polls of the state of the consumers while the search runs
+POLL_INTERVAL = 0.05
 
-def create_producers(number_of_producers, queue, lock, current_bytes_try, found):
-    """Creates a list of producers that share a queue and a lock.
-    The producers create data for the consumers in the consumer producer model
 
-    :param number_of_producers: The number of producers that will add to the queue
-    :param queue: The process safe queue that will be shared among producers/consumers and main process
-    :param lock: The lock over resources that will be shared among producers/consumers and main process
-    :param current_bytes_try: The length of the byte sequence to be generated by the producers
-    :return: A list of producer processes that can be started
-    :param found: A shared variable  between consumer/producer and mainprocess
+def create_consumers(number_of_consumers, archive_name, bytes_missing, scheduler, lock, state, progress_queue,
+                     sources, file_name, file_hash, hash_method, cancel, archive_function, needs_password=False,
+                     password=None, metrics=None, profile_directory=None, backend='process'):
+    """Creates a list of consumers that share a work scheduler, a lock and the state of the search
+
+    :param number_of_consumers: The number of consumers that will test candidates
+    :param archive_name: The name of the archive to be reconstructed by consumers
+    :param bytes_missing: The number of bytes that are considered missing from the end of the archive
+    :param scheduler: The WorkScheduler that hands out the chunks of candidates to the consumers
+    :param lock: The lock over resources that will be shared among consumers and main process
+    :param state: The SearchState with a slot for every consumer, where they report their results
+    :param progress_queue: The queue where consumers put the chunks they searched completely
+    :param sources: The candidate sources that generate the byte sequences, indexed like in the scheduler segments
+    :param file_name: The name of the file to be extracted from the archive
+    :param file_hash: The hash of the file to be extracted from the file
+    :param hash_method: The hash method (any hashlib method sent as a string e.g. 'md5')
+    :param cancel: The Event that stops the consumers
+    :param archive_function: A function that will be used to open the archive
+    :param needs_password: A boolean value telling if a password is needed to open the archive. (default False)
+    :param password: String representation of the password (default False)
+    :param metrics: The WorkerMetrics where the consumers publish their counters (default None)
+    :param profile_directory: If set every consumer runs under cProfile and writes its profile there (default None).
+        Only the process backend can be profiled
+    :param backend: The key of CONSUMER_BACKENDS the consumers are run with (default 'process')
+    :return: A list of consumers that can be started
     """
-    # Create producers processes
+    consumers = []
+    shared = ()
+    if backend == 'thread':
+        # The threads share the mapped prefix, the parsed headers and the caches of one verifier
+        shared_verifier = ArchiveVerifier(map_archive_prefix(archive_name, bytes_missing), file_name, file_hash,
+                                          hash_method, archive_function, needs_password, password)
+        shared = (shared_verifier, create_crc_screen(shared_verifier.prefix, [file_name], archive_function))
+
+    for i in range(number_of_consumers):
+        args = (scheduler, i, lock, state, progress_queue, archive_name, bytes_missing, sources, file_name,
+                file_hash, hash_method, cancel, archive_function, needs_password, password, metrics) + shared
+        if profile_directory is None:
+            c = CONSUMER_BACKENDS[backend](target=consumer, args=args)
+        else:
+            c = CONSUMER_BACKENDS[backend](target=run_profiled, args=(profile_directory, consumer) + args)
+        # A thread that does not stop in time must not keep the program running
+        c.daemon = backend == 'thread'
+        consumers.append(c)
+    return consumers
 
-    offset = 256 ** (current_bytes_try - 1)
-    if offset == 1:
-        offset = 0
-    elements_to_be_added = 256 ** current_bytes_try - offset
-    # TODO: Check that numbers divide correctly
-    elements_per_producer = int(
-        elements_to_be_added / numbers_of_producers)
 
-    producers = []
+def collect_results(state, consumers, progress_queue, journal, sources, scheduler, cancel, deadline=None,
+                    reporter=None, shutdown_timeout=SHUTDOWN_TIMEOUT, poll_interval=POLL_INTERVAL):
+    """Polls the state of the search while recording the chunks the consumers complete in the journal
+    and following the tail length that is searched.
+    A wrong password sets the cancellation event, which wakes the main process up right away. The consumers
+    then have shutdown_timeout seconds to stop before they are terminated. A hit does not cancel the search right
+    away: the consumers search the chunks that come before it, and the search is cancelled once the scheduler has
+    none of them left, or shutdown_timeout seconds after the hit, so the time from the hit to the end of the
+    consumers stays under twice shutdown_timeout.
+    A consumer that exits without marking its slot done (e.g. it crashed) is reported and does not hold up
+    the others.
 
-    for i in range(numbers_of_producers):
-        producers.append(Process(target=producer, args=(queue, lock, i, elements_per_producer, offset, found)))
-    return producers
+    :param state: The SearchState of the consumers. Its status is set to 2 when the deadline passes
+    :param consumers: The consumer processes or threads
+    :param progress_queue: The queue where consumers put the chunks they searched completely
+    :param journal: The CheckpointJournal of the search
+    :param sources: The candidate sources used by the consumers
+    :param scheduler: The WorkScheduler that hands out the chunks to the consumers
+    :param cancel: The Event that stops the consumers
+    :param deadline: The time.monotonic() value when the consumers are stopped (default None: no deadline)
+    :param reporter: The MetricsReporter told about every new tail length (default None)
+    :param shutdown_timeout: The number of seconds the consumers have to stop once the search is cancelled
+        (default SHUTDOWN_TIMEOUT)
+    :param poll_interval: The number of seconds between two polls of the state (default POLL_INTERVAL)
+    :return: A list with the (result, source name, length, stage rejects) outcome of every consumer that stopped
+        in time, and the number of seconds between the hit (or the cancellation) and the end of the consumers (None
+        when the search was neither cancelled nor solved)
+    """
+    def record_progress(timeout):
+        # Only the first get waits: the consumers may complete chunks more often than every timeout seconds
+        try:
+            journal.add(*progress_queue.get(timeout=timeout))
+            while True:
+                journal.add(*progress_queue.get_nowait())
+        except Empty:
+            pass
 
+    searched = None
 
-def create_consumers_and_pipes(number_of_consumers, archive_name, bytes_missing, queue, lock, file_name,
-                               file_hash, hash_method, found, archive_function, needs_password=False, password=None):
-    """Creates a list of consumers that share a queue and a lock.
-    Creates a list of pipes used for communication between consumers and main process
+    def follow_front():
+        nonlocal searched
+        front = scheduler.front()
+        if front is None or front[:2] == searched:
+            return
+        searched = front[:2]
+        source_index, length, left = front
+        print(f"Searching the candidates with {length} bytes of the {sources[source_index].name} candidate source")
+        if reporter is not None:
+            reporter.start_round(sources[source_index].name, length, left)
 
-    :param number_of_consumers: The number of producers that will read to the queue
-    :param archive_name: The name of the archive to be reconstructed by consumers
-    :param bytes_missing: The number of bytes to be trimmed from the archive
-    :param queue: The process safe queue that will be shared among producers/consumers and main process
-    :param lock: The lock over resources that will be shared among producers/consumers and main process
+    running = set(range(len(consumers)))
+    cancel_time = None
+    hit_time = None
+    while running:
+        if cancel_time is None:
+            follow_front()
+            # Wakes up as soon as a consumer finds that the password is wrong
+            cancel.wait(poll_interval)
+            record_progress(timeout=0)
+        else:
+            timeout = cancel_time + shutdown_timeout - time.monotonic()
+            if timeout <= 0:
+                break
+            # The consumers that are stopping may still put the chunks they completed
+            record_progress(timeout=min(timeout, poll_interval))
+        journal.save()
+        for i in list(running):
+            if state.worker_state(i) == WORKER_DONE:
+                running.discard(i)
+            elif not consumers[i].is_alive():
+                print(f"Consumer {consumers[i]} exited without a result. The chunk it was searching is not recorded")
+                running.discard(i)
+        if cancel_time is None:
+            if state.status == SEARCH_FOUND and hit_time is None:
+                print("A tail rebuilds the archive. Searching the candidates that come before it")
+                hit_time = time.monotonic()
+            if hit_time is not None:
+                # The scheduler only keeps the chunks that come before the tail
+                if scheduler.front() is None:
+                    cancel.set()
+                    cancel_time = time.monotonic()
+                elif time.monotonic() > hit_time + shutdown_timeout:
+                    print("The candidates that come before the tail were not all searched in time. "
+                          "A shorter tail may rebuild the archive")
+                    cancel.set()
+                    cancel_time = time.monotonic()
+            elif state.status == SEARCH_WRONG_PASSWORD:
+                cancel.set()
+                cancel_time = time.monotonic()
+            elif deadline is not None and time.monotonic() > deadline:
+                print("The time budget ran out. Stopping the consumers")
+                state.stop(SEARCH_TIME_BUDGET)
+                cancel.set()
+                cancel_time = time.monotonic()
+    # The consumers that are done only have to exit
+    stop_start = time.monotonic() if cancel_time is None else cancel_time
+    stop_consumers(consumers, stop_start + shutdown_timeout, lambda: record_progress(timeout=0.01))
+    record_progress(timeout=0)
+    journal.save(force=True)
+    shutdown_seconds = None
+    if hit_time is not None:
+        shutdown_seconds = time.monotonic() - hit_time
+        print(f"The consumers stopped {shutdown_seconds:.3f} seconds after the tail was found")
+    elif cancel_time is not None:
+        shutdown_seconds = time.monotonic() - cancel_time
+        print(f"The consumers stopped {shutdown_seconds:.3f} seconds after the search was cancelled")
+    return state.responses(sources), shutdown_seconds
+
+
+def plan_keyspace(sources, max_missing_bytes, journal):
+    """Lists the segments of the keyspace in the order they are searched: the tail lengths of every candidate
+    source from the shortest one, without the ranges recorded as searched in the journal
+
+    :param sources: The candidate sources, the first one being searched first
+    :param max_missing_bytes: The maximum length of the byte strings that are tried (None: no limit)
+    :param journal: The CheckpointJournal of the search
+    :return: A list of (source index, length, start, stop) tuples
+    """
+    segments = []
+    for source_index, source in enumerate(sources):
+        last_length = max_missing_bytes
+        if source.max_length is not None:
+            last_length = source.max_length if last_length is None else min(last_length, source.max_length)
+        length = 1
+        while last_length is None or length <= last_length:
+            keyspace_size = source.keyspace_size(length)
+            if keyspace_size > MAX_KEYSPACE_SIZE:
+                print(f"The {keyspace_size} candidates with {length} bytes are too many to be searched. "
+                      f"The search stops at {length - 1} bytes")
+                return segments
+            if keyspace_size == 0:
+                print(f"No candidate with {length} bytes is consistent with the archive structure")
+            else:
+                remaining_ranges = journal.remaining(source.name, length, keyspace_size)
+                if not remaining_ranges:
+                    print(f"All the candidates with {length} bytes were searched by a previous run")
+                segments += [(source_index, length, start, stop) for start, stop in remaining_ranges]
+            length += 1
+    return segments
+
+
+def solve_zip_tail(prefix, file_name, file_hash, hash_method, archive_function,
+                   needs_password=False, password=None):
+    """Tries to rebuild the missing tail of a ZIP archive from its surviving structures before
+    falling back to the brute force search.
+
+    :param prefix: A bytes-like object with the truncated archive
     :param file_name: The name of the file to be extracted from the archive
     :param file_hash: The hash of the file to be extracted from the file
     :param hash_method: The hash method (any hashlib method sent as a string e.g. 'md5')
-    :return: A list of consumers that can be started, A list of pipes used for communication between consumers and main process
-    :param found: A shared variable  between consumer/producer and mainprocess
-    in order to stop the process when the solution is found
     :param archive_function: A function that will be used to open the archive
     :param needs_password: A boolean value telling if a password is needed to open the archive. (default False)
-    :param password: String representation of the password (default False)
+    :param password: String representation of the password (default None)
+    :return: The tail that rebuilds the archive or None if the solver could not find it
     """
-    # Create consumers processes
+    verifier = ArchiveVerifier(prefix, file_name, file_hash, hash_method, archive_function, needs_password,
+                               password)
+    for candidate in zip_tail_candidates(prefix):
+        response = verifier.check(candidate)
+        if response == -1:
+            return None
+        if response:
+            return candidate
+    return None
 
-    consumers = []
-    pipe_list = []
-
-    for i in range(numbers_of_consumers):
-        corrupted_archive = trim_archive(archive_name, bytes_missing, copy=True, c_name=f'tr_{i}')
-        parent_conn, child_conn = Pipe()
-        pipe_list.append(parent_conn)
-        c = Process(target=consumer,
-                    args=(queue, lock, child_conn, corrupted_archive, file_name, file_hash,
-                          hash_method, found, archive_function, needs_password, password))
-        consumers.append(c)
-    return consumers, pipe_list
 
+def check_archive_password(prefix, file_names, password):
+    """Verifies the password once, before any consumer is started, against the encryption headers of the
+    members that lie in the truncated ZIP archive
 
-if __name__ == '__main__':
-    # UNCOMMENT THIS TO READ FROM KEYBOARD
-    archive_name,archive_open_function,file_name,needs_password,password,\
-    bytes_missing,hash_method,file_hash,numbers_of_producers,\
-    numbers_of_consumers=read_input_from_keyboard()
-
-    # print(archive_name,archive_open_function,file_name,needs_password,password,\
-    # bytes_missing,hash_method,file_hash,numbers_of_producers,\
-    # numbers_of_consumers)
-    # archive_name = "./the.zip"
-    # file_name = 'LoremIpsum.txt'
-    # needs_password = False
-    # password = None
-
-    # archive_name = "./AI_PROJECT.rar"
-    # file_name = 'AI_PROJECT/news.json'
-    # needs_password=False
-    # password=None
-
-    # archive_name = "./the_pass_protected.zip"
-    # file_name = 'LoremIpsum.txt'
-    # needs_password=True
-    # password='qweasdzxc1'
-
-    # UNCOMMENT THIS BLOCK FOR WRONG PASSWORD CASE
-    # archive_name = "./the_pass_protected.rar"
-    # file_name = 'LoremIpsum.txt'
-    # needs_password = True
-    # password = 'qweasdzxc1'
-    #
-    # bytes_missing = 2
-    # hash_method = 'md5'
-    #
-    # file_hash = compute_hash_unopened_file(file_name, hash_method)
-    # file_extension = get_file_extension(archive_name)
-    #
-    # accepted_extensions = {'.zip': zipfile.ZipFile, '.rar': RarFile}
-    # if file_extension not in accepted_extensions:
-    #     print("Please send a file with one of the following extensions:", list(accepted_extensions.keys()))
-    #     exit()
-    #
-    # archive_open_function = accepted_extensions[file_extension]
-    #
-    # numbers_of_producers = 4
-    # numbers_of_consumers = 4
-
-    found = Value('i', 0)
-    queue = Queue()
-    lock = Lock()
-    current_bytes_try = 1
-    while True:
-
-        main_corrupted_archive, removed_bits = trim_archive(archive_name, bytes_missing, copy=True,
-                                                            c_name=f'MAIN_truncated_archive', save_bytes=True)
-        print("Bits that were removed:", removed_bits)
-        print("Generator value for the removed part:", int.from_bytes(removed_bits, byteorder='big'))
-
-        producers = create_producers(numbers_of_producers, queue, lock, current_bytes_try, found)
-        consumers, pipe_list = create_consumers_and_pipes(numbers_of_consumers, archive_name, bytes_missing, queue,
-                                                          lock, file_name, file_hash, hash_method, found,
-                                                          archive_open_function, needs_password, password)
-        for p in producers:
-            p.start()
-
-        sleep(1)
-
-        for c in consumers:
-            c.start()
-        for p in producers:
-            p.join()
-            print(f"Producer {p} finished the job")
-
-        with lock:
-            print(f'Main thread tries to gather results from processes')
-        processes_responses = [x.recv() for x in pipe_list]
-
-        for c in consumers:
-            c.join()
-            print(f"Consumer {c} finished the job")
-
-        print("Results from processes:", processes_responses)
-
-        # Check if we received a Wrong password message and restart with a new password
-        if 'Wrong password' in processes_responses:
-            print(f"The password provided was wrong! ")
-            password = input("Please give a new password:\n")
-            found.value = 0
-            continue
-
-        # Search for solution
-        for response in processes_responses:
-            if response != 'Not found':
-                append_bytes_to_file(main_corrupted_archive, response)
-                print("File found after adding the following bits:")
-                print(response)
-                z = archive_open_function(main_corrupted_archive)
-                if needs_password:
-                    f = z.open(file_name, pwd=bytes(password, 'utf-8'))
+    :param prefix: A bytes-like object with the truncated archive
+    :param file_names: The name of the member to be extracted or the list of the names of the members
+    :param password: String representation of the password
+    :return: False if the password is wrong, True otherwise (also when no encryption header survived: the
+        consumers then find it out with the candidates)
+    """
+    if isinstance(file_names, str):
+        file_names = [file_names]
+    members = find_encrypted_members(prefix, file_names)
+    if Cipher is None and any(member.aes is not None for member in members):
+        print("The cryptography package is not installed: the WinZip AES members are accepted on their "
+              "authentication code and their hash is not verified")
+    checked = check_password(prefix, members, password.encode('utf-8'))
+    if checked is None:
+        print("No encryption header of the members survived: the password is verified with the candidates")
+    elif checked:
+        print("The password opens the encryption headers of the members")
+    return checked is not False
+
+
+def print_found_file(prefix, response, archive_open_function, file_name, needs_password=False, password=None):
+    """Rebuilds the archive in memory with the bytes found and prints the content of the file
+
+    :param prefix: A bytes-like object with the truncated archive
+    :param response: The byte string that rebuilds the archive
+    :param archive_open_function: A function that will be used to open the archive
+    :param file_name: The name of the file to be extracted from the archive
+    :param needs_password: A boolean value telling if a password is needed to open the archive. (default False)
+    :param password: String representation of the password (default None)
+    """
+    print("File found after adding the following bits:")
+    print(response)
+    z = archive_open_function(TailOverlayFile(prefix, response))
+    if needs_password:
+        f = z.open(file_name, pwd=bytes(password, 'utf-8'))
+    else:
+        f = z.open(file_name)
+    print("File content:")
+    print(f.read())
+    print("Done!")
+
+
+# The exit codes of the command line interface
+EXIT_FOUND = 0
+EXIT_NOT_FOUND = 1
+EXIT_WRONG_PASSWORD = 2
+EXIT_TIME_BUDGET = 3
+
+
+def find_missing_bytes(archive_name, archive_open_function, file_name, file_hash, hash_method, bytes_missing,
+                       numbers_of_consumers, needs_password=False, password=None, max_missing_bytes=None,
+                       time_budget=None, journal_path=None, resume=False, ask_password=None, use_solver=True,
+                       use_format_source=True, status_interval=5.0, metrics_path=None, metrics_port=None,
+                       profile_path=None, profile_top=20, interleave=1, backend='process', hints=None):
+    """Searches the bytes missing from the end of the archive: the ZIP tail solver first, then the candidates
+    of the format-aware source and finally the raw byte strings, one length after the other.
+    All the lengths are searched by one pool of consumers that is started once.
+
+    :param archive_name: The name of the archive
+    :param archive_open_function: A function that will be used to open the archive
+    :param file_name: The name of the file to be extracted from the archive
+    :param file_hash: The hash of the file to be extracted from the archive
+    :param hash_method: The hash method (any hashlib method sent as a string e.g. 'md5')
+    :param bytes_missing: The number of bytes removed from the end of the archive before the search
+    :param numbers_of_consumers: The number of consumers
+    :param needs_password: A boolean value telling if a password is needed to open the archive. (default False)
+    :param password: String representation of the password (default None)
+    :param max_missing_bytes: The maximum length of the byte strings that are tried (default None: no limit)
+    :param time_budget: The maximum number of seconds spent searching (default None: no limit)
+    :param journal_path: The checkpoint journal of the search (default: <archive>.journal when resume is set,
+        otherwise the searched ranges are not written anywhere). It is deleted once the tail is found
+    :param resume: If True the candidates recorded as searched in the journal are skipped (default False)
+    :param ask_password: A function that returns a new password when the password is wrong. If it is None
+        the search stops with the wrong password status (default None)
+    :param use_solver: If False the ZIP tail solver is skipped, e.g. to measure the enumeration (default True)
+    :param use_format_source: If False the raw byte strings are enumerated right away (default True)
+    :param status_interval: The number of seconds between two status lines, 0 to print none (default 5)
+    :param metrics_path: A JSON file rewritten with the metrics of the search (default None)
+    :param metrics_port: The port of a local HTTP endpoint that serves the metrics (default None)
+    :param profile_path: If set the consumers run under cProfile and their merged profile is written to this
+        pstats file (default None)
+    :param profile_top: The number of functions printed in the profile summary (default 20)
+    :param interleave: The number of tail lengths that are searched in turn (default 1: the shorter tails are
+        exhausted first)
+    :param backend: The key of CONSUMER_BACKENDS the consumers are run with (default 'process')
+    :param hints: The TailHints of what is known about the tail. Only the candidates that agree with them are
+        searched, the likely ones first (default None)
+    :return: A dictionary with the status ('found', 'not found', 'wrong password' or 'time budget exhausted'),
+        the tail that rebuilds the archive, the password and the statistics of the search
+    """
+    start_time = time.monotonic()
+    deadline = None if time_budget is None else start_time + time_budget
+    search_key = {'archive': archive_name, 'bytes_missing': bytes_missing, 'file_name': file_name,
+                  'hash_method': hash_method, 'file_hash': file_hash}
+    if hints is not None:
+        # Other hints number the candidates differently
+        search_key['hints'] = str(hints)
+    # Nothing is written next to the archive unless a journal is asked for: the evidence stays untouched
+    journal = CheckpointJournal(journal_path or (f"{archive_name}.journal" if resume else None), search_key)
+    if resume and journal.load():
+        print(f"Resuming the search recorded in {journal.path}")
+    stage_rejects = dict.fromkeys(STAGES, 0)
+    hits = 0
+    # The seconds between the cancellation of the last pool of consumers and their end
+    shutdown_seconds = None
+    # The archive is mapped once: the consumers map the same file and share its pages
+    archive_map = map_archive_prefix(archive_name, 0)
+    prefix = archive_map[:len(archive_map) - bytes_missing]
+    removed_bits = archive_map[len(archive_map) - bytes_missing:].tobytes()
+    print("Bits that were removed:", removed_bits)
+    print("Generator value for the removed part:", int.from_bytes(removed_bits, byteorder='big'))
+
+    def search_result(status, tail=None, source_name=None):
+        elapsed = time.monotonic() - start_time
+        candidates_tested = sum(stage_rejects.values()) + hits
+        return {'status': status, 'tail': tail, 'prefix': prefix, 'password': password, 'source': source_name,
+                'candidates_tested': candidates_tested, 'elapsed_seconds': elapsed,
+                'candidates_per_second': candidates_tested / elapsed if elapsed > 0 else 0.0,
+                'stage_rejects': dict(stage_rejects), 'backend': backend, 'shutdown_seconds': shutdown_seconds}
+
+    if needs_password and archive_open_function == zipfile.ZipFile:
+        while not check_archive_password(prefix, file_name, password):
+            print("The password provided is incorrect! Try sending a valid password")
+            if ask_password is None:
+                return search_result('wrong password')
+            password = ask_password()
+
+    if use_solver and archive_open_function == zipfile.ZipFile:
+        solved_tail = solve_zip_tail(prefix, file_name, file_hash, hash_method,
+                                     archive_open_function, needs_password, password)
+        if solved_tail is not None:
+            print("The ZIP tail solver rebuilt the end of the archive")
+            journal.remove()
+            return search_result('found', solved_tail, 'zip solver')
+        print("The ZIP tail solver could not rebuild the end of the archive. Falling back to enumeration")
+
+    source = select_candidate_source(archive_name, prefix) if use_format_source else RawCandidateSource()
+    print(f"Using the {source.name} candidate source")
+    # The raw byte strings are searched once the candidates of the format-aware source are exhausted
+    sources = [source] if source.name == RawCandidateSource.name else [source, RawCandidateSource()]
+    if hints is not None:
+        print(f"Only the candidates that agree with the hints {hints} are searched, the likely ones first")
+        sources = [HintedCandidateSource(source, hints) for source in sources]
+    metrics = WorkerMetrics(numbers_of_consumers)
+    reporter = MetricsReporter(metrics, status_interval, metrics_path, metrics_port)
+    reporter.start()
+    profile_directory = None if profile_path is None else tempfile.mkdtemp(prefix='FindMissingBytes-profile-')
+    profiled_pids = []
+    try:
+        # The pool is only restarted when the password is wrong and a new one is given
+        while True:
+            if deadline is not None and time.monotonic() > deadline:
+                return search_result('time budget exhausted')
+            segments = plan_keyspace(sources, max_missing_bytes, journal)
+            if not segments:
+                if resume:
+                    print("All the candidates were searched by a previous run")
                 else:
-                    f = z.open(file_name)
-                f.seek(0)
-                print("File content:")
-                print(f.read())
-                print("Done!")
-                exit(0)
-        print(f"Failed to unpack with {current_bytes_try}")
-        current_bytes_try += 1
+                    print("No candidate is left to search")
+                return search_result('not found')
+            scheduler = WorkScheduler(segments, numbers_of_consumers, interleave)
+            # Every pool gets new shared objects: a consumer terminated while it used one may have left it broken
+            cancel = Event()
+            lock = Lock()
+            progress_queue = Queue()
+            # The result slot holds the longest tail of the keyspace
+            state = SearchState(numbers_of_consumers, max(length for _, length, _, _ in segments))
+            try:
+                consumers = create_consumers(numbers_of_consumers, archive_name, bytes_missing, scheduler, lock,
+                                             state, progress_queue, sources, file_name, file_hash, hash_method,
+                                             cancel, archive_open_function, needs_password, password, metrics,
+                                             profile_directory, backend)
+                for c in consumers:
+                    c.start()
+                if profile_directory is not None:
+                    profiled_pids.extend(c.pid for c in consumers)
+
+                with lock:
+                    print(f'Main thread tries to gather results from processes')
+                responses, shutdown_seconds = collect_results(state, consumers, progress_queue, journal, sources,
+                                                              scheduler, cancel, deadline, reporter)
+                # The outcome is read from the status and the result slot: a consumer that reported it may have
+                # been terminated before it marked its slot done
+                status = state.status
+                result = state.result()
+                wrong_password_sections = state.reported(sources, SEARCH_WRONG_PASSWORD)
+            finally:
+                state.close()
+            # Only the consumers that stopped in time report their counters
+            for _, _, _, consumer_stage_rejects in responses:
+                for stage, rejects in consumer_stage_rejects.items():
+                    stage_rejects[stage] += rejects
+
+            print("Results from processes:", [response for response, _, _, _ in responses])
+            print(f"Candidates rejected by every verification stage so far:", stage_rejects)
+
+            # Check if we received a Wrong password message and restart with a new password
+            if status == SEARCH_WRONG_PASSWORD:
+                print(f"The password provided was wrong! ")
+                if ask_password is None:
+                    return search_result('wrong password')
+                password = ask_password()
+                for source_name, length in wrong_password_sections:
+                    journal.reset(source_name, length)
+                continue
+
+            # Search for solution
+            if result is not None:
+                tail, source_index, _ = result
+                hits += 1
+                journal.remove()
+                return search_result('found', tail, sources[source_index].name)
+            if status == SEARCH_TIME_BUDGET:
+                return search_result('time budget exhausted')
+            print(f"No candidate with up to {segments[-1][1]} bytes rebuilds the archive")
+            return search_result('not found')
+
+    finally:
+        reporter.stop()
+        if profile_directory is not None:
+            stats = merge_profiles(profile_directory, profile_path, profiled_pids)
+            os.rmdir(profile_directory)
+            if stats is not None:
+                print(f"The merged profile of the consumers was written to {profile_path}")
+                print_profile_summary(stats, profile_top)
+
+
+def peak_rss_kib():
+    """Returns the peak resident set size (KiB) of this process and of the biggest of its finished children,
+    or None where it can not be measured"""
+    if resource is None:
+        return None
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+@contextlib.contextmanager
+def stdout_to_stderr():
+    """Sends what is written to stdout to stderr until the end of the with block.
+    The file descriptor 1 is redirected, not only sys.stdout: the consumers started with the spawn start method
+    and the extractors run as subprocesses write to it.
+    """
+    sys.stdout.flush()
+    saved_stdout = os.dup(1)
+    os.dup2(2, 1)
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            yield
+    finally:
+        sys.stderr.flush()
+        os.dup2(saved_stdout, 1)
+        os.close(saved_stdout)
+
+
+def json_result(result, archive_name, file_name):
+    """Converts the result of find_missing_bytes to a JSON serializable dictionary"""
+    return {'status': result['status'], 'archive': archive_name, 'file_name': file_name,
+            'tail': None if result['tail'] is None else result['tail'].hex(),
+            'tail_length': None if result['tail'] is None else len(result['tail']),
+            'source': result['source'], 'candidates_tested': result['candidates_tested'],
+            'elapsed_seconds': round(result['elapsed_seconds'], 6),
+            'candidates_per_second': round(result['candidates_per_second'], 2),
+            'stage_rejects': result['stage_rejects'], 'backend': result['backend'],
+            'shutdown_seconds': None if result['shutdown_seconds'] is None else round(result['shutdown_seconds'], 6),
+            'peak_rss_kib': peak_rss_kib()}
+
+
+exit_codes = {'found': EXIT_FOUND, 'not found': EXIT_NOT_FOUND, 'wrong password': EXIT_WRONG_PASSWORD,
+              'time budget exhausted': EXIT_TIME_BUDGET}
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Finds the bytes missing from the end of a truncated archive. Without an archive the "
+                    "parameters are read from the keyboard",
+        epilog=f"Exit codes: {EXIT_FOUND} found, {EXIT_NOT_FOUND} not found, {EXIT_WRONG_PASSWORD} wrong password, "
+               f"{EXIT_TIME_BUDGET} time budget exhausted")
+    parser.add_argument('archive', nargs='?', help="The path of the archive")
+    parser.add_argument('--file-name', help="The name of the file inside the archive")
+    hash_group = parser.add_mutually_exclusive_group()
+    hash_group.add_argument('--hash', help="The expected hash of the file")
+    hash_group.add_argument('--hash-file',
+                            help="Compute the expected hash from this file (default: the local file named like "
+                                 "--file-name)")
+    parser.add_argument('--hash-method', default='md5', help="Any hashlib method (default md5)")
+    parser.add_argument('--password', default=None, help="The password of the archive")
+    parser.add_argument('--truncate', type=int, default=0,
+                        help="Remove this many bytes from the end of the archive before the search (default 0)")
+    parser.add_argument('--max-missing-bytes', type=int, default=None,
+                        help="The maximum number of missing bytes searched (default: no limit)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="The number of consumers (default: one per CPU)")
+    parser.add_argument('--time-budget', type=float, default=None,
+                        help="Stop the search after this many seconds (default: no limit)")
+    parser.add_argument('--interleave', type=int, default=1,
+                        help="Search the chunks of this many tail lengths in turn instead of exhausting the shorter "
+                             "tails first (default 1)")
+    parser.add_argument('--hint', action='append', default=[], metavar='POSITION=VALUES',
+                        help="What is known about a byte of the tail: a hexadecimal value (0=50), values in order of "
+                             "likelihood (0=50,10), a range (0=30-39) or a value and a mask (0=40/f0). Positions "
+                             "count from the start of the tail, or from the end of the archive when negative (-1 is "
+                             "the last byte). The candidates are then searched best-first. Can be repeated")
+    parser.add_argument('--known-tail', default=None, metavar='HEX',
+                        help="The first bytes of the tail in hexadecimal, e.g. recovered from another copy")
+    parser.add_argument('--backend', choices=list(CONSUMER_BACKENDS), default='process',
+                        help="Run the consumers as processes or as threads that share one verifier (default process)")
+    parser.add_argument('--no-solver', action='store_true',
+                        help="Skip the ZIP tail solver and go straight to the enumeration")
+    parser.add_argument('--raw', action='store_true',
+                        help="Skip the format-aware candidate source and enumerate the raw byte strings")
+    parser.add_argument('--status-interval', type=float, default=5.0,
+                        help="Seconds between two status lines, 0 to print none (default 5)")
+    parser.add_argument('--metrics-file', default=None,
+                        help="Rewrite this JSON file with the metrics of the search at every status interval")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="Serve the metrics of the search as JSON on http://127.0.0.1:<port>/")
+    parser.add_argument('--profile', nargs='?', const='FindMissingBytes.pstats', default=None, metavar='PSTATS',
+                        help="Run the consumers under cProfile and write the merged profile to this file "
+                             "(default FindMissingBytes.pstats)")
+    parser.add_argument('--profile-top', type=int, default=20,
+                        help="The number of functions in the profile summary (default 20)")
+    parser.add_argument('--output', default=None, help="Write the JSON result to this file instead of stdout")
+    parser.add_argument('--journal', default=None,
+                        help="Record the searched ranges in this checkpoint journal, deleted once the tail is found "
+                             "(default: <archive>.journal with --resume, otherwise no journal is written)")
+    parser.add_argument('--resume', action='store_true',
+                        help="Skip the candidates recorded as searched in the checkpoint journal")
+    arguments = parser.parse_args()
+    if arguments.archive is not None:
+        if get_file_extension(arguments.archive) not in accepted_extensions:
+            parser.error(f"the archive must have one of the following extensions: {list(accepted_extensions)}")
+        if arguments.file_name is None:
+            parser.error("--file-name is required with an archive")
+    arguments.hints = None
+    if arguments.hint or arguments.known_tail:
+        try:
+            arguments.hints = TailHints([TailHints.parse_hint(hint) for hint in arguments.hint],
+                                        bytes.fromhex(arguments.known_tail or ''))
+        except ValueError as e:
+            parser.error(f"invalid hint: {e}")
+    if arguments.profile is not None and arguments.backend != 'process':
+        # cProfile can't profile several threads of a process at once
+        parser.error("--profile needs the process backend")
+    return arguments
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+
+    if arguments.archive is None:
+        archive_name,archive_open_function,file_name,needs_password,password,\
+        bytes_missing,hash_method,file_hash,numbers_of_consumers=read_input_from_keyboard()
+        result = find_missing_bytes(archive_name, archive_open_function, file_name, file_hash, hash_method,
+                                    bytes_missing, numbers_of_consumers, needs_password, password,
+                                    journal_path=arguments.journal, resume=arguments.resume,
+                                    ask_password=lambda: input("Please give a new password:\n"),
+                                    status_interval=arguments.status_interval, metrics_path=arguments.metrics_file,
+                                    metrics_port=arguments.metrics_port, profile_path=arguments.profile,
+                                    profile_top=arguments.profile_top, interleave=arguments.interleave,
+                                    backend=arguments.backend, hints=arguments.hints)
+        if result['status'] == 'found':
+            print_found_file(result['prefix'], result['tail'], archive_open_function, file_name, needs_password,
+                             result['password'])
+        sys.exit(exit_codes[result['status']])
+
+    archive_open_function = accepted_extensions[get_file_extension(arguments.archive)]
+    # Only the JSON result is written to stdout, so it can be piped. The progress of the search goes to stderr,
+    # also from the consumers and the extractors they run
+    with stdout_to_stderr():
+        file_hash = arguments.hash or compute_hash_unopened_file(arguments.hash_file or arguments.file_name,
+                                                                 arguments.hash_method)
+        result = find_missing_bytes(arguments.archive, archive_open_function, arguments.file_name, file_hash,
+                                    arguments.hash_method, arguments.truncate, arguments.workers,
+                                    arguments.password is not None, arguments.password, arguments.max_missing_bytes,
+                                    arguments.time_budget, arguments.journal, arguments.resume,
+                                    use_solver=not arguments.no_solver, use_format_source=not arguments.raw,
+                                    status_interval=arguments.status_interval, metrics_path=arguments.metrics_file,
+                                    metrics_port=arguments.metrics_port, profile_path=arguments.profile,
+                                    profile_top=arguments.profile_top, interleave=arguments.interleave,
+                                    backend=arguments.backend, hints=arguments.hints)
+    output = json.dumps(json_result(result, arguments.archive, arguments.file_name))
+    if arguments.output is None:
+        print(output)
+    else:
+        with open(arguments.output, 'w') as f:
+            f.write(output + '\n')
+    sys.exit(exit_codes[result['status']])
@@ -0,0 +1,570 @@
+import copy
+import hashlib
+import traceback
+from time import perf_counter
+import zipfile
+from zipfile import BadZipFile
+from zlib import crc32, error as ZlibError
+
+from rarfile import BadRarFile, RarFile
+
+from file_processing import compute_hash_opened_file
+from in_memory_archive import TailOverlayFile
+from rar_headers import RarLayout
+from zip_directory import CachedZipFile, ZipDirectoryCache
+from zip_encryption import AES_METHOD, AES_STRENGTHS, AES_VERIFIER_SIZE, AES_AUTHENTICATION_CODE_SIZE, AesKeys, \
+    Cipher, aes_extra_field, check_password, find_encrypted_members, zipcrypto_check_byte
+from zip_tail_solver import END_OF_CENTRAL_DIRECTORY_SIGNATURE, END_OF_CENTRAL_DIRECTORY_STRUCT, \
+    CENTRAL_DIRECTORY_SIGNATURE, LOCAL_HEADER_SIGNATURE, LOCAL_HEADER_STRUCT, DATA_DESCRIPTOR_FLAG, ZIP64_LIMIT
+from zipcrypto import ZipCryptoKeys, ENCRYPTION_HEADER_SIZE
+
+# The verification stages, in the order they run. A candidate is rejected by the first stage it fails:
+# structure - the End of Central Directory record rebuilt by the tail is not consistent
+# headers   - the archive can not be opened or the local header of the member does not match the central directory
+# crc       - the member can not be decompressed or its CRC-32 / size do not match
+# hash      - the hash_method digest of the member is not the expected one
+STAGES = ('structure', 'headers', 'crc', 'hash')
+
+# Bit 0 of the flags tells that the member is encrypted
+ENCRYPTED_FLAG = 0x01
+# Bit 11 of the flags tells that the member name is encoded with UTF-8 (cp437 otherwise)
+UTF8_NAME_FLAG = 0x800
+# zipfile searches the End of Central Directory record in the last 64 KiB of the archive (the comment size limit)
+END_RECORD_SEARCH_SIZE = END_OF_CENTRAL_DIRECTORY_STRUCT.size + 0xFFFF
+# The size of the reads made while decompressing a member
+READ_SIZE = 1 << 16
+
+
+class ArchiveVerifier:
+    """Verifies candidate tails against a truncated archive that is kept in memory.
+    The archive prefix is read once and every candidate is tested on a TailOverlayFile,
+    so no candidate ever touches the filesystem.
+    ZIP candidates go through the STAGES from the cheapest to the most expensive one and the hash
+    is only computed for the candidates that pass all the others.
+    """
+
+    def __init__(self, prefix, file_name, file_hash, hash_method, archive_function, needs_password=False,
+                 password=None):
+        """
+        :param prefix: A bytes-like object with the truncated archive
+        :param file_name: The name of the file to be extracted from the archive, or a list of names when several
+            members of the archive are verified together
+        :param file_hash: The hash of the initial file, or the list of the hashes of the members
+        :param hash_method: The method of generating the file_hash (any hashlib method sent as a string e.g. 'md5')
+        :param archive_function: A function that will be used to open the archive
+        :param needs_password: A boolean value telling if a password is needed to open the archive. (default False)
+        :param password: String representation of the password (default None)
+        """
+        self.prefix = prefix
+        # The (name, hash) of every member that is verified. A candidate is accepted when all of them match
+        if isinstance(file_name, str):
+            self.targets = [(file_name, file_hash)]
+        else:
+            self.targets = list(zip(file_name, file_hash))
+        self.file_name, self.file_hash = self.targets[0]
+        self.hash_method = hash_method
+        self.archive_function = archive_function
+        self.needs_password = needs_password
+        self.password = password
+        self.is_zip = archive_function == zipfile.ZipFile
+        # The password is checked once against the encryption headers that lie in the prefix (None when there is
+        # none). Once it is known to be right, a candidate whose check byte does not match is only rejected
+        self.password_checked = None
+        if self.is_zip and needs_password:
+            self.password_bytes = password.encode('utf-8')
+            self.password_checked = check_password(
+                prefix, find_encrypted_members(prefix, [name for name, _ in self.targets]), self.password_bytes)
+            # The ZipCrypto keys after the password, copied for every member
+            self._zipcrypto_keys = ZipCryptoKeys(self.password_bytes)
+        # The central directory records that lie in the prefix are parsed once for all the candidates
+        self.zip_directory = ZipDirectoryCache(prefix) if self.is_zip else None
+        # The headers of a RAR archive are verified in-process: the extractor only runs for the candidates
+        # whose headers are all valid
+        self.rar_layout = None
+        if archive_function == RarFile:
+            try:
+                self.rar_layout = RarLayout(prefix)
+            except ValueError as e:
+                print(f"The RAR headers can't be verified in-process ({e}). Every candidate is opened with rarfile")
+        # The number of candidates rejected by every stage
+        self.stage_rejects = dict.fromkeys(STAGES, 0)
+        # The time spent on the candidates, charged to the last stage each one reached
+        self.stage_seconds = dict.fromkeys(STAGES, 0.0)
+        # The stage that rejected the members whose data lies entirely in the prefix (None when accepted)
+        self._member_results = {}
+        # The hash object and CRC-32 of the part of the stored members that lies in the prefix
+        self._member_checkpoints = {}
+        # The decryption state of the encrypted members after the part of their data that lies in the prefix
+        self._encryption_checkpoints = {}
+        # The positions of the End of Central Directory signatures that are entirely inside the prefix
+        search_start = max(0, len(prefix) - END_RECORD_SEARCH_SIZE)
+        window = bytes(prefix[search_start:])
+        self._prefix_end_records = []
+        position = window.find(END_OF_CENTRAL_DIRECTORY_SIGNATURE)
+        while position != -1:
+            self._prefix_end_records.append(search_start + position)
+            position = window.find(END_OF_CENTRAL_DIRECTORY_SIGNATURE, position + 1)
+
+    def share(self):
+        """Returns a verifier for another thread of the same process. It shares the prefix, the parsed headers
+        and the cached member results and checkpoints with this one and has its own counters.
+        The caches only hold values that don't depend on the thread, so when two threads fill the same entry
+        the worst case is that the work is done twice.
+
+        :return: An ArchiveVerifier
+        """
+        verifier = copy.copy(self)
+        verifier.stage_rejects = dict.fromkeys(STAGES, 0)
+        verifier.stage_seconds = dict.fromkeys(STAGES, 0.0)
+        return verifier
+
+    def open_candidate(self, bytes_to_add):
+        """Returns a file object for the archive rebuilt with the given tail
+
+        :param bytes_to_add: The byte string that will be appended to the end of the archive
+        :return: A read-only file object
+        """
+        return TailOverlayFile(self.prefix, bytes_to_add)
+
+    def open_member(self, z, file_name=None):
+        """Opens a member that is verified
+
+        :param z: The opened archive
+        :param file_name: The name of the member (default: the first member that is verified)
+        :return: A file object with the content of the member
+        """
+        if file_name is None:
+            file_name = self.file_name
+        if self.needs_password:
+            return z.open(file_name, pwd=bytes(self.password, 'utf-8'))
+        return z.open(file_name)
+
+    def find_end_record(self, bytes_to_add):
+        """Returns the position of the End of Central Directory record of the rebuilt archive
+        (the last signature of the archive, like zipfile does) or -1 if there is none
+
+        :param bytes_to_add: The candidate tail
+        """
+        prefix_length = len(self.prefix)
+        overlap = len(END_OF_CENTRAL_DIRECTORY_SIGNATURE) - 1
+        window = bytes(self.prefix[max(0, prefix_length - overlap):]) + bytes(bytes_to_add)
+        window_start = prefix_length + len(bytes_to_add) - len(window)
+        position = window.rfind(END_OF_CENTRAL_DIRECTORY_SIGNATURE)
+        if position != -1:
+            return window_start + position
+        if self._prefix_end_records:
+            return self._prefix_end_records[-1]
+        return -1
+
+    def check_end_record(self, candidate, bytes_to_add):
+        """Stage 1: verifies that the End of Central Directory record of the rebuilt archive is consistent
+
+        :param candidate: The file object of the rebuilt archive
+        :param bytes_to_add: The candidate tail
+        :return: The (position, entries, central directory size, central directory offset, comment length) of the
+            record if it is consistent, None otherwise
+        """
+        size = len(self.prefix) + len(bytes_to_add)
+        position = self.find_end_record(bytes_to_add)
+        if position == -1 or position + END_OF_CENTRAL_DIRECTORY_STRUCT.size > size:
+            return None
+        candidate.seek(position)
+        (_, disk_number, central_directory_disk, disk_entries, entries, central_directory_size,
+         central_directory_offset, comment_length) = END_OF_CENTRAL_DIRECTORY_STRUCT.unpack(
+            candidate.read(END_OF_CENTRAL_DIRECTORY_STRUCT.size))
+        end_record = (position, entries, central_directory_size, central_directory_offset, comment_length)
+        if position + END_OF_CENTRAL_DIRECTORY_STRUCT.size + comment_length != size:
+            return None
+        if 0xFFFF in (disk_entries, entries) or ZIP64_LIMIT in (central_directory_size, central_directory_offset):
+            # ZIP64 archives are left to zipfile
+            return end_record
+        if disk_number != 0 or central_directory_disk != 0 or disk_entries != entries:
+            return None
+        if central_directory_size + central_directory_offset > position:
+            return None
+        if entries:
+            candidate.seek(position - central_directory_size)
+            if candidate.read(4) != CENTRAL_DIRECTORY_SIGNATURE:
+                return None
+        return end_record
+
+    @staticmethod
+    def check_local_header(candidate, info):
+        """Stage 2: verifies that the local header of the member matches its central directory record
+
+        :param candidate: The file object of the rebuilt archive
+        :param info: The ZipInfo of the member
+        :return: The position where the member data starts or None if the headers don't match
+        """
+        candidate.seek(info.header_offset)
+        header = candidate.read(LOCAL_HEADER_STRUCT.size)
+        if len(header) != LOCAL_HEADER_STRUCT.size:
+            return None
+        (signature, _, _, _, _, _, crc, compressed_size, file_size, name_length,
+         extra_length) = LOCAL_HEADER_STRUCT.unpack(header)
+        name = info.orig_filename.encode('utf-8' if info.flag_bits & UTF8_NAME_FLAG else 'cp437')
+        if signature != LOCAL_HEADER_SIGNATURE or candidate.read(name_length) != name:
+            return None
+        data_start = info.header_offset + LOCAL_HEADER_STRUCT.size + name_length + extra_length
+        if info.flag_bits & DATA_DESCRIPTOR_FLAG or ZIP64_LIMIT in (compressed_size, file_size):
+            # The local header does not hold the CRC and the sizes
+            return data_start
+        if (crc, compressed_size, file_size) != (info.CRC, info.compress_size, info.file_size):
+            return None
+        return data_start
+
+    def read_candidate(self, start, end, bytes_to_add):
+        """Returns the bytes of the archive rebuilt with the given tail between start and end
+
+        :param start: The position of the first byte
+        :param end: The position right after the last byte
+        :param bytes_to_add: The candidate tail
+        """
+        prefix_length = len(self.prefix)
+        data = bytes(self.prefix[start:end]) if start < prefix_length else b''
+        return data + bytes_to_add[max(0, start - prefix_length):max(0, end - prefix_length)]
+
+    def check_member_crc(self, z, info, open_data=None):
+        """Stage 3: decompresses the member and verifies its CRC-32 and size.
+        The decompression stops as soon as the member gets bigger than its expected size.
+
+        :param z: The opened archive
+        :param info: The ZipInfo of the member. Its CRC-32 is not verified when it is None
+        :param open_data: A function returning a file object with the content of the member (default: open_member)
+        :return: True if the CRC-32 and the size match
+        """
+        if open_data is None:
+            open_data = lambda: self.open_member(z, info.filename)
+        crc = 0
+        size = 0
+        with open_data() as f:
+            while chunk := f.read(READ_SIZE):
+                size += len(chunk)
+                if size > info.file_size:
+                    return False
+                crc = crc32(chunk, crc)
+        return size == info.file_size and info.CRC in (None, crc)
+
+    def check_member_data(self, z, info, file_hash, open_data=None):
+        """Stages 3 and 4: verifies the CRC-32 of the member and, only when it matches, its hash
+
+        :param z: The opened archive
+        :param info: The ZipInfo of the member
+        :param file_hash: The expected hash of the member
+        :param open_data: A function returning a file object with the content of the member (default: open_member)
+        :return: None if the member is the expected one, otherwise the stage that rejected it
+        """
+        if open_data is None:
+            open_data = lambda: self.open_member(z, info.filename)
+        if not self.check_member_crc(z, info, open_data):
+            return 'crc'
+        with open_data() as f:
+            if compute_hash_opened_file(f, self.hash_method) != file_hash:
+                return 'hash'
+        return None
+
+    def check_cached_member_data(self, z, info, key, file_hash, open_data=None):
+        """Stages 3 and 4 for a member whose data lies entirely before the truncation point.
+        The member content does not depend on the tail, so it is decompressed and hashed only once.
+
+        :param z: The opened archive
+        :param info: The ZipInfo of the member
+        :param key: The description of the member data (position, sizes, method, CRC-32, flags)
+        :param file_hash: The expected hash of the member
+        :param open_data: A function returning a file object with the content of the member (default: open_member)
+        :return: None if the member is the expected one, otherwise the stage that rejected it
+        """
+        key = key + (file_hash,)
+        if key not in self._member_results:
+            try:
+                self._member_results[key] = self.check_member_data(z, info, file_hash, open_data)
+            except (BadZipFile, ZlibError, EOFError, ValueError, OSError):
+                self._member_results[key] = 'crc'
+        return self._member_results[key]
+
+    def check_stored_member_data(self, data_start, data_size, expected_crc, bytes_to_add, key, file_hash):
+        """Stages 3 and 4 for a stored member whose data may run into the tail.
+
+        :param data_start: The position where the member data starts
+        :param data_size: The size of the member data
+        :param expected_crc: The CRC-32 of the member or None if the archive does not hold it
+        :param bytes_to_add: The candidate tail
+        :param key: The description of the member data (position, sizes, method, CRC-32, flags)
+        :param file_hash: The expected hash of the member
+        :return: None if the member is the expected one, otherwise the stage that rejected it
+        """
+        data_end = data_start + data_size
+        suffix = bytes_to_add[max(0, data_start - len(self.prefix)):max(0, data_end - len(self.prefix))]
+        return self.check_stored_data(lambda: memoryview(self.prefix)[data_start:data_end], suffix, expected_crc,
+                                      key, file_hash)
+
+    def check_stored_data(self, read_prefix_part, suffix, expected_crc, key, file_hash):
+        """Stages 3 and 4 for the content of a stored member.
+        The CRC-32 and the hash of the part of the member that lies in the prefix are computed once;
+        every candidate continues from a copy of that checkpoint with its own bytes only.
+
+        :param read_prefix_part: A function returning the part of the content that lies in the prefix. It is only
+            called the first time the key is seen
+        :param suffix: The part of the content that lies in the tail
+        :param expected_crc: The CRC-32 of the member or None if the archive does not hold it
+        :param key: The description of the member data (position, sizes, method, CRC-32, flags)
+        :param file_hash: The expected hash of the member
+        :return: None if the member is the expected one, otherwise the stage that rejected it
+        """
+        if key not in self._member_checkpoints:
+            data = read_prefix_part()
+            hash_object = hashlib.new(self.hash_method)
+            crc = 0
+            for chunk_start in range(0, len(data), READ_SIZE):
+                chunk = data[chunk_start:chunk_start + READ_SIZE]
+                hash_object.update(chunk)
+                crc = crc32(chunk, crc)
+            self._member_checkpoints[key] = (hash_object, crc)
+        hash_object, crc = self._member_checkpoints[key]
+        if expected_crc is not None and crc32(suffix, crc) != expected_crc:
+            return 'crc'
+        hash_object = hash_object.copy()
+        hash_object.update(suffix)
+        if hash_object.hexdigest() != file_hash:
+            return 'hash'
+        return None
+
+    def check_decrypted_member_data(self, info, data, suffix, key, file_hash):
+        """Stages 3 and 4 for the decrypted content of an encrypted member
+
+        :param info: The ZipInfo of the decrypted member: not encrypted, with the size of the decrypted data
+        :param data: The decrypted part of the member data that lies in the prefix
+        :param suffix: The decrypted part of the member data that lies in the tail
+        :param key: The description of the member data (position, sizes, method, CRC-32, flags)
+        :param file_hash: The expected hash of the member
+        :return: None if the member is the expected one, otherwise the stage that rejected it
+        """
+        if info.compress_type == zipfile.ZIP_STORED and info.compress_size == info.file_size:
+            return self.check_stored_data(lambda: data, suffix, info.CRC, key, file_hash)
+        open_data = lambda: zipfile.ZipExtFile(TailOverlayFile(data, suffix), 'rb', info)
+        if not suffix:
+            return self.check_cached_member_data(None, info, key, file_hash, open_data)
+        return self.check_member_data(None, info, file_hash, open_data)
+
+    def check_zipcrypto_member(self, info, data_start, bytes_to_add, key, file_hash):
+        """Stages 3 and 4 for a member encrypted with ZipCrypto whose encryption header lies in the prefix.
+        The part of the member that lies in the prefix is decrypted once; every candidate continues from a copy
+        of the keys with its own bytes only. A check byte that does not match the CRC-32 (or time) written by
+        the candidate rejects it at the crc stage.
+
+        :param info: The ZipInfo of the member
+        :param data_start: The position where the member data starts
+        :param bytes_to_add: The candidate tail
+        :param key: The description of the member data (position, sizes, method, CRC-32, flags)
+        :param file_hash: The expected hash of the member
+        :return: None if the member is the expected one, otherwise the stage that rejected it
+        """
+        data_end = data_start + info.compress_size
+        prefix_end = min(data_end, len(self.prefix))
+        checkpoint_key = (data_start, prefix_end)
+        if checkpoint_key not in self._encryption_checkpoints:
+            keys = self._zipcrypto_keys.copy()
+            header = keys.decrypt(self.prefix[data_start:data_start + ENCRYPTION_HEADER_SIZE])
+            data = keys.decrypt(self.prefix[data_start + ENCRYPTION_HEADER_SIZE:prefix_end])
+            self._encryption_checkpoints[checkpoint_key] = (header[-1], keys, data)
+        check_byte, keys, data = self._encryption_checkpoints[checkpoint_key]
+        if check_byte != zipcrypto_check_byte(info.flag_bits, info.CRC, info._raw_time):
+            return 'crc'
+        suffix = keys.copy().decrypt(self.read_candidate(prefix_end, data_end, bytes_to_add))
+        decrypted_info = copy.copy(info)
+        decrypted_info.flag_bits &= ~ENCRYPTED_FLAG
+        decrypted_info.compress_size -= ENCRYPTION_HEADER_SIZE
+        return self.check_decrypted_member_data(decrypted_info, data, suffix, key, file_hash)
+
+    def check_aes_member(self, info, data_start, bytes_to_add, key, file_hash):
+        """Stages 3 and 4 for a member encrypted with WinZip AES.
+        The keys are derived once and the authentication code and the decryption of the part of the member that
+        lies in the prefix are computed once. The authentication code of the encrypted data is verified at the
+        crc stage, before anything is decrypted. Without the cryptography package the member can't be decrypted
+        and it is accepted on its authentication code alone.
+
+        :param info: The ZipInfo of the member
+        :param data_start: The position where the member data starts
+        :param bytes_to_add: The candidate tail
+        :param key: The description of the member data (position, sizes, method, CRC-32, flags)
+        :param file_hash: The expected hash of the member
+        :return: None if the member is the expected one, otherwise the stage that rejected it
+        """
+        aes = aes_extra_field(info.extra)
+        if aes is None:
+            return 'headers'
+        version, strength, method = aes
+        salt_length = AES_STRENGTHS[strength][1]
+        encrypted_start = data_start + salt_length + AES_VERIFIER_SIZE
+        data_end = data_start + info.compress_size
+        encrypted_end = data_end - AES_AUTHENTICATION_CODE_SIZE
+        if encrypted_end < encrypted_start:
+            return 'crc'
+        prefix_end = max(encrypted_start, min(encrypted_end, len(self.prefix)))
+        checkpoint_key = (data_start, prefix_end, strength)
+        checkpoint = self._encryption_checkpoints.get(checkpoint_key)
+        if checkpoint is None:
+            header = self.read_candidate(data_start, encrypted_start, bytes_to_add)
+            keys = AesKeys(self.password_bytes, header[:salt_length], strength)
+            authenticator = keys.authenticator()
+            encrypted = self.prefix[encrypted_start:prefix_end]
+            authenticator.update(encrypted)
+            data = None if Cipher is None else keys.decrypt(encrypted)
+            checkpoint = (header, keys, authenticator, data)
+            # A salt written by the tail belongs to this candidate only
+            if encrypted_start <= len(self.prefix):
+                self._encryption_checkpoints[checkpoint_key] = checkpoint
+        header, keys, authenticator, data = checkpoint
+        if header[salt_length:] != keys.verifier:
+            return 'headers'
+        encrypted_suffix = self.read_candidate(prefix_end, encrypted_end, bytes_to_add)
+        authenticator = authenticator.copy()
+        authenticator.update(encrypted_suffix)
+        authentication_code = self.read_candidate(encrypted_end, data_end, bytes_to_add)
+        if authenticator.digest()[:AES_AUTHENTICATION_CODE_SIZE] != authentication_code:
+            return 'crc'
+        if data is None:
+            return None
+        decrypted_info = copy.copy(info)
+        decrypted_info.flag_bits &= ~ENCRYPTED_FLAG
+        decrypted_info.compress_type = method
+        decrypted_info.compress_size = encrypted_end - encrypted_start
+        if version != 1:
+            # AE-2 members don't keep their CRC-32: the authentication code replaces it
+            decrypted_info.CRC = None
+        suffix = keys.decrypt(encrypted_suffix, prefix_end - encrypted_start)
+        return self.check_decrypted_member_data(decrypted_info, data, suffix, key, file_hash)
+
+    def check_zip_member(self, z, info, data_start, bytes_to_add, file_hash):
+        """Stages 3 and 4 for ZIP archives, reusing the work done for previous candidates when the
+        member data (or a part of it) does not depend on the tail
+
+        :param z: The opened archive
+        :param info: The ZipInfo of the member
+        :param data_start: The position where the member data starts
+        :param bytes_to_add: The candidate tail
+        :param file_hash: The expected hash of the member
+        :return: None if the member is the expected one, otherwise the stage that rejected it
+        """
+        data_end = data_start + info.compress_size
+        key = (data_start, info.compress_type, info.compress_size, info.file_size, info.CRC, info.flag_bits)
+        encrypted = info.flag_bits & ENCRYPTED_FLAG
+        if encrypted and self.needs_password:
+            if data_end > len(self.prefix) + len(bytes_to_add):
+                return 'crc'
+            if info.compress_type == AES_METHOD:
+                return self.check_aes_member(info, data_start, bytes_to_add, key, file_hash)
+            if data_start + ENCRYPTION_HEADER_SIZE <= min(data_end, len(self.prefix)):
+                return self.check_zipcrypto_member(info, data_start, bytes_to_add, key, file_hash)
+        if data_end <= len(self.prefix):
+            return self.check_cached_member_data(z, info, key, file_hash)
+        stored = info.compress_type == zipfile.ZIP_STORED and info.compress_size == info.file_size
+        if stored and not encrypted and data_start <= len(self.prefix) and \
+                data_end <= len(self.prefix) + len(bytes_to_add):
+            return self.check_stored_member_data(data_start, info.compress_size, info.CRC, bytes_to_add, key,
+                                                 file_hash)
+        return self.check_member_data(z, info, file_hash)
+
+    def check(self, bytes_to_add):
+        """Verifies if adding the bytes_to_add byte string to the end of the archive returns
+        a valid archive and if the file given can be extracted from the archive.
+
+        :param bytes_to_add: The byte string that will be appended to the end of the archive
+        :return: True if every member can be extracted from the archive with its expected hash,
+            False if one can't and -1 when the password is wrong
+        """
+        if self.password_checked is False:
+            print("The password provided is incorrect! Try sending a valid password")
+            return -1
+        start_time = perf_counter()
+        candidate = self.open_candidate(bytes_to_add)
+        stage = 'structure'
+        try:
+            if self.is_zip:
+                end_record = self.check_end_record(candidate, bytes_to_add)
+                if end_record is None:
+                    self.stage_rejects[stage] += 1
+                    return False
+                stage = 'headers'
+                # Only the central directory records written by the tail are parsed
+                z = CachedZipFile(candidate, self.zip_directory, end_record)
+                # The archive is opened once for all the members
+                for file_name, file_hash in self.targets:
+                    stage = 'headers'
+                    info = z.getinfo(file_name)
+                    data_start = self.check_local_header(candidate, info)
+                    if data_start is None:
+                        self.stage_rejects[stage] += 1
+                        return False
+                    stage = 'crc'
+                    rejected_stage = self.check_zip_member(z, info, data_start, bytes_to_add, file_hash)
+                    if rejected_stage is not None:
+                        stage = rejected_stage
+                        self.stage_rejects[rejected_stage] += 1
+                        return False
+                stage = 'hash'
+                return True
+            if self.rar_layout is not None:
+                tail_blocks = self.rar_layout.parse_tail(bytes_to_add)
+                if tail_blocks is None:
+                    self.stage_rejects[stage] += 1
+                    return False
+                # Compressed and encrypted members are left to rarfile and its extractor
+                extracted_targets = []
+                for file_name, file_hash in self.targets:
+                    stage = 'headers'
+                    member = self.rar_layout.find_member(file_name, tail_blocks)
+                    if member is None:
+                        self.stage_rejects[stage] += 1
+                        return False
+                    if not member.stored or member.encrypted or member.split:
+                        extracted_targets.append((file_name, file_hash))
+                        continue
+                    stage = 'crc'
+                    rejected_stage = self.check_stored_member_data(
+                        member.data_start, member.data_size, member.crc, bytes_to_add,
+                        (member.data_start, member.data_size, member.crc), file_hash)
+                    if rejected_stage is not None:
+                        stage = rejected_stage
+                        self.stage_rejects[rejected_stage] += 1
+                        return False
+                if not extracted_targets:
+                    stage = 'hash'
+                    return True
+            else:
+                extracted_targets = self.targets
+            z = self.archive_function(candidate)
+            stage = 'hash'
+            for file_name, file_hash in extracted_targets:
+                f = self.open_member(z, file_name)
+                computed_hash = compute_hash_opened_file(f, self.hash_method)
+                if computed_hash != file_hash:
+                    self.stage_rejects[stage] += 1
+                    return False
+            return True
+        except Exception as e:
+            # BadZipFile when a ZIP archive is corrupted
+            # BadRarFile when a RAR archive is corrupted or the password is incorrect
+            # Errno 22 when the archive is valid but the file inside is corrupted
+            # zlib/EOF/Value errors when a member is decompressed from a corrupted stream
+            # KeyError when the rebuilt central directory does not hold the member
+            # NotImplementedError when a record written by the tail asks for a feature zipfile lacks (e.g. flag bit 6)
+            if type(e) == BadZipFile or type(e) == BadRarFile or '[Errno 22]' in str(e):
+                # When the password is wrong for a RAR file the returned error is failed to read instead of Bad password
+                if type(e) == BadRarFile and 'Failed the read' in str(e):
+                    print("The password provided is incorrect! Try sending a valid password")
+                    return -1  # Returns -1 when the password is wrong
+            elif 'Bad password' in str(e):
+                # Once the password opened an encryption header of the prefix, a wrong check byte means that
+                # the candidate is wrong, not the password
+                if not self.password_checked:
+                    print("The password provided is incorrect! Try sending a valid password")
+                    return -1  # Returns -1 when the password is wrong
+            elif not isinstance(e, (ZlibError, EOFError, ValueError, OSError, KeyError, NotImplementedError)):
+                print(e)
+                traceback.print_exc()
+                exit()
+            self.stage_rejects[stage] += 1
+            return False
+        finally:
+            self.stage_seconds[stage] += perf_counter() - start_time
@@ -0,0 +1,440 @@
+import argparse
+import json
+import os
+import re
+import sys
+import time
+import zipfile
+from multiprocessing import Process, Lock, Queue, Event
+from queue import Empty
+from types import SimpleNamespace
+
+from archive_verifier import ArchiveVerifier, STAGES
+from candidate_sources import select_candidate_source, RawCandidateSource
+from checkpoint_journal import CheckpointJournal
+from consumer_producer_model import CANCEL_CHECK_INTERVAL, stop_consumers
+from crc_screening import create_crc_screen
+from file_processing import get_file_extension, map_archive_prefix
+from FindMissingBytes import (plan_keyspace, solve_zip_tail, check_archive_password, EXIT_FOUND, EXIT_NOT_FOUND,
+                              EXIT_WRONG_PASSWORD, EXIT_TIME_BUDGET, SHUTDOWN_TIMEOUT, stdout_to_stderr)
+from input_parser import accepted_extensions
+from metrics import WorkerMetrics, MetricsReporter
+from shared_state import SearchState, SEARCH_FOUND, SEARCH_WRONG_PASSWORD
+from work_scheduler import WorkScheduler
+
+# The hash method of a manifest line is inferred from the length of its hexadecimal digest
+HASH_METHODS_BY_LENGTH = {32: 'md5', 40: 'sha1', 56: 'sha224', 64: 'sha256', 96: 'sha384', 128: 'sha512'}
+# <hash>  <archive>:<member>, like the lines of sha256sum (a * before the path marks binary mode)
+MANIFEST_LINE = re.compile(r'^([0-9a-fA-F]+)\s+\*?(.+?(?:' + '|'.join(re.escape(extension) for extension in
+                                                                     accepted_extensions) + r')):(.+)$',
+                           re.IGNORECASE)
+
+
+class BatchJob:
+    """A truncated archive and the members (with their expected hashes) that have to be recovered from it"""
+
+    def __init__(self, archive_name, hash_method):
+        self.archive_name = archive_name
+        self.archive_function = accepted_extensions[get_file_extension(archive_name).lower()]
+        self.hash_method = hash_method
+        self.file_names = []
+        self.file_hashes = []
+
+
+def parse_manifest(path, hash_method=None):
+    """Reads a manifest with one `<hash>  <archive>:<member>` line per member to be recovered.
+    The members of an archive are grouped in one job, so every candidate tail is verified against all of them
+    at once. The archive paths are relative to the directory of the manifest.
+
+    :param path: The name of the manifest
+    :param hash_method: The hash method of every line (default None: inferred from the length of the digest)
+    :return: A list of BatchJob objects
+    :raise ValueError: If a line can not be parsed
+    """
+    jobs = {}
+    directory = os.path.dirname(os.path.abspath(path))
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            match = MANIFEST_LINE.match(line)
+            if match is None:
+                raise ValueError(f"{path}:{line_number}: expected '<hash>  <archive>:<member>'")
+            file_hash, archive_name, file_name = match.groups()
+            line_hash_method = hash_method or HASH_METHODS_BY_LENGTH.get(len(file_hash))
+            if line_hash_method is None:
+                raise ValueError(f"{path}:{line_number}: no hash method has {len(file_hash)} hexadecimal digits")
+            archive_name = os.path.join(directory, archive_name)
+            key = (archive_name, line_hash_method)
+            if key not in jobs:
+                jobs[key] = BatchJob(archive_name, line_hash_method)
+            jobs[key].file_names.append(file_name)
+            jobs[key].file_hashes.append(file_hash.lower())
+    return list(jobs.values())
+
+
+def batch_consumer(scheduler, worker_id, lock, result_queue, jobs, sources, source_jobs, states, cancel,
+                   password=None, metrics=None):
+    """Tests the chunks of every job handed out by the scheduler. The verifier of a job is created the first
+    time one of its chunks is handed out and is kept for the rest of the search.
+    A tail found is reported in the SearchState of its job, which keeps the tail that comes first in the order of
+    the job's search, and the chunks of the job that come after it are dropped from the scheduler. The chunks of
+    the job that come before it are still searched, like in the search of a single archive. A chunk whose job was
+    solved before it (or whose password is wrong) is left unfinished.
+    Every chunk searched completely and every result is put in the result queue as soon as it is known.
+
+    :param scheduler: The WorkScheduler that hands out the chunks of all the jobs
+    :param worker_id: The number of the consumer, used to find its metrics slot
+    :param lock: A protection mechanism between consumers and mainprocess shared resources
+    :param result_queue: The queue of the messages sent to the main process
+    :param jobs: The list of BatchJob objects
+    :param sources: The candidate sources of all the jobs, indexed by the source index of the chunks
+    :param source_jobs: The index of the job of every source
+    :param states: The SearchState of every job
+    :param cancel: The Event set by the main process when the time budget runs out, or when the jobs are solved
+        and the chunks that come before their tails were not searched in time. It is checked between chunks and
+        every CANCEL_CHECK_INTERVAL candidates, like the SearchState of the job of the chunk
+    :param password: String representation of the password of the archives (default None)
+    :param metrics: The WorkerMetrics where the consumer publishes its counters after every chunk (default None)
+    """
+    with lock:
+        print(f'Starting batch consumer with PID {os.getpid()}...')
+    verifiers = {}
+    screens = {}
+    totals = SimpleNamespace(stage_rejects=dict.fromkeys(STAGES, 0), stage_seconds=dict.fromkeys(STAGES, 0.0))
+    chunks = 0
+    hits = 0
+    metrics_base = metrics.worker_values(worker_id) if metrics is not None else None
+
+    while not cancel.is_set():
+        chunk = scheduler.next_chunk()
+        if chunk is None:
+            break
+        source_index, length, start, stop = chunk
+        source = sources[source_index]
+        job_index = source_jobs[source_index]
+        state = states[job_index]
+        if job_index not in verifiers:
+            job = jobs[job_index]
+            verifiers[job_index] = ArchiveVerifier(map_archive_prefix(job.archive_name, 0), job.file_names,
+                                                   job.file_hashes, job.hash_method, job.archive_function,
+                                                   password is not None, password)
+            screens[job_index] = create_crc_screen(verifiers[job_index].prefix, job.file_names,
+                                                   job.archive_function)
+        verifier = verifiers[job_index]
+        screen = screens[job_index]
+        if screen is None:
+            candidates = source.candidates(length, start, stop)
+        else:
+            candidates = screen.candidates(verifier, source, length, start, stop)
+        for count, r_value in enumerate(candidates, 1):
+            if count % CANCEL_CHECK_INTERVAL == 1 and (cancel.is_set() or state.status == SEARCH_WRONG_PASSWORD or
+                                                       state.found_before(source_index, length, start)):
+                break
+            response = verifier.check(r_value)
+            if response:
+                if response == 1:
+                    hits += 1
+                    if state.report(worker_id, SEARCH_FOUND, source_index, length, start, r_value):
+                        scheduler.truncate(source_index, length, start,
+                                           {i for i, job in enumerate(source_jobs) if job == job_index})
+                    result_queue.put(('found', job_index, source.name, r_value))
+                else:
+                    state.report(worker_id, SEARCH_WRONG_PASSWORD, source_index, length, start)
+                    result_queue.put(('wrong password', job_index, source.name, None))
+                break
+        else:
+            result_queue.put(('searched', job_index, source.name, (length, start, stop)))
+        chunks += 1
+        if metrics is not None:
+            for stage in STAGES:
+                totals.stage_rejects[stage] = sum(v.stage_rejects[stage] for v in verifiers.values())
+                totals.stage_seconds[stage] = sum(v.stage_seconds[stage] for v in verifiers.values())
+            metrics.publish(worker_id, metrics_base, chunks, hits, totals)
+
+    stage_rejects = {stage: sum(v.stage_rejects[stage] for v in verifiers.values()) for stage in STAGES}
+    result_queue.put(('done', worker_id, hits, stage_rejects))
+
+
+def search_batch(jobs, numbers_of_consumers, password=None, max_missing_bytes=None, time_budget=None, resume=False,
+                 use_solver=True, use_format_source=True, interleave=1, status_interval=5.0, metrics_path=None,
+                 metrics_port=None):
+    """Searches the missing tails of several archives with one pool of consumers.
+    The keyspaces of the jobs are merged so the jobs advance by the same number of candidates: the cheap
+    jobs are solved first and stop taking workers, and every job is still searched in its own priority order.
+
+    :param jobs: A list of BatchJob objects
+    :param numbers_of_consumers: The number of consumer processes
+    :param password: String representation of the password of the archives (default None)
+    :param max_missing_bytes: The maximum length of the byte strings that are tried (default None: no limit)
+    :param time_budget: The maximum number of seconds spent searching (default None: no limit)
+    :param resume: If True the searched ranges are recorded in the journal of every archive (<archive>.journal)
+        and the candidates recorded by a previous run are skipped. The journal of a solved archive is deleted
+        (default False)
+    :param use_solver: If False the ZIP tail solver is skipped (default True)
+    :param use_format_source: If False the raw byte strings are enumerated right away (default True)
+    :param interleave: The number of segments of the merged keyspace searched in turn (default 1)
+    :param status_interval: The number of seconds between two status lines, 0 to print none (default 5)
+    :param metrics_path: A JSON file rewritten with the metrics of the search (default None)
+    :param metrics_port: The port of a local HTTP endpoint that serves the metrics (default None)
+    :return: A dictionary with the result of every job and the statistics of the search
+    """
+    start_time = time.monotonic()
+    deadline = None if time_budget is None else start_time + time_budget
+    results = [{'archive': job.archive_name, 'file_names': job.file_names, 'hash_method': job.hash_method,
+                'status': 'not found', 'tail': None, 'source': None, 'elapsed_seconds': None} for job in jobs]
+
+    def solved(job_index, tail, source_name, status='found'):
+        results[job_index].update(status=status, tail=tail, source=source_name,
+                                  elapsed_seconds=time.monotonic() - start_time)
+        print(f"{jobs[job_index].archive_name}: {status}" + (f" with the tail {tail}" if tail is not None else ""))
+
+    sources = []
+    source_jobs = []
+    journals = []
+    plans = []
+    for job_index, job in enumerate(jobs):
+        prefix = map_archive_prefix(job.archive_name, 0)
+        # The journals are only written next to the archives when the search is resumable
+        journal = CheckpointJournal(f"{job.archive_name}.journal" if resume else None,
+                                    {'archive': job.archive_name, 'bytes_missing': 0, 'file_name': job.file_names,
+                                     'hash_method': job.hash_method, 'file_hash': job.file_hashes})
+        if resume and journal.load():
+            print(f"Resuming the search of {job.archive_name} recorded in {journal.path}")
+        journals.append(journal)
+        # A wrong password is found out once, before the consumers are started
+        if password is not None and job.archive_function == zipfile.ZipFile and \
+                not check_archive_password(prefix, job.file_names, password):
+            solved(job_index, None, None, 'wrong password')
+            plans.append([])
+            continue
+        if use_solver and job.archive_function == zipfile.ZipFile:
+            solved_tail = solve_zip_tail(prefix, job.file_names, job.file_hashes, job.hash_method,
+                                         job.archive_function, password is not None, password)
+            if solved_tail is not None:
+                solved(job_index, solved_tail, 'zip solver')
+                plans.append([])
+                continue
+        source = select_candidate_source(job.archive_name, prefix) if use_format_source else RawCandidateSource()
+        job_sources = [source] if source.name == RawCandidateSource.name else [source, RawCandidateSource()]
+        segments = plan_keyspace(job_sources, max_missing_bytes, journal)
+        plans.append([(len(sources) + source_index, length, start, stop)
+                      for source_index, length, start, stop in segments])
+        sources += job_sources
+        source_jobs += [job_index] * len(job_sources)
+
+    # The segments of all the jobs ordered by the number of candidates their job searched before them
+    ordered = []
+    for job_index, plan in enumerate(plans):
+        searched = 0
+        for position, segment in enumerate(plan):
+            ordered.append(((searched, job_index, position), segment))
+            searched += segment[3] - segment[2]
+    segments = [segment for _, segment in sorted(ordered)]
+
+    stage_rejects = dict.fromkeys(STAGES, 0)
+    hits = 0
+    shutdown_seconds = None
+    if segments:
+        time_budget_exhausted = False
+        cancel = Event()
+        lock = Lock()
+        result_queue = Queue()
+        scheduler = WorkScheduler(segments, numbers_of_consumers, interleave)
+        # The result slot of every job holds the longest tail of its keyspace
+        states = [SearchState(numbers_of_consumers, max((length for _, length, _, _ in plan), default=1))
+                  for plan in plans]
+        metrics = WorkerMetrics(numbers_of_consumers)
+        reporter = MetricsReporter(metrics, status_interval, metrics_path, metrics_port)
+        reporter.start()
+        consumers = [Process(target=batch_consumer, args=(scheduler, i, lock, result_queue, jobs, sources,
+                                                          source_jobs, states, cancel, password, metrics))
+                     for i in range(numbers_of_consumers)]
+        for c in consumers:
+            c.start()
+        searched_front = None
+        # The consumers that sent their counters, and the ones that exited without sending them (e.g. they crashed)
+        finished_consumers = set()
+        failed_consumers = set()
+        cancel_time = None
+        # The time every job got a result: the chunks that come before the tails are searched for at most
+        # SHUTDOWN_TIMEOUT seconds more
+        solved_time = None
+
+        def receive(timeout):
+            nonlocal hits
+            try:
+                message = result_queue.get(timeout=timeout)
+            except Empty:
+                return
+            kind, index = message[:2]
+            if kind == 'searched':
+                journals[index].add(message[2], *message[3])
+                journals[index].save()
+            elif kind == 'found':
+                # The first tail found is reported right away. The SearchState of the job keeps the one that comes
+                # first in its order, which replaces it at the end of the search
+                if results[index]['status'] == 'not found':
+                    solved(index, message[3], message[2])
+            elif kind == 'wrong password':
+                if results[index]['status'] == 'not found':
+                    solved(index, None, None, kind)
+                    scheduler.cancel({i for i, job_index in enumerate(source_jobs) if job_index == index})
+            else:
+                finished_consumers.add(index)
+                hits += message[2]
+                for stage, rejects in message[3].items():
+                    stage_rejects[stage] += rejects
+
+        def reap():
+            for i, c in enumerate(consumers):
+                if i in finished_consumers or i in failed_consumers or c.is_alive():
+                    continue
+                c.join()
+                # The counters of a consumer that exited normally may still be in the queue
+                while i not in finished_consumers and not result_queue.empty():
+                    receive(timeout=0)
+                if i not in finished_consumers:
+                    print(f"Consumer {c} exited without sending its counters. The chunk it was searching is not "
+                          f"recorded")
+                    failed_consumers.add(i)
+
+        try:
+            while len(finished_consumers) + len(failed_consumers) < len(consumers):
+                if cancel_time is None:
+                    front = scheduler.front()
+                    if front is not None and front[:2] != searched_front:
+                        searched_front = front[:2]
+                        source_index, length, left = front
+                        reporter.start_round(f"{os.path.basename(jobs[source_jobs[source_index]].archive_name)}:"
+                                             f"{sources[source_index].name}", length, left)
+                    if solved_time is None and all(result['status'] != 'not found' for result in results):
+                        solved_time = time.monotonic()
+                    if solved_time is not None:
+                        # The consumers stop by themselves once the chunks that come before the tails are searched
+                        if scheduler.front() is not None and time.monotonic() > solved_time + SHUTDOWN_TIMEOUT:
+                            print("The candidates that come before the tails were not all searched in time. "
+                                  "Shorter tails may rebuild the archives")
+                            cancel.set()
+                            cancel_time = time.monotonic()
+                    elif deadline is not None and time.monotonic() > deadline:
+                        print("The time budget ran out. Stopping the consumers")
+                        time_budget_exhausted = True
+                        cancel.set()
+                        cancel_time = time.monotonic()
+                elif time.monotonic() > cancel_time + SHUTDOWN_TIMEOUT:
+                    break
+                receive(timeout=1 if cancel_time is None else 0.1)
+                reap()
+            stop_start = time.monotonic() if cancel_time is None else cancel_time
+            stop_consumers(consumers, stop_start + SHUTDOWN_TIMEOUT, lambda: receive(timeout=0.01))
+            while not result_queue.empty():
+                receive(timeout=0)
+            if solved_time is not None:
+                shutdown_seconds = time.monotonic() - solved_time
+                print(f"The consumers stopped {shutdown_seconds:.3f} seconds after every archive got a result")
+            elif cancel_time is not None:
+                shutdown_seconds = time.monotonic() - cancel_time
+                print(f"The consumers stopped {shutdown_seconds:.3f} seconds after the search was cancelled")
+            for job_index, state in enumerate(states):
+                result = state.result()
+                if result is not None and results[job_index]['status'] == 'found':
+                    tail, source_index, _ = result
+                    if tail != results[job_index]['tail']:
+                        print(f"{jobs[job_index].archive_name}: the tail {tail} comes first in the order of the "
+                              f"search and replaces {results[job_index]['tail']}")
+                    results[job_index].update(tail=tail, source=sources[source_index].name)
+        finally:
+            reporter.stop()
+            for state in states:
+                state.close()
+        for journal in journals:
+            journal.save(force=True)
+        if time_budget_exhausted:
+            for result in results:
+                if result['status'] == 'not found':
+                    result['status'] = 'time budget exhausted'
+
+    for journal, result in zip(journals, results):
+        if result['status'] == 'found':
+            journal.remove()
+    elapsed = time.monotonic() - start_time
+    candidates_tested = sum(stage_rejects.values()) + hits
+    return {'jobs': results, 'candidates_tested': candidates_tested, 'elapsed_seconds': elapsed,
+            'candidates_per_second': candidates_tested / elapsed if elapsed > 0 else 0.0,
+            'stage_rejects': stage_rejects, 'shutdown_seconds': shutdown_seconds}
+
+
+def batch_exit_code(result):
+    """Returns EXIT_FOUND when every job was solved, otherwise the exit code of the worst job status"""
+    statuses = {job['status'] for job in result['jobs']}
+    if 'time budget exhausted' in statuses:
+        return EXIT_TIME_BUDGET
+    if 'wrong password' in statuses:
+        return EXIT_WRONG_PASSWORD
+    if 'not found' in statuses:
+        return EXIT_NOT_FOUND
+    return EXIT_FOUND
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Recovers the members listed in a manifest of '<hash>  <archive>:<member>' lines (like the "
+                    "output of sha256sum) from truncated archives, with one pool of workers for all of them",
+        epilog=f"Exit codes: {EXIT_FOUND} all found, {EXIT_NOT_FOUND} not found, {EXIT_WRONG_PASSWORD} wrong "
+               f"password, {EXIT_TIME_BUDGET} time budget exhausted")
+    parser.add_argument('manifest', help="The path of the manifest")
+    parser.add_argument('--hash-method', default=None,
+                        help="Any hashlib method (default: inferred from the length of every digest)")
+    parser.add_argument('--password', default=None, help="The password of the archives")
+    parser.add_argument('--max-missing-bytes', type=int, default=None,
+                        help="The maximum number of missing bytes searched (default: no limit)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="The number of consumer processes (default: one per CPU)")
+    parser.add_argument('--time-budget', type=float, default=None,
+                        help="Stop the search after this many seconds (default: no limit)")
+    parser.add_argument('--interleave', type=int, default=1,
+                        help="Search the chunks of this many segments in turn (default 1)")
+    parser.add_argument('--no-solver', action='store_true', help="Skip the ZIP tail solver")
+    parser.add_argument('--raw', action='store_true',
+                        help="Skip the format-aware candidate sources and enumerate the raw byte strings")
+    parser.add_argument('--status-interval', type=float, default=5.0,
+                        help="Seconds between two status lines, 0 to print none (default 5)")
+    parser.add_argument('--metrics-file', default=None,
+                        help="Rewrite this JSON file with the metrics of the search at every status interval")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="Serve the metrics of the search as JSON on http://127.0.0.1:<port>/")
+    parser.add_argument('--resume', action='store_true',
+                        help="Record the searched ranges in the checkpoint journal of every archive "
+                             "(<archive>.journal) and skip the candidates recorded there by a previous run")
+    parser.add_argument('--output', default=None, help="Write the JSON result to this file instead of stdout")
+    arguments = parser.parse_args()
+
+    try:
+        jobs = parse_manifest(arguments.manifest, arguments.hash_method)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    if not jobs:
+        parser.error(f"{arguments.manifest} lists no member")
+    # Only the JSON result is written to stdout, so it can be piped. The progress goes to stderr
+    with stdout_to_stderr():
+        result = search_batch(jobs, arguments.workers, arguments.password, arguments.max_missing_bytes,
+                              arguments.time_budget, arguments.resume, not arguments.no_solver, not arguments.raw,
+                              arguments.interleave, arguments.status_interval, arguments.metrics_file,
+                              arguments.metrics_port)
+    for job in result['jobs']:
+        job['tail'] = None if job['tail'] is None else job['tail'].hex()
+        if job['elapsed_seconds'] is not None:
+            job['elapsed_seconds'] = round(job['elapsed_seconds'], 6)
+    result['elapsed_seconds'] = round(result['elapsed_seconds'], 6)
+    result['candidates_per_second'] = round(result['candidates_per_second'], 2)
+    if result['shutdown_seconds'] is not None:
+        result['shutdown_seconds'] = round(result['shutdown_seconds'], 6)
+    output = json.dumps(result)
+    if arguments.output is None:
+        print(output)
+    else:
+        with open(arguments.output, 'w') as f:
+            f.write(output + '\n')
+    sys.exit(batch_exit_code(result))
@@ -0,0 +1,246 @@
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import zipfile
+
+from file_processing import compute_hash_unopened_file, trim_archive
+from zipcrypto import encrypt_archive
+
+BENCHMARK_PASSWORD = 'benchmark'
+LOREM_IPSUM = (b"Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut "
+               b"labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco. ")
+WRITE_SIZE = 1 << 20
+# The throughput is measured over every tail of up to this many bytes
+MAX_MISSING_BYTES = 4
+SIZE_SUFFIXES = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+# The archives are written without ZIP64 (the tail solver and encrypt_archive don't handle it) and zipfile needs ZIP64
+# for the members that could grow over its limit once compressed (it keeps a 5% margin): about 1.9G
+MAX_MEMBER_SIZE = int(zipfile.ZIP64_LIMIT / 1.05)
+
+compression_methods = {'stored': zipfile.ZIP_STORED, 'deflate': zipfile.ZIP_DEFLATED, 'bzip2': zipfile.ZIP_BZIP2,
+                       'lzma': zipfile.ZIP_LZMA}
+
+
+def parse_size(size):
+    """Converts a size like 64K, 512M or 2G to a number of bytes"""
+    size = size.strip().upper()
+    if size[-1:] in SIZE_SUFFIXES:
+        return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+    return int(size)
+
+
+def write_member(path, size, seed=0):
+    """Writes a file of the given size mixing text (compressible) and random bytes, in chunks so members of
+    several GB can be generated
+
+    :param path: The name of the file
+    :param size: The size of the file in bytes
+    :param seed: The seed of the random bytes (default 0)
+    """
+    rng = random.Random(seed)
+    text = LOREM_IPSUM * (WRITE_SIZE // len(LOREM_IPSUM) // 2)
+    with open(path, 'wb') as f:
+        written = 0
+        while written < size:
+            chunk = (text + rng.randbytes(WRITE_SIZE - len(text)))[:size - written]
+            f.write(chunk)
+            written += len(chunk)
+
+
+def build_corpus(directory, member_sizes, compressions, with_comments=True, with_encryption=True):
+    """Generates the archives of the benchmark
+
+    :param directory: The directory where the members and the archives are written
+    :param member_sizes: A dictionary {label: size in bytes} of the members
+    :param compressions: The names of the compression methods (keys of compression_methods)
+    :param with_comments: If True every archive also has a variant with an archive comment (default True)
+    :param with_encryption: If True a ZipCrypto variant of the deflate archives is added (default True)
+    :return: A list of dictionaries describing the archives (name, member, hash, password...)
+    :raise ValueError: If a member is bigger than MAX_MEMBER_SIZE
+    """
+    for size_label, size in member_sizes.items():
+        if size > MAX_MEMBER_SIZE:
+            raise ValueError(f"The member {size_label} has {size} bytes, more than the {MAX_MEMBER_SIZE} bytes an "
+                             f"archive without ZIP64 can hold")
+    corpus = []
+    for size_label, size in member_sizes.items():
+        member_name = f"member_{size_label}.bin"
+        member_path = os.path.join(directory, member_name)
+        write_member(member_path, size)
+        member_hash = compute_hash_unopened_file(member_path, 'md5')
+        for compression in compressions:
+            for comment in ([b'', b'benchmark archive comment'] if with_comments else [b'']):
+                case = f"{compression}-{size_label}{'-comment' if comment else ''}"
+                archive = os.path.join(directory, f"{case}.zip")
+                with zipfile.ZipFile(archive, 'w', compression_methods[compression], allowZip64=False) as z:
+                    z.write(member_path, member_name)
+                    z.comment = comment
+                corpus.append({'case': case, 'archive': archive, 'member': member_name, 'hash': member_hash,
+                               'password': None})
+                if with_encryption and compression == 'deflate':
+                    encrypted_archive = os.path.join(directory, f"zipcrypto-{case}.zip")
+                    encrypt_archive(archive, encrypted_archive, BENCHMARK_PASSWORD.encode('utf-8'))
+                    corpus.append({'case': f"zipcrypto-{case}", 'archive': encrypted_archive, 'member': member_name,
+                                   'hash': member_hash, 'password': BENCHMARK_PASSWORD})
+    return corpus
+
+
+def run_search(archive, member, file_hash, password, workers, time_budget, max_missing_bytes, use_solver, raw_search,
+               directory, backend='process'):
+    """Runs the command line search on a truncated archive in a separate process
+
+    :return: The JSON result of the search
+    """
+    output = os.path.join(directory, 'result.json')
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'FindMissingBytes.py'),
+               archive, '--file-name', member, '--hash', file_hash, '--hash-method', 'md5',
+               '--workers', str(workers), '--backend', backend, '--max-missing-bytes', str(max_missing_bytes),
+               '--output', output]
+    if time_budget is not None:
+        command += ['--time-budget', str(time_budget)]
+    if password is not None:
+        command += ['--password', password]
+    if not use_solver:
+        command.append('--no-solver')
+    if raw_search:
+        command.append('--raw')
+    completed = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        with open(output, 'r') as f:
+            result = json.load(f)
+    except (FileNotFoundError, ValueError):
+        result = {'status': 'error', 'stderr': completed.stderr.decode('utf-8', 'replace')[-2000:]}
+    result['exit_code'] = completed.returncode
+    if os.path.exists(output):
+        os.remove(output)
+    return result
+
+
+def measure_throughput(archive, entry, worker_counts, window, use_solver, raw_search, directory,
+                       backends=('process',)):
+    """Measures the steady candidates/sec of every backend and worker count with a hash that matches no candidate,
+    so the workers search for the whole window instead of stopping at the first hit
+
+    :return: A list with the throughput, the peak memory and the scaling efficiency of every backend and worker count
+    """
+    runs = []
+    for backend in backends:
+        backend_runs = []
+        for workers in worker_counts:
+            print(f"{entry['case']}: throughput with {workers} {backend} workers", file=sys.stderr)
+            result = run_search(archive, entry['member'], '0' * len(entry['hash']), entry['password'], workers,
+                                window, MAX_MISSING_BYTES, use_solver, raw_search, directory, backend)
+            backend_runs.append({'backend': backend, 'workers': workers, 'status': result['status'],
+                                 'candidates_tested': result.get('candidates_tested'),
+                                 'elapsed_seconds': result.get('elapsed_seconds'),
+                                 'candidates_per_second': result.get('candidates_per_second'),
+                                 'peak_rss_kib': result.get('peak_rss_kib'), 'stderr': result.get('stderr')})
+        baseline = backend_runs[0]
+        for run in backend_runs:
+            # Throughput per worker relative to the smallest worker count of the backend (1.0 is a perfect scaling)
+            run['scaling_efficiency'] = None
+            if baseline['candidates_per_second'] and run['candidates_per_second'] is not None:
+                run['scaling_efficiency'] = round((run['candidates_per_second'] / run['workers'])
+                                                  / (baseline['candidates_per_second'] / baseline['workers']), 3)
+        runs += backend_runs
+    return runs
+
+
+def run_benchmark(corpus, truncations, worker_counts, time_budget, throughput_window, use_solver, raw_search,
+                  directory, backends=('process',)):
+    """Truncates every archive of the corpus, measures the throughput of every backend and worker count and
+    the time needed to find the tail of every truncation
+
+    :return: A list with one dictionary per archive of the corpus
+    """
+    report = []
+    for entry in corpus:
+        truncated_name = os.path.join(directory, 'truncated_archive')
+        searches = []
+        throughput = []
+        for truncation in truncations:
+            truncated_archive, removed = trim_archive(entry['archive'], truncation, copy=True, c_name=truncated_name,
+                                                      save_bytes=True)
+            if not throughput and throughput_window:
+                throughput = measure_throughput(truncated_archive, entry, worker_counts, throughput_window,
+                                                use_solver, raw_search, directory, backends)
+            runs = []
+            for backend, workers in ((backend, workers) for backend in backends for workers in worker_counts):
+                print(f"{entry['case']}: {truncation} bytes missing, {workers} {backend} workers", file=sys.stderr)
+                result = run_search(truncated_archive, entry['member'], entry['hash'], entry['password'], workers,
+                                    time_budget, truncation, use_solver, raw_search, directory, backend)
+                runs.append({'backend': backend, 'workers': workers, 'status': result['status'],
+                             'exit_code': result['exit_code'],
+                             'source': result.get('source'),
+                             # Another tail can rebuild the member too (e.g. the bytes of an archive comment)
+                             'tail_matches': result.get('tail') == removed.hex(),
+                             'time_to_solution': result.get('elapsed_seconds') if result['status'] == 'found' else None,
+                             'candidates_tested': result.get('candidates_tested'),
+                             'peak_rss_kib': result.get('peak_rss_kib'), 'stderr': result.get('stderr')})
+            searches.append({'bytes_missing': truncation, 'removed': removed.hex(), 'runs': runs})
+            os.remove(truncated_archive)
+        report.append({'case': entry['case'], 'archive_size': os.path.getsize(entry['archive']),
+                       'throughput': throughput, 'searches': searches})
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measures the search on a generated corpus of truncated ZIP archives "
+                                                 "and prints a JSON report")
+    parser.add_argument('--member-sizes', default='small=64K',
+                        help=f"Comma separated label=size members, e.g. small=64K,big=1.9G. A member has at most "
+                             f"{MAX_MEMBER_SIZE} bytes (1.9G): the archives are written without ZIP64 "
+                             f"(default small=64K)")
+    parser.add_argument('--compressions', default=','.join(compression_methods),
+                        help=f"Comma separated compression methods (default {','.join(compression_methods)})")
+    parser.add_argument('--no-comments', action='store_true', help="Skip the archives with a comment")
+    parser.add_argument('--no-encryption', action='store_true', help="Skip the ZipCrypto archives")
+    parser.add_argument('--truncations', default='1,2,3,4',
+                        help="Comma separated numbers of bytes removed from the archives (default 1,2,3,4)")
+    parser.add_argument('--workers', default=','.join(str(n) for n in sorted({1, 2, 4, os.cpu_count()})),
+                        help="Comma separated worker counts (default 1,2,4 and the number of CPUs)")
+    parser.add_argument('--backends', default='process',
+                        help="Comma separated consumer backends of FindMissingBytes.py, e.g. process,thread "
+                             "(default process)")
+    parser.add_argument('--time-budget', type=float, default=60.0,
+                        help="The time budget of every search in seconds (default 60)")
+    parser.add_argument('--throughput-window', type=float, default=10.0,
+                        help="The number of seconds of every throughput measurement, 0 to skip them (default 10)")
+    parser.add_argument('--no-solver', action='store_true',
+                        help="Skip the ZIP tail solver to measure the enumeration")
+    parser.add_argument('--raw', action='store_true',
+                        help="Enumerate the raw byte strings instead of the format-aware candidates")
+    parser.add_argument('--directory', default=None,
+                        help="Where the corpus is generated (default: a temporary directory)")
+    parser.add_argument('--output', default=None, help="Write the JSON report to this file instead of stdout")
+    arguments = parser.parse_args()
+
+    member_sizes = dict((label, parse_size(size)) for label, size in
+                        (item.split('=') for item in arguments.member_sizes.split(',')))
+    too_big = [label for label, size in member_sizes.items() if size > MAX_MEMBER_SIZE]
+    if too_big:
+        parser.error(f"--member-sizes: {', '.join(too_big)} has more than {MAX_MEMBER_SIZE} bytes (1.9G), the "
+                     f"biggest member of an archive without ZIP64")
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        directory = arguments.directory or temporary_directory
+        os.makedirs(directory, exist_ok=True)
+        corpus = build_corpus(directory, member_sizes, arguments.compressions.split(','),
+                              not arguments.no_comments, not arguments.no_encryption)
+        report = run_benchmark(corpus, [int(n) for n in arguments.truncations.split(',')],
+                               [int(n) for n in arguments.workers.split(',')], arguments.time_budget,
+                               arguments.throughput_window, not arguments.no_solver, arguments.raw, directory,
+                               arguments.backends.split(','))
+
+    output = json.dumps({'cpu_count': os.cpu_count(), 'backends': arguments.backends.split(','),
+                         'use_solver': not arguments.no_solver, 'raw': arguments.raw,
+                         'time_budget': arguments.time_budget, 'throughput_window': arguments.throughput_window,
+                         'results': report}, indent=2)
+    if arguments.output is None:
+        print(output)
+    else:
+        with open(arguments.output, 'w') as f:
+            f.write(output + '\n')
@@ -0,0 +1,445 @@
+import bisect
+import struct
+import zlib
+
+from file_processing import get_file_extension
+from zip_tail_solver import build_tail_template, END_OF_CENTRAL_DIRECTORY_SIGNATURE, END_OF_CENTRAL_DIRECTORY_STRUCT
+
+ALL_BYTES = bytes(range(256))
+# Archive comments are almost always text: printable ASCII first, then the rest
+LIKELY_COMMENT_BYTES = bytes(range(0x20, 0x7f)) + bytes(range(0x20)) + bytes(range(0x7f, 0x100))
+
+RAR4_SIGNATURE = b'Rar!\x1a\x07\x00'
+RAR5_SIGNATURE = b'Rar!\x1a\x07\x01\x00'
+
+
+def rar4_end_of_archive_block(flags):
+    """Build a RAR 4.x end of archive block (HEAD_CRC, HEAD_TYPE=0x7b, HEAD_FLAGS, HEAD_SIZE)
+
+    :param flags: The value of HEAD_FLAGS
+    :return: The block as a byte string
+    """
+    header = struct.pack('<BHH', 0x7b, flags, 7)
+    return struct.pack('<H', zlib.crc32(header) & 0xFFFF) + header
+
+
+def rar5_end_of_archive_block(flags):
+    """Build a RAR 5.0 end of archive block (CRC32, header size, header type=5, header flags, end of archive flags)
+
+    :param flags: The value of the header flags
+    :return: The block as a byte string
+    """
+    header = bytes([3, 5, flags, 0])
+    return struct.pack('<I', zlib.crc32(header)) + header
+
+
+class TailPattern:
+    """Candidate tails of a fixed length described by the byte values allowed on every position.
+    The values of a position are ordered by likelihood, so lower indexes hold the more likely tails.
+    """
+
+    # The index of a tail is its number in the mixed radix of the domains (the CRC screen relies on it)
+    mixed_radix = True
+
+    def __init__(self, domains):
+        """
+        :param domains: For every position of the tail, a sequence with the byte values allowed on it
+        """
+        self.domains = [bytes(domain) for domain in domains]
+        self.radices = [len(domain) for domain in self.domains]
+        self.size = 1
+        for radix in self.radices:
+            self.size *= radix
+
+    def __len__(self):
+        return len(self.domains)
+
+    def digits_at(self, index):
+        """Convert an index of the pattern to the position of every byte in its domain
+
+        :param index: A number between 0 and the size of the pattern
+        :return: A list of digits, the first position being the most significant one
+        """
+        digits = [0] * len(self.radices)
+        for position in range(len(self.radices) - 1, -1, -1):
+            index, digits[position] = divmod(index, self.radices[position])
+        return digits
+
+    def tail_at(self, index):
+        """Returns the tail with the given index
+
+        :param index: A number between 0 and the size of the pattern
+        :return: A byte string
+        """
+        return bytes(domain[digit] for domain, digit in zip(self.domains, self.digits_at(index)))
+
+    def tails(self, start, stop):
+        """Yields the tails with indexes from start until stop (stop is not included)
+
+        :param start: The index of the first tail
+        :param stop: The upper limit
+        """
+        digits = self.digits_at(start)
+        tail = bytearray(domain[digit] for domain, digit in zip(self.domains, digits))
+        for _ in range(start, stop):
+            yield bytes(tail)
+            position = len(digits) - 1
+            while position >= 0:
+                digits[position] += 1
+                if digits[position] < self.radices[position]:
+                    tail[position] = self.domains[position][digits[position]]
+                    break
+                digits[position] = 0
+                tail[position] = self.domains[position][0]
+                position -= 1
+
+
+class RankOrderedPattern(TailPattern):
+    """A TailPattern whose tails are ordered best-first: by the sum of the ranks of their bytes (the rank of a
+    value being its position in its domain), then like in a TailPattern. A tail with one unlikely byte comes
+    after every tail with a few slightly less likely ones, so the likely tails of a big pattern are searched
+    first. Every index is still the index of exactly one tail, so the searched ranges are recorded like the
+    ranges of any pattern.
+    """
+
+    mixed_radix = False
+
+    def __init__(self, domains):
+        super().__init__(domains)
+        # _counts[position][total] is the number of ways the ranks of the positions from position on sum to total
+        self._counts = [[1]]
+        for radix in reversed(self.radices):
+            following = self._counts[0]
+            counts = []
+            window = 0
+            for total in range(len(following) + radix - 1):
+                window += following[total] if total < len(following) else 0
+                window -= following[total - radix] if total >= radix else 0
+                counts.append(window)
+            self._counts.insert(0, counts)
+        # _offsets[total] is the index of the first tail whose ranks sum to total
+        self._offsets = [0]
+        for count in self._counts[0]:
+            self._offsets.append(self._offsets[-1] + count)
+
+    def digits_at(self, index):
+        total = bisect.bisect_right(self._offsets, index) - 1
+        index -= self._offsets[total]
+        digits = []
+        for position, radix in enumerate(self.radices):
+            following = self._counts[position + 1]
+            rank = max(0, total - len(following) + 1)
+            while index >= following[total - rank]:
+                index -= following[total - rank]
+                rank += 1
+            digits.append(rank)
+            total -= rank
+        return digits
+
+    def next_digits(self, digits):
+        """Moves the digits to the next tail: the next one whose ranks have the same sum or the first one of the
+        next sum
+
+        :param digits: The digits of a tail, changed in place
+        :return: The first position whose digit changed
+        """
+        following_total = 0
+        for position in range(len(digits) - 1, -1, -1):
+            if following_total and digits[position] + 1 < self.radices[position]:
+                digits[position] += 1
+                self.first_digits(digits, position + 1, following_total - 1)
+                return position
+            following_total += digits[position]
+        self.first_digits(digits, 0, following_total + 1)
+        return 0
+
+    def first_digits(self, digits, start, total):
+        """Sets the digits from start on to the first ones whose ranks sum to total: the highest ranks go last"""
+        for position in range(len(digits) - 1, start - 1, -1):
+            digits[position] = min(total, self.radices[position] - 1)
+            total -= digits[position]
+
+    def tails(self, start, stop):
+        if start >= stop:
+            return
+        digits = self.digits_at(start)
+        tail = bytearray(domain[digit] for domain, digit in zip(self.domains, digits))
+        yield bytes(tail)
+        for _ in range(start + 1, stop):
+            for position in range(self.next_digits(digits), len(digits)):
+                tail[position] = self.domains[position][digits[position]]
+            yield bytes(tail)
+
+
+class TailHints:
+    """What is known about some bytes of the missing tail: the values allowed on them, in order of likelihood when
+    they are listed one by one. A position counts from the start of the tail, or from the end of the archive when
+    it is negative (-1 being the last byte), so a hint on the end of the archive holds for every tail length.
+    """
+
+    def __init__(self, hints=(), known_prefix=b''):
+        """
+        :param hints: A sequence of (position, values, ordered) tuples where values is the byte string of the
+            values allowed on the position and ordered tells if its order is the order of likelihood
+        :param known_prefix: The first bytes of the tail, e.g. recovered from another copy of the archive
+        """
+        self.hints = [(position, bytes([value]), True) for position, value in enumerate(known_prefix)]
+        self.hints += [(position, bytes(values), ordered) for position, values, ordered in hints]
+
+    @staticmethod
+    def parse_hint(text):
+        """Parses a hint written as POSITION=VALUES, where VALUES is a hexadecimal byte (41), a list of bytes in
+        order of likelihood (41,61), an inclusive range (30-39) or a value and a mask (40/f0: the bits of the
+        mask are the ones of the value)
+
+        :param text: The hint
+        :return: A (position, values, ordered) tuple
+        :raise ValueError: If the hint can not be parsed
+        """
+        position, separator, values = text.partition('=')
+        if not separator:
+            raise ValueError(f"{text!r} is not POSITION=VALUES")
+        position = int(position)
+        if '/' in values:
+            value, mask = (int(part, 16) for part in values.split('/'))
+            allowed, ordered = bytes(v for v in ALL_BYTES if v & mask == value & mask), False
+        elif '-' in values:
+            first, last = (int(part, 16) for part in values.split('-'))
+            allowed, ordered = bytes(range(first, last + 1)), False
+        else:
+            allowed, ordered = bytes(int(part, 16) for part in values.split(',')), True
+        if not allowed:
+            raise ValueError(f"{text!r} allows no value")
+        return position, allowed, ordered
+
+    def restrict(self, domains):
+        """Returns the domains of a pattern restricted by the hints. The values listed one by one by a hint come
+        in its order, the others keep the order of the pattern
+
+        :param domains: The domains of every position of a tail
+        :return: The restricted domains, or None if a hint allows no value of a domain or needs a longer tail
+        """
+        domains = list(domains)
+        for position, values, ordered in self.hints:
+            index = position if position >= 0 else len(domains) + position
+            if index >= len(domains):
+                return None
+            if index < 0:
+                # The byte is in the prefix
+                continue
+            if ordered:
+                domains[index] = bytes(value for value in values if value in domains[index])
+            else:
+                domains[index] = bytes(value for value in domains[index] if value in values)
+            if not domains[index]:
+                return None
+        return domains
+
+    @staticmethod
+    def format_values(values, ordered):
+        """Writes the values of a hint back: the listed values, or the ranges of the values (30-39+41-41)"""
+        if ordered:
+            return values.hex(',')
+        ranges = []
+        for value in values:
+            if ranges and ranges[-1][1] == value - 1:
+                ranges[-1][1] = value
+            else:
+                ranges.append([value, value])
+        return '+'.join(f"{first:02x}-{last:02x}" for first, last in ranges)
+
+    def __str__(self):
+        return ' '.join(f"{position}={self.format_values(values, ordered)}" for position, values, ordered in self.hints)
+
+
+class RawCandidateSource:
+    """Every byte string of the requested length, in numeric order"""
+
+    name = 'raw'
+    # The biggest tail length the source can produce (None when there is no limit)
+    max_length = None
+
+    def __init__(self):
+        self._patterns = {}
+
+    def build_patterns(self, length):
+        """Returns the list of TailPattern objects for the given length, the most likely one first
+
+        :param length: The length of the tails
+        """
+        return [TailPattern([ALL_BYTES] * length)]
+
+    def patterns(self, length):
+        if length not in self._patterns:
+            self._patterns[length] = self.build_patterns(length)
+        return self._patterns[length]
+
+    def keyspace_size(self, length):
+        """Returns the number of candidates of the given length
+
+        :param length: The length of the tails
+        """
+        return sum(pattern.size for pattern in self.patterns(length))
+
+    def candidates(self, length, start, stop):
+        """Yields the candidates with indexes from start until stop (stop is not included)
+
+        :param length: The length of the tails
+        :param start: The index of the first candidate
+        :param stop: The upper limit
+        """
+        pattern_start = 0
+        for pattern in self.patterns(length):
+            pattern_stop = pattern_start + pattern.size
+            if start < pattern_stop and stop > pattern_start:
+                yield from pattern.tails(max(start, pattern_start) - pattern_start,
+                                         min(stop, pattern_stop) - pattern_start)
+            pattern_start = pattern_stop
+
+
+class ZipTrailerCandidateSource(RawCandidateSource):
+    """ZIP tails consistent with the structures that survived the truncation.
+    When the surviving local headers and central directory can be parsed, the tail is rebuilt by
+    zip_tail_solver and only the bytes it can not infer are enumerated. Otherwise the tail is
+    constrained to be the end of an End of Central Directory record without comment (signature,
+    zero disk numbers and zero comment length).
+    """
+
+    name = 'zip'
+
+    def __init__(self, prefix):
+        """
+        :param prefix: A bytes-like object with the truncated archive. It is only used while the
+            source is created, so the source can be sent to other processes without it
+        """
+        super().__init__()
+        self.template = build_tail_template(prefix)
+        self.comment_length_known = self.template is not None and \
+            len(build_tail_template(prefix, comment_length=1)) == len(self.template)
+        if self.template is None:
+            self.max_length = None
+        elif self.comment_length_known:
+            self.max_length = len(self.template)
+        else:
+            self.max_length = len(self.template) + 0xFFFF
+
+    def template_pattern(self, tail, comment_length):
+        comment_start = len(tail) - comment_length
+        domains = []
+        for position, value in enumerate(tail):
+            if value is not None:
+                domains.append(bytes([value]))
+            elif position >= comment_start:
+                domains.append(LIKELY_COMMENT_BYTES)
+            else:
+                domains.append(ALL_BYTES)
+        return TailPattern(domains)
+
+    def build_patterns(self, length):
+        if self.template is None:
+            return [self.end_record_pattern(length)]
+        if self.comment_length_known:
+            if length != len(self.template):
+                return []
+            return [self.template_pattern(self.template.tail, self.template.comment_length)]
+        comment_length = length - len(self.template)
+        if comment_length < 0:
+            return []
+        # The template was built without comment: its last two bytes are the comment length field
+        tail = self.template.tail[:-2] + list(struct.pack('<H', comment_length)) + [None] * comment_length
+        return [self.template_pattern(tail, comment_length)]
+
+    @staticmethod
+    def end_record_pattern(length):
+        """The constraints of the last bytes of an End of Central Directory record without comment
+
+        :param length: The length of the tails
+        """
+        end_record_size = END_OF_CENTRAL_DIRECTORY_STRUCT.size
+        # signature, disk numbers and comment length are known, entry counts, size and offset are not
+        record_domains = [bytes([value]) for value in END_OF_CENTRAL_DIRECTORY_SIGNATURE] + \
+                         [b'\x00'] * 4 + [ALL_BYTES] * 12 + [b'\x00'] * 2
+        if length <= end_record_size:
+            return TailPattern(record_domains[end_record_size - length:])
+        return TailPattern([ALL_BYTES] * (length - end_record_size) + record_domains)
+
+
+class RarTrailerCandidateSource(RawCandidateSource):
+    """RAR tails that end with a valid end of archive block.
+    The end of archive block of RAR 4.x and RAR 5.0 archives is constant (its CRC covers only constant fields),
+    so the only bytes that are enumerated are the ones lost before it.
+    """
+
+    name = 'rar'
+
+    def __init__(self, prefix):
+        """
+        :param prefix: A bytes-like object with the truncated archive
+        """
+        super().__init__()
+        head = bytes(prefix[:1 << 20])
+        if RAR5_SIGNATURE in head:
+            # Flag 0x04 (skip if unknown) is set by WinRAR, 0 by other writers
+            self.trailers = [rar5_end_of_archive_block(0x04), rar5_end_of_archive_block(0)]
+        elif RAR4_SIGNATURE in head:
+            # Flag 0x4000 (skip if unknown) is set by WinRAR, 0 by other writers
+            self.trailers = [rar4_end_of_archive_block(0x4000), rar4_end_of_archive_block(0)]
+        else:
+            self.trailers = []
+
+    def build_patterns(self, length):
+        if not self.trailers:
+            return super().build_patterns(length)
+        patterns = []
+        for trailer in self.trailers:
+            if length <= len(trailer):
+                pattern = TailPattern([bytes([value]) for value in trailer[len(trailer) - length:]])
+            else:
+                pattern = TailPattern([ALL_BYTES] * (length - len(trailer)) + [bytes([value]) for value in trailer])
+            # The last bytes of the trailers can be the same
+            if all(pattern.domains != known.domains for known in patterns):
+                patterns.append(pattern)
+        return patterns
+
+
+class HintedCandidateSource(RawCandidateSource):
+    """The candidates of another source that agree with the TailHints, searched best-first.
+    The hints shrink the domains of the patterns of the source and the patterns are RankOrderedPattern objects,
+    so the search starts with the likely tails of the reduced keyspace.
+    """
+
+    def __init__(self, source, hints):
+        """
+        :param source: The candidate source whose candidates are restricted
+        :param hints: The TailHints
+        """
+        super().__init__()
+        self.source = source
+        self.hints = hints
+        self.name = f"{source.name}+hints"
+        self.max_length = source.max_length
+
+    def build_patterns(self, length):
+        patterns = []
+        for pattern in self.source.patterns(length):
+            domains = self.hints.restrict(pattern.domains)
+            if domains is not None:
+                patterns.append(RankOrderedPattern(domains))
+        return patterns
+
+
+# The format-aware candidate source for every accepted archive extension
+candidate_sources = {'.zip': ZipTrailerCandidateSource, '.rar': RarTrailerCandidateSource}
+
+
+def select_candidate_source(archive_name, prefix):
+    """Returns the candidate source that fits the archive
+
+    :param archive_name: The name of the archive
+    :param prefix: A bytes-like object with the truncated archive
+    :return: A candidate source object
+    """
+    source_class = candidate_sources.get(get_file_extension(archive_name))
+    if source_class is None:
+        return RawCandidateSource()
+    return source_class(prefix)
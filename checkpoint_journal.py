@@ -0,0 +1,133 @@
+import json
+import os
+import time
+
+
+class CheckpointJournal:
+    """Records the ranges of candidate indexes that were completely searched, for every candidate source
+    and tail length, so an interrupted search can be resumed.
+    The ranges are kept merged and the journal is written to a temporary file that is fsync'd and then
+    renamed over the previous one, so a crash never leaves a half written journal behind.
+    A journal without a path (or whose file can't be written) only keeps the ranges in memory.
+    """
+
+    def __init__(self, path, search_key, sync_interval=5.0):
+        """
+        :param path: The name of the journal file, or None to keep the ranges in memory only
+        :param search_key: A dictionary that identifies the search (archive, file, hash...). A journal
+            written for another search is ignored
+        :param sync_interval: The minimum number of seconds between two writes of the journal (default 5)
+        """
+        self.path = path
+        self.search_key = search_key
+        self.sync_interval = sync_interval
+        self.completed = {}
+        self._last_sync = 0
+        self._dirty = False
+
+    @staticmethod
+    def section(source_name, length):
+        return f"{source_name}:{length}"
+
+    def load(self):
+        """Loads the ranges recorded by a previous run of the same search
+
+        :return: True if the journal was loaded
+        """
+        if self.path is None:
+            return False
+        try:
+            with open(self.path, 'r') as f:
+                journal = json.load(f)
+        except FileNotFoundError:
+            print(f"There is no journal {self.path} to resume from. Starting a new search")
+            return False
+        except ValueError as e:
+            print(f"The journal {self.path} can not be read ({e}). Starting a new search")
+            return False
+        if journal.get('search') != self.search_key:
+            print(f"The journal {self.path} belongs to another search. Starting a new search")
+            return False
+        self.completed = {section: [tuple(r) for r in ranges] for section, ranges in journal['completed'].items()}
+        return True
+
+    def add(self, source_name, length, start, stop):
+        """Records a range of candidates that was completely searched
+
+        :param source_name: The name of the candidate source
+        :param length: The length of the tails
+        :param start: The index of the first candidate of the range
+        :param stop: The upper limit of the range (not included)
+        """
+        ranges = self.completed.setdefault(self.section(source_name, length), [])
+        ranges.append((start, stop))
+        ranges.sort()
+        merged = [ranges[0]]
+        for range_start, range_stop in ranges[1:]:
+            if range_start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], range_stop))
+            else:
+                merged.append((range_start, range_stop))
+        self.completed[self.section(source_name, length)] = merged
+        self._dirty = True
+
+    def reset(self, source_name, length):
+        """Forgets the ranges recorded for a tail length (e.g. when they were searched with a wrong password)
+
+        :param source_name: The name of the candidate source
+        :param length: The length of the tails
+        """
+        self.completed.pop(self.section(source_name, length), None)
+        self._dirty = True
+
+    def remaining(self, source_name, length, keyspace_size):
+        """Returns the ranges of candidates that were not searched yet
+
+        :param source_name: The name of the candidate source
+        :param length: The length of the tails
+        :param keyspace_size: The number of candidates of the given length
+        :return: A list of (start, stop) tuples
+        """
+        remaining = []
+        position = 0
+        for start, stop in self.completed.get(self.section(source_name, length), []):
+            if start > position:
+                remaining.append((position, min(start, keyspace_size)))
+            position = max(position, stop)
+        if position < keyspace_size:
+            remaining.append((position, keyspace_size))
+        return [(start, stop) for start, stop in remaining if stop > start]
+
+    def save(self, force=False):
+        """Writes the journal if something changed and sync_interval seconds passed since the last write
+
+        :param force: If True the journal is written right away (default False)
+        """
+        if self.path is None or not self._dirty or \
+                (not force and time.monotonic() - self._last_sync < self.sync_interval):
+            return
+        temporary_path = f"{self.path}.tmp"
+        try:
+            with open(temporary_path, 'w') as f:
+                json.dump({'search': self.search_key, 'completed': self.completed}, f, separators=(',', ':'))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary_path, self.path)
+        except OSError as e:
+            # e.g. a read-only directory: the search goes on, it just can't be resumed
+            print(f"The journal {self.path} can not be written ({e}). The searched ranges are not recorded")
+            self.path = None
+            return
+        self._last_sync = time.monotonic()
+        self._dirty = False
+
+    def remove(self):
+        """Deletes the journal file, once the search it records is over"""
+        if self.path is None:
+            return
+        for path in (self.path, f"{self.path}.tmp"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.path = None
@@ -1,133 +1,154 @@
 import os
-from queue import Empty
+import time
 
-from file_processing import check_archive_validity
-from generator import byte_generator
+from archive_verifier import ArchiveVerifier
+from crc_screening import create_crc_screen
+from file_processing import map_archive_prefix
+from shared_state import SEARCH_FOUND, SEARCH_WRONG_PASSWORD, SEARCH_TIME_BUDGET
 
+# The number of candidates tested between two checks of the cancellation event inside a chunk
+CANCEL_CHECK_INTERVAL = 64
 
-def producer(queue, lock, producer_number, elements_per_producer, offset, found):
-    """Inserts byte string values into a process safe queue.
-    The producer won't close until all the elements in the queue are consumed
-    :param queue: The queue where elements will be inserted
-    :param lock: A protection mechanism between producer, consumer and mainprocess shared resources
-    :param producer_number: The number of the producer in the producer list handled by
-    the mainprocess. Used to split the elements between producers.
-    :param elements_per_producer: The number of elements to be inserted
-    :param offset: A number used to compute the first and last element that will be inserted by
-    the current producer
-    :param found: A shared variable  between consumer/producer and mainprocess
-    in order to stop the process when the solution is found
-    """
-    with lock:
-        print(f'Starting producer with PID {os.getpid()}')
-    # Get the limits of the generator
-    producer_start = offset + elements_per_producer * producer_number
-    producer_stop = offset + elements_per_producer * (producer_number + 1)
-    producer_generator = byte_generator(producer_start, producer_stop)
-    print(f"Limits of the producer with PID {os.getpid()}:[{producer_start},{producer_stop}]")
 
-    # Push elements generated to queue
-    for i in range(elements_per_producer):
-        if found.value:
-            break
-        queue.put(next(producer_generator))
-
-    with lock:
-        if found.value == 0:
-            print(f'Closing producer {os.getpid()} after all elements were added to the queue')
-        elif found.value == 1:
-            print(f'Closing producer {os.getpid()} because the solution was found.')
-        else:
-            print(f'Closing producer {os.getpid()} because the password provided was wrong.')
-
-
-def consumer(queue, lock, pipe_conn, corrupted_archive, file_name, file_hash, hash_method, found, archive_function,
-             needs_password=False, password=None):
-    """Reconstructs the corrupted archive by reading byte string elements from a process safe queue.
-    If the archive can be reconstructed it sends the byte string to be used to the main process.
-    If the archive can not be reconstructed it sends the Not found string.
-    The consumer won't close until all the elements in the queue are consumed
-    :param queue:  The queue from where elements will be read
-    :param lock: A protection mechanism between producer, consumer and mainprocess shared resources
-    :param pipe_conn: The communication pipe between consumer and mainprocess
-    :param corrupted_archive: The name of the archive to be reconstructed
+def consumer(scheduler, worker_id, lock, state, progress_queue, archive_name, bytes_missing, sources, file_name,
+             file_hash, hash_method, cancel, archive_function, needs_password=False, password=None, metrics=None,
+             shared_verifier=None, shared_screen=None):
+    """Reconstructs the corrupted archive by testing the candidates of the chunks handed out by the scheduler.
+    The candidates of a chunk are generated locally, so nothing but the chunk limits crosses process boundaries.
+    The consumer lives for the whole search: the chunks of every tail length are tested with the same
+    mapped archive and verifier, so what the verifier cached about the prefix is reused across lengths.
+    If the archive can be reconstructed the byte string to be used is reported in the shared SearchState,
+    together with the candidate source and length it was found with, and so is a wrong password.
+    A tail found does not stop the consumers: the chunks that come before it in the order of the search are
+    still searched, so a longer tail found first can't win over a shorter one.
+    The number of candidates rejected by every verification stage is written in the slot of the consumer
+    after every chunk, and the slot is marked done when the consumer stops.
+    :param scheduler: The WorkScheduler that hands out the chunks of candidate indexes
+    :param worker_id: The number of the consumer, used to find its slots in the state and in the metrics
+    :param lock: A protection mechanism between consumers and mainprocess shared resources
+    :param state: The SearchState shared by the consumers and the main process. Its status tells why the search
+        stopped: the solution is found (1), the password is wrong (-1) or the time budget ran out (2)
+    :param progress_queue: The queue where the consumer puts the (source name, length, start, stop) of every
+        chunk it searched completely, so the main process can record them in the checkpoint journal
+    :param archive_name: The name of the archive to be reconstructed. It is mapped in memory (read-only), without
+        its last bytes_missing bytes, and is never modified
+    :param bytes_missing: The number of bytes that are missing from the end of the archive
+    :param sources: The candidate sources that convert candidate indexes to byte strings, indexed by the
+        source index of the chunks
     :param file_name: The name of the file to be extracted from the archive
     :param file_hash: The hash of the file to be extracted from the archive
     :param hash_method: The method of generating the file_hash (any hashlib method sent as a string e.g. 'md5')
-    :param found: A shared variable  between consumer/producer and mainprocess
-        in order to stop the process when the solution is found or the password is wrong
+    :param cancel: The Event set (with the status of the state) when the password is wrong or the time budget ran
+        out. It is checked between chunks and every CANCEL_CHECK_INTERVAL candidates, so the consumers stop
+        without finishing their chunk. It is also set after a hit, once no chunk that comes before the tail is left
+        to hand out: the consumers then finish the chunk they search and take no new one
     :param archive_function: A function that will be used to open the archive
     :param needs_password: A boolean value telling if a password is needed to open the archive. (default False)
     :param password: String representation of the password (default False)
+    :param metrics: The WorkerMetrics where the consumer publishes its counters after every chunk (default None)
+    :param shared_verifier: When the consumers are threads, the ArchiveVerifier whose prefix and caches they share.
+        The consumer works with its own share() of it instead of mapping the archive (default None)
+    :param shared_screen: The CrcScreen shared by the consumer threads, if any (default None)
 
     """
+    if shared_verifier is None:
+        consumer_name = f'Consumer with PID {os.getpid()}'
+        verifier = ArchiveVerifier(map_archive_prefix(archive_name, bytes_missing), file_name, file_hash,
+                                   hash_method, archive_function, needs_password, password)
+        # When the tail holds the end of a stored member, blocks of candidates are screened by their CRC-32 first
+        screen = create_crc_screen(verifier.prefix, [name for name, _ in verifier.targets], archive_function)
+    else:
+        consumer_name = f'Consumer thread {worker_id} of PID {os.getpid()}'
+        verifier = shared_verifier.share()
+        screen = shared_screen
+    state.start(worker_id)
     with lock:
-        print(f'Starting consumer with PID {os.getpid()}...')
+        print(f'Starting {consumer_name}...')
 
-    # Checks if we found a solution on this thread
-    sent_value = 0
-    # Time waiting for an element in the queue
-    queue_timeout = 5
-    elements_processed = 0
+    result = "Not found"
+    source = length = None
+    chunks = 0
+    hits = 0
+    # The slot of the worker keeps the counters of the consumers that had the same number for shorter tails
+    metrics_base = metrics.worker_values(worker_id) if metrics is not None else None
 
-    while not queue.empty() and found.value == 0:
-        try:
-            r_value = queue.get(timeout=queue_timeout)
-            elements_processed += 1
-            if elements_processed % 1000 == 0:
-                with lock:
-                    print(
-                        f"Consumer with PID {os.getpid()} processed f{elements_processed} elements. Queue remaining "
-                        f"size:{queue.qsize()}")
-            response = check_archive_validity(corrupted_archive, r_value, file_name, file_hash, hash_method,
-                                              archive_function, needs_password, password)
+    while not cancel.is_set() and result != "Wrong password":
+        chunk = scheduler.next_chunk()
+        if chunk is None:
+            break
+        source_index, length, start, stop = chunk
+        source = sources[source_index]
+        if screen is None:
+            candidates = source.candidates(length, start, stop)
+        else:
+            candidates = screen.candidates(verifier, source, length, start, stop)
+        for count, r_value in enumerate(candidates, 1):
+            # The chunk is left unfinished (and is not recorded as searched) when a tail that comes before the chunk
+            # was found, or when the search is cancelled for another reason than a tail: after a hit the cancellation
+            # only stops the consumers from taking new chunks, and the chunks that come before the tail are finished
+            if count % CANCEL_CHECK_INTERVAL == 1 and (state.found_before(source_index, length, start) or
+                                                       cancel.is_set() and state.status != SEARCH_FOUND):
+                break
+            response = verifier.check(r_value)
             if response:
                 if response == 1:
-                    with lock:
-                        print(f"Consumer with PID {os.getpid()} found the file after adding:", r_value)
-                        print(f'{os.getpid()} tries to send correct bytes missing')
-                    pipe_conn.send(r_value)
-                    sent_value = 1
-                    found.value = 1
+                    hits += 1
+                    result = r_value
+                    # The candidates that come before the tail (shorter tails first) are still searched,
+                    # so the tail that is kept is the one the search finds first in its order
+                    if state.report(worker_id, SEARCH_FOUND, source_index, length, start, r_value):
+                        scheduler.truncate(source_index, length, start)
                 else:
-                    with lock:
-                        print(f"Consumer with PID {os.getpid()} found that the password provided is wrong:", r_value)
-                        print(f'{os.getpid()} tries to send Wrong password')
-                    pipe_conn.send("Wrong password")
-                    sent_value = 1
-                    found.value = -1
+                    result = "Wrong password"
+                    state.report(worker_id, SEARCH_WRONG_PASSWORD, source_index, length, start)
+                    cancel.set()
+                break
+        else:
+            progress_queue.put((source.name, length, start, stop))
+        chunks += 1
+        state.publish(worker_id, chunks, hits, verifier.stage_rejects)
+        if metrics is not None:
+            metrics.publish(worker_id, metrics_base, chunks, hits, verifier)
+
+    state.finish(worker_id)
+    with lock:
+        if result == "Wrong password":
+            print(f"{consumer_name} found that the password provided is wrong")
+        elif result != "Not found":
+            print(f"{consumer_name} found the file after adding:", result)
+        elif state.status == SEARCH_FOUND:
+            print(f'{consumer_name} was notified that the value was found.')
+        elif state.status == SEARCH_WRONG_PASSWORD:
+            print(f'{consumer_name} was notified that the archive password was wrong.')
+        elif state.status == SEARCH_TIME_BUDGET:
+            print(f'{consumer_name} was stopped because the time budget ran out.')
+        else:
+            print(f'{consumer_name} stopped without a result: all chunks were handed out')
+
 
-                # We can't close the processes until all elements where consumed from the queue.
-                # Therefore we empty it after finding the correct value
-                while not queue.empty():
-                    queue.get(timeout=1)
+def stop_consumers(consumers, deadline, drain=None):
+    """Waits for the consumers to stop until the deadline, then terminates the processes that are still running.
+    Threads can't be terminated: they stop at their next check of the cancellation event.
 
-        # When we fail to extract an element from the queue
-        except Empty:
-            print(f"Consumer with PID {os.getpid()} found that the Queue was empty")
-            if sent_value == 0:
-                with lock:
-                    print(f'Consumer with PID {os.getpid()} tries to send Not found signal (from exc)')
-                pipe_conn.send("Not found")
-            else:
-                with lock:
-                    print(f'Consumer with PID {os.getpid()} already sent results through pipe ')
-    if found.value:
-        if found.value == 1:
-            with lock:
-                print(f'Consumer with PID {os.getpid()} was notified that the value was found. Flushing the queue... ')
+    :param consumers: The consumer processes or threads
+    :param deadline: The time.monotonic() value when the consumers that are still running are terminated
+    :param drain: A function called while waiting that empties the queues the consumers put elements in, for at
+        most a fraction of a second: a process can't exit before the elements it put are read (default None)
+    :return: The number of consumers that were still running at the deadline
+    """
+    while any(c.is_alive() for c in consumers) and time.monotonic() < deadline:
+        if drain is not None:
+            drain()
+        else:
+            next(c for c in consumers if c.is_alive()).join(min(0.1, max(0.0, deadline - time.monotonic())))
+    late = [c for c in consumers if c.is_alive()]
+    for c in late:
+        if hasattr(c, 'terminate'):
+            print(f"Consumer {c} did not stop in time and is terminated")
+            c.terminate()
         else:
-            with lock:
-                print(
-                    f'Consumer with PID {os.getpid()} was notified that the archive password was wrong. Flushing the queue... ')
-        try:
-            # We can't close the processes until all elements where consumed from the queue.
-            # Therefore we empty it after finding the correct value
-            while not queue.empty():
-                queue.get(timeout=1)
-        except Empty:
-            pass
-    if sent_value == 0:
-        with lock:
-            print(f'Consumer with PID {os.getpid()} tries to send Not found signal (after while)')
-        pipe_conn.send("Not found")
+            print(f"Consumer {c} did not stop in time and is left running")
+    for c in consumers:
+        if not c.is_alive() or hasattr(c, 'terminate'):
+            c.join()
+    return len(late)
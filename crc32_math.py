@@ -0,0 +1,76 @@
+import zlib
+
+# The bit-reversed polynomial of the CRC-32 used by ZIP and RAR
+CRC32_POLYNOMIAL = 0xEDB88320
+
+
+def _build_crc_table():
+    table = []
+    for n in range(256):
+        c = n
+        for _ in range(8):
+            c = (c >> 1) ^ CRC32_POLYNOMIAL if c & 1 else c >> 1
+        table.append(c)
+    return table
+
+
+CRC_TABLE = _build_crc_table()
+
+
+def gf2_matrix_times(matrix, vector):
+    """Multiplies a 32x32 matrix over GF(2) (a list of 32 columns) by a 32 bit vector"""
+    result = 0
+    column = 0
+    while vector:
+        if vector & 1:
+            result ^= matrix[column]
+        vector >>= 1
+        column += 1
+    return result
+
+
+def gf2_matrix_square(matrix):
+    return [gf2_matrix_times(matrix, column) for column in matrix]
+
+
+def zeros_operator(count):
+    """Returns the matrix that advances the CRC-32 register over count zero bytes.
+    It is built by squaring the one byte operator, like crc32_combine of zlib.
+
+    :param count: The number of zero bytes
+    """
+    result = [1 << bit for bit in range(32)]
+    operator = [(1 << bit >> 8) ^ CRC_TABLE[(1 << bit) & 0xFF] for bit in range(32)]
+    while count:
+        if count & 1:
+            result = [gf2_matrix_times(operator, column) for column in result]
+        count >>= 1
+        if count:
+            operator = gf2_matrix_square(operator)
+    return result
+
+
+def byte_contributions(distance):
+    """Returns what every byte value adds (xor) to the CRC-32 of a message when it is written at a position
+    followed by distance bytes. The CRC-32 is linear: crc32(a xor b) = crc32(a) xor crc32(b) xor crc32(zeros)
+    for messages of the same length, so the CRC-32 of a message is the CRC-32 of the message with the byte
+    set to zero xor the contribution of the byte.
+
+    :param distance: The number of bytes of the message after the byte
+    :return: A list with the contribution of the 256 byte values
+    """
+    operator = zeros_operator(distance)
+    return [gf2_matrix_times(operator, CRC_TABLE[value]) for value in range(256)]
+
+
+def crc32_with_zeros(data, positions, crc=0):
+    """Returns the CRC-32 of data where the bytes at the given positions are replaced by zeros
+
+    :param data: A byte string
+    :param positions: The positions that are set to zero
+    :param crc: The CRC-32 of the bytes before data (default 0)
+    """
+    data = bytearray(data)
+    for position in positions:
+        data[position] = 0
+    return zlib.crc32(data, crc)
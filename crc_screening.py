@@ -0,0 +1,158 @@
+from time import perf_counter
+import zipfile
+from zlib import crc32
+
+try:
+    import numpy
+except ImportError:
+    # Optional: without NumPy every candidate goes straight to the verifier
+    numpy = None
+
+from rarfile import RarFile
+
+from crc32_math import byte_contributions, crc32_with_zeros
+from rar_headers import RarLayout
+from zip_tail_solver import parse_truncated_zip, ZIP64_LIMIT
+
+# Bit 0 of the ZIP flags tells that the member is encrypted, bit 11 that its name is encoded with UTF-8
+ENCRYPTED_FLAG = 0x01
+UTF8_NAME_FLAG = 0x800
+# The number of candidates screened at once (a few MiB of NumPy arrays)
+BLOCK_SIZE = 1 << 18
+
+
+class CrcScreen:
+    """Screens blocks of candidate tails against the CRC-32 of a stored member whose data runs into the tail.
+    The CRC-32 is linear, so the CRC-32 of the member rebuilt with a candidate is the CRC-32 of the member
+    with the enumerated bytes set to zero xor a contribution of every enumerated byte, read from a table
+    of 256 values per position. The CRC-32 of a whole block of candidates is computed with a few NumPy
+    operations per position and only the candidates with the expected CRC-32 are handed to the verifier.
+    """
+
+    def __init__(self, prefix, data_start, data_end, crc):
+        """
+        :param prefix: A bytes-like object with the truncated archive
+        :param data_start: The position where the member data starts
+        :param data_end: The position right after the member data (after the end of the prefix)
+        :param crc: The CRC-32 of the member
+        """
+        self.data_start = data_start
+        self.data_end = data_end
+        self.crc = crc
+        # The CRC-32 of the part of the member that lies in the prefix
+        self.prefix_crc = crc32(memoryview(prefix)[data_start:])
+        # The number of member bytes that every candidate has to provide
+        self.tail_data_size = data_end - len(prefix)
+        self._tables = {}
+
+    def _table(self, position, domain):
+        """Returns the contribution of the values of a domain at a position of the tail"""
+        key = (position, domain)
+        if key not in self._tables:
+            contributions = byte_contributions(self.tail_data_size - 1 - position)
+            self._tables[key] = numpy.array([contributions[value] for value in domain], dtype=numpy.uint32)
+        return self._tables[key]
+
+    def screen_pattern(self, pattern, start, stop):
+        """Yields the indexes of the candidates of a TailPattern, from start until stop, that give the
+        member its expected CRC-32
+
+        :param pattern: A TailPattern at least tail_data_size bytes long
+        :param start: The index of the first candidate
+        :param stop: The upper limit
+        """
+        data_domains = pattern.domains[:self.tail_data_size]
+        # The positions whose value is enumerated and their stride in the index of the pattern
+        strides = []
+        stride = pattern.size
+        for position, radix in enumerate(pattern.radices):
+            stride //= radix
+            if position < self.tail_data_size and radix > 1:
+                strides.append((position, stride, radix))
+        base = crc32_with_zeros(bytes(domain[0] for domain in data_domains), [p for p, _, _ in strides],
+                                self.prefix_crc)
+        tables = [(self._table(position, data_domains[position]), stride, radix)
+                  for position, stride, radix in strides]
+        for block_start in range(start, stop, BLOCK_SIZE):
+            indexes = numpy.arange(block_start, min(stop, block_start + BLOCK_SIZE), dtype=numpy.int64)
+            crc = numpy.full(len(indexes), base, dtype=numpy.uint32)
+            for table, stride, radix in tables:
+                crc ^= table[(indexes // stride) % radix]
+            for match in numpy.flatnonzero(crc == self.crc):
+                yield block_start + int(match)
+
+    def candidates(self, verifier, source, length, start, stop):
+        """Yields the candidates of a source, from start until stop, that pass the screening.
+        The rejected ones are counted by the crc stage of the verifier.
+
+        :param verifier: The ArchiveVerifier of the worker
+        :param source: The candidate source
+        :param length: The length of the tails
+        :param start: The index of the first candidate
+        :param stop: The upper limit
+        """
+        if length < self.tail_data_size:
+            # The archive ends inside the member data: the verifier rejects these candidates right away
+            yield from source.candidates(length, start, stop)
+            return
+        pattern_start = 0
+        for pattern in source.patterns(length):
+            pattern_stop = pattern_start + pattern.size
+            if start < pattern_stop and stop > pattern_start:
+                local_start = max(start, pattern_start) - pattern_start
+                local_stop = min(stop, pattern_stop) - pattern_start
+                if not pattern.mixed_radix:
+                    # The digits of a block of indexes can only be computed in the mixed radix order
+                    yield from pattern.tails(local_start, local_stop)
+                    pattern_start = pattern_stop
+                    continue
+                screen_start = perf_counter()
+                matches = list(self.screen_pattern(pattern, local_start, local_stop))
+                verifier.stage_seconds['crc'] += perf_counter() - screen_start
+                verifier.stage_rejects['crc'] += local_stop - local_start - len(matches)
+                for index in matches:
+                    yield pattern.tail_at(index)
+            pattern_start = pattern_stop
+
+
+def stored_member_in_tail(prefix, file_names, archive_function):
+    """Finds the data of a member to be extracted when it is stored, not encrypted and runs into the tail
+
+    :param prefix: A bytes-like object with the truncated archive
+    :param file_names: The names of the files to be extracted from the archive
+    :param archive_function: A function that will be used to open the archive
+    :return: A tuple (data start, data end, CRC-32) or None
+    """
+    if archive_function == zipfile.ZipFile:
+        layout = parse_truncated_zip(prefix)
+        entry = None if layout is None else layout.truncated_entry
+        if entry is None or entry.method != zipfile.ZIP_STORED or entry.flags & ENCRYPTED_FLAG or \
+                entry.descriptor_length or entry.compressed_size != entry.size or \
+                ZIP64_LIMIT in (entry.compressed_size, entry.size):
+            return None
+        encoding = 'utf-8' if entry.flags & UTF8_NAME_FLAG else 'cp437'
+        if all(entry.name != file_name.encode(encoding) for file_name in file_names):
+            return None
+        return entry.data_start, entry.data_end, entry.crc
+    if archive_function == RarFile:
+        try:
+            members = RarLayout(prefix).members
+        except ValueError:
+            return None
+        for member in (members.get(file_name) for file_name in file_names):
+            if member is not None and member.data_end > len(prefix) and member.stored and not member.encrypted \
+                    and not member.split and member.crc is not None:
+                return member.data_start, member.data_end, member.crc
+    return None
+
+
+def create_crc_screen(prefix, file_names, archive_function):
+    """Returns a CrcScreen for the archive or None when the member is not a stored member whose data runs into
+    the tail or NumPy is not installed
+    """
+    if numpy is None:
+        return None
+    member = stored_member_in_tail(prefix, file_names, archive_function)
+    if member is None:
+        return None
+    return CrcScreen(prefix, *member)
@@ -0,0 +1,451 @@
+import argparse
+import os
+import socket
+import threading
+import time
+import zipfile
+from multiprocessing import Process
+from multiprocessing.managers import BaseManager
+
+from archive_verifier import ArchiveVerifier
+from candidate_sources import select_candidate_source, RawCandidateSource
+from file_processing import compute_hash_unopened_file, get_file_extension, map_archive_prefix
+from FindMissingBytes import print_found_file, solve_zip_tail
+from input_parser import accepted_extensions
+
+
+class CoordinatorManager(BaseManager):
+    pass
+
+
+class LeaseCoordinator:
+    """Splits the keyspace of a search into leases (source, length, start, stop) and hands them out to
+    the workers that connect to the coordinator.
+    A worker renews its lease after every batch of candidates and tells how far it got. A lease that is not
+    renewed before its deadline (the worker died or hangs) is handed out again to the next worker that asks for
+    work. A lease that progresses so slowly that it would take slow_factor times longer than at the median rate
+    of the completed leases is taken back from its worker, and the candidates it did not search yet are handed
+    out again.
+    When a worker reports a hit (or a wrong password) the search is stopped and every worker is told so
+    the next time it renews its lease or asks for work. When no worker was seen for lease_timeout seconds the
+    search is given up, since nobody is left to search the leases.
+    The methods are called from the threads of the manager server, so the state is protected by a lock.
+    """
+
+    def __init__(self, job, keyspace, lease_size=65536, lease_timeout=60.0, slow_factor=4.0):
+        """
+        :param job: A dictionary with everything a worker needs to set up its verifier
+        :param keyspace: A list of (source name, length, keyspace size) tuples, in the order they are searched
+        :param lease_size: The maximum number of candidates in a lease (default 65536)
+        :param lease_timeout: The number of seconds a lease is kept without being renewed (default 60)
+        :param slow_factor: How many times longer than at the median rate a lease may take before it is taken
+            back from its worker (default 4)
+        """
+        self.job = job
+        self.keyspace = keyspace
+        self.lease_size = lease_size
+        self.lease_timeout = lease_timeout
+        self.slow_factor = slow_factor
+        self.state = 'running'
+        self.result = None
+        self.winner = None
+        self.candidates_searched = 0
+        self.reassigned_leases = 0
+        self._lock = threading.Lock()
+        self._fresh_leases = self._split_keyspace()
+        self._expired_leases = []
+        self._active_leases = {}
+        # The candidates per second of the last completed leases
+        self._lease_rates = []
+        self._next_lease_id = 0
+        self._keyspace_exhausted = False
+        self._workers = {}
+
+    def _split_keyspace(self):
+        for source_name, length, keyspace_size in self.keyspace:
+            for start in range(0, keyspace_size, self.lease_size):
+                yield source_name, length, start, min(keyspace_size, start + self.lease_size)
+
+    def _expire_leases(self, now):
+        """Moves the leases that passed their deadline to the list of leases to be handed out again
+        (called with the lock taken)"""
+        for lease_id, (lease, worker_name, deadline, _) in list(self._active_leases.items()):
+            if deadline < now:
+                print(f"Lease {lease_id} {lease} of worker {worker_name} expired. It will be handed out again")
+                del self._active_leases[lease_id]
+                self._expired_leases.append(lease)
+                self.reassigned_leases += 1
+
+    def expire_leases(self):
+        """Takes back the leases that passed their deadline and gives the search up when every worker that joined
+        it was silent for lease_timeout seconds. Called regularly by the coordinator, since the leases are otherwise
+        only taken back when a worker asks for one"""
+        with self._lock:
+            now = time.monotonic()
+            if self.state != 'running':
+                return
+            self._expire_leases(now)
+            if self._workers and all(now - seen >= self.lease_timeout for seen in self._workers.values()):
+                print(f"No worker was seen for {self.lease_timeout} seconds. The search is given up")
+                self.state = 'no live worker'
+
+    def _update_state(self):
+        """Ends the search when every lease was handed out and completed (called with the lock taken)"""
+        if (self.state == 'running' and self._keyspace_exhausted and not self._expired_leases
+                and not self._active_leases):
+            self.state = 'not found'
+
+    def get_job(self):
+        return self.job
+
+    def should_stop(self):
+        return self.state != 'running'
+
+    def acquire_lease(self, worker_name):
+        """Hands out the next lease to a worker
+
+        :param worker_name: The name of the worker
+        :return: A tuple (lease id, source name, length, start, stop) or None if there is nothing to hand out
+            right now (the search stopped or all the leases left are held by other workers)
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._workers[worker_name] = now
+            if self.state != 'running':
+                return None
+            self._expire_leases(now)
+            if self._expired_leases:
+                lease = self._expired_leases.pop(0)
+            else:
+                lease = next(self._fresh_leases, None)
+                if lease is None:
+                    self._keyspace_exhausted = True
+                    self._update_state()
+                    return None
+            lease_id = self._next_lease_id
+            self._next_lease_id += 1
+            self._active_leases[lease_id] = (lease, worker_name, now + self.lease_timeout, now)
+            return (lease_id,) + lease
+
+    def _is_slow(self, lease, position, elapsed):
+        """Tells if a lease would take more than slow_factor times longer than at the median rate of the
+        completed leases (called with the lock taken)"""
+        if len(self._lease_rates) < 3:
+            return False
+        _, _, start, stop = lease
+        expected = (stop - start) / sorted(self._lease_rates)[len(self._lease_rates) // 2]
+        # Before the expected duration of the whole lease the progress says too little
+        if elapsed <= expected:
+            return False
+        return (position - start) * self.slow_factor * expected < (stop - start) * elapsed
+
+    def renew_lease(self, worker_name, lease_id, position=None):
+        """Extends the deadline of a lease, unless its worker searches it too slowly: then the candidates
+        from position on are handed out again
+
+        :param worker_name: The name of the worker
+        :param lease_id: The id of the lease
+        :param position: The index of the first candidate of the lease the worker did not search yet
+            (default None: the progress is unknown)
+        :return: False if the worker should give up the lease (it expired, it was taken back or the search stopped)
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._workers[worker_name] = now
+            if self.state != 'running' or lease_id not in self._active_leases:
+                return False
+            lease, _, _, acquired = self._active_leases[lease_id]
+            if position is not None and self._is_slow(lease, position, now - acquired):
+                source_name, length, start, stop = lease
+                print(f"Lease {lease_id} {lease} of worker {worker_name} progresses too slowly. "
+                      f"The candidates from {position} will be handed out again")
+                del self._active_leases[lease_id]
+                self.candidates_searched += position - start
+                self._expired_leases.append((source_name, length, position, stop))
+                self.reassigned_leases += 1
+                return False
+            self._active_leases[lease_id] = (lease, worker_name, now + self.lease_timeout, acquired)
+            return True
+
+    def complete_lease(self, worker_name, lease_id):
+        """Records that every candidate of a lease was searched
+
+        :param worker_name: The name of the worker
+        :param lease_id: The id of the lease
+        """
+        with self._lock:
+            self._workers[worker_name] = time.monotonic()
+            active_lease = self._active_leases.pop(lease_id, None)
+            if active_lease is not None:
+                (_, _, start, stop), _, _, acquired = active_lease
+                self.candidates_searched += stop - start
+                rate = (stop - start) / max(time.monotonic() - acquired, 1e-6)
+                self._lease_rates = self._lease_rates[-63:] + [rate]
+            self._update_state()
+
+    def report_result(self, worker_name, lease_id, tail, response):
+        """Stops the search after a worker found the tail or found that the password is wrong
+
+        :param worker_name: The name of the worker
+        :param lease_id: The id of the lease where the result was found
+        :param tail: The byte string that was tested
+        :param response: 1 if the tail rebuilds the archive, -1 if the password is wrong
+        """
+        with self._lock:
+            self._active_leases.pop(lease_id, None)
+            if self.state != 'running':
+                return
+            self.state = 'found' if response == 1 else 'wrong password'
+            self.result = tail
+            self.winner = worker_name
+            print(f"Worker {worker_name} reported {self.state} in lease {lease_id}:", tail)
+
+    def status(self):
+        with self._lock:
+            now = time.monotonic()
+            return {'state': self.state, 'candidates_searched': self.candidates_searched,
+                    'active_leases': len(self._active_leases), 'reassigned_leases': self.reassigned_leases,
+                    'live_workers': sum(now - seen < self.lease_timeout for seen in self._workers.values())}
+
+
+def parse_address(address, default_port=50000):
+    """Converts a host:port string to a (host, port) tuple"""
+    host, _, port = address.rpartition(':')
+    if not host:
+        return address, default_port
+    return host, int(port)
+
+
+def connect_to_coordinator(address, authkey):
+    """Returns a proxy of the coordinator served at address"""
+    CoordinatorManager.register('coordinator')
+    manager = CoordinatorManager(address=address, authkey=authkey)
+    manager.connect()
+    return manager.coordinator()
+
+
+def worker(address, authkey, archive_name=None, worker_name=None, batch_size=1024, poll_interval=1.0):
+    """Asks the coordinator for leases and tests their candidates until the search stops.
+    The candidates are generated locally from the lease limits, so only the limits and the results
+    travel over the network. The lease is renewed after every batch of candidates, which is also when
+    the worker learns that the search was stopped by another worker.
+
+    :param address: The (host, port) tuple of the coordinator
+    :param authkey: The key shared by the coordinator and the workers
+    :param archive_name: The path of the worker's copy of the archive (default: the path of the coordinator)
+    :param worker_name: The name reported to the coordinator (default: host:pid)
+    :param batch_size: The number of candidates tested between two renewals of the lease (default 1024)
+    :param poll_interval: The number of seconds to wait when there is no lease to take (default 1)
+    """
+    worker_name = worker_name or f"{socket.gethostname()}:{os.getpid()}"
+    try:
+        coordinator = connect_to_coordinator(address, authkey)
+        job = coordinator.get_job()
+    except (OSError, EOFError) as e:
+        print(f"Worker {worker_name} could not reach the coordinator at {address}: {e}")
+        return
+    archive_name = archive_name or job['archive_name']
+    prefix = map_archive_prefix(archive_name, job['bytes_missing'])
+    if len(prefix) != job['prefix_size']:
+        print(f"Worker {worker_name}: {archive_name} is not the archive of the coordinator "
+              f"({len(prefix)} bytes instead of {job['prefix_size']})")
+        return
+    verifier = ArchiveVerifier(prefix, job['file_name'], job['file_hash'], job['hash_method'],
+                               accepted_extensions[job['extension']], job['needs_password'], job['password'])
+    # The sources are rebuilt from the same archive, so they map the lease indexes to the same tails
+    sources = {source.name: source for source in (select_candidate_source(job['archive_name'], prefix),
+                                                  RawCandidateSource())}
+    print(f"Worker {worker_name} joined the search")
+
+    leases_completed = 0
+    try:
+        while not coordinator.should_stop():
+            lease = coordinator.acquire_lease(worker_name)
+            if lease is None:
+                time.sleep(poll_interval)
+                continue
+            lease_id, source_name, length, start, stop = lease
+            source = sources[source_name]
+            for batch_start in range(start, stop, batch_size):
+                batch_stop = min(stop, batch_start + batch_size)
+                response = 0
+                for tail in source.candidates(length, batch_start, batch_stop):
+                    response = verifier.check(tail)
+                    if response:
+                        coordinator.report_result(worker_name, lease_id, tail, response)
+                        break
+                if response or not coordinator.renew_lease(worker_name, lease_id, batch_stop):
+                    break
+            else:
+                coordinator.complete_lease(worker_name, lease_id)
+                leases_completed += 1
+    except (OSError, EOFError):
+        print(f"Worker {worker_name} lost the connection to the coordinator")
+    print(f"Worker {worker_name} stopped after completing {leases_completed} leases. "
+          f"Candidates rejected by every verification stage:", verifier.stage_rejects)
+
+
+def build_keyspace(archive_name, prefix, max_length):
+    """Returns the keyspace searched by the coordinator: the candidates of the format-aware source
+    followed by the raw byte strings, both up to max_length bytes (the order of the interactive search)
+
+    :param archive_name: The name of the archive
+    :param prefix: A bytes-like object with the truncated archive
+    :param max_length: The maximum number of missing bytes
+    :return: A list of (source name, length, keyspace size) tuples
+    """
+    keyspace = []
+    source = select_candidate_source(archive_name, prefix)
+    if source.name != RawCandidateSource.name:
+        last_length = max_length if source.max_length is None else min(max_length, source.max_length)
+        keyspace += [(source.name, length, source.keyspace_size(length)) for length in range(1, last_length + 1)]
+    raw_source = RawCandidateSource()
+    keyspace += [(raw_source.name, length, raw_source.keyspace_size(length)) for length in range(1, max_length + 1)]
+    return [(source_name, length, size) for source_name, length, size in keyspace if size > 0]
+
+
+def coordinate(job, prefix, keyspace, address, authkey, lease_size=65536, lease_timeout=60.0, local_workers=0,
+               status_interval=10.0, slow_factor=4.0):
+    """Serves the leases of the search until a worker reports a result, the whole keyspace is searched or no
+    worker is left
+
+    :param job: A dictionary with everything a worker needs to set up its verifier
+    :param prefix: A bytes-like object with the truncated archive
+    :param keyspace: A list of (source name, length, keyspace size) tuples
+    :param address: The (host, port) tuple the coordinator listens on
+    :param authkey: The key shared by the coordinator and the workers
+    :param lease_size: The maximum number of candidates in a lease (default 65536)
+    :param lease_timeout: The number of seconds a lease is kept without being renewed (default 60)
+    :param local_workers: The number of worker processes started on this host (default 0)
+    :param status_interval: The number of seconds between two status lines (default 10)
+    :param slow_factor: How many times longer than at the median rate a lease may take before it is taken back
+        from its worker (default 4)
+    :return: The LeaseCoordinator at the end of the search
+    """
+    coordinator = LeaseCoordinator(job, keyspace, lease_size, lease_timeout, slow_factor)
+    CoordinatorManager.register('coordinator', callable=lambda: coordinator)
+    server = CoordinatorManager(address=address, authkey=authkey).get_server()
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    print(f"Coordinator listening on {server.address} with {sum(size for _, _, size in keyspace)} candidates "
+          f"in leases of {lease_size}")
+
+    host, port = server.address
+    local_address = ('127.0.0.1' if host in ('', '0.0.0.0') else host, port)
+    workers = [Process(target=worker, args=(local_address, authkey, job['archive_name'], f"local-{i}"))
+               for i in range(local_workers)]
+    for w in workers:
+        w.start()
+
+    start_time = time.monotonic()
+    next_status = start_time + status_interval
+    while not coordinator.should_stop():
+        time.sleep(0.2)
+        coordinator.expire_leases()
+        if time.monotonic() >= next_status:
+            next_status += status_interval
+            print("Coordinator status:", coordinator.status())
+    # Leave the workers one poll interval to learn that the search stopped
+    deadline = time.monotonic() + 2
+    while coordinator.status()['active_leases'] and time.monotonic() < deadline:
+        time.sleep(0.1)
+    for w in workers:
+        w.join(timeout=5)
+    status = coordinator.status()
+    print(f"Search ended after {time.monotonic() - start_time:.2f} seconds:", status)
+    server.stop_event.set()
+    server_thread.join()
+    return coordinator
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Searches the bytes missing from the end of an archive on several "
+                                                 "hosts. Start one coordinator and any number of workers")
+    subparsers = parser.add_subparsers(dest='role', required=True)
+    coordinator_parser = subparsers.add_parser('coordinator', help="Split the search into leases and serve them")
+    coordinator_parser.add_argument('archive', help="The path of the archive")
+    coordinator_parser.add_argument('--file-name', required=True, help="The name of the file inside the archive")
+    hash_group = coordinator_parser.add_mutually_exclusive_group(required=True)
+    hash_group.add_argument('--hash', help="The expected hash of the file")
+    hash_group.add_argument('--original-file', help="Compute the expected hash from this file")
+    coordinator_parser.add_argument('--hash-method', default='md5', help="Any hashlib method (default md5)")
+    coordinator_parser.add_argument('--password', default=None,
+                                    help="The password of the archive. It is sent to the workers in clear text")
+    coordinator_parser.add_argument('--bytes-missing', type=int, default=0,
+                                    help="Remove this many bytes from the end of the archive first (default 0)")
+    coordinator_parser.add_argument('--max-length', type=int, default=4,
+                                    help="The maximum number of missing bytes searched (default 4)")
+    coordinator_parser.add_argument('--listen', default='127.0.0.1:50000',
+                                    help="The host:port the coordinator listens on (default 127.0.0.1:50000). "
+                                         "Listen on another interface, e.g. 0.0.0.0:50000, for remote workers")
+    coordinator_parser.add_argument('--lease-size', type=int, default=65536,
+                                    help="The number of candidates in a lease (default 65536)")
+    coordinator_parser.add_argument('--lease-timeout', type=float, default=60.0,
+                                    help="Seconds before a lease that is not renewed is handed out again (default 60)")
+    coordinator_parser.add_argument('--slow-factor', type=float, default=4.0,
+                                    help="Take a lease back from its worker when it would take this many times longer "
+                                         "than at the median rate of the completed leases (default 4)")
+    coordinator_parser.add_argument('--local-workers', type=int, default=0,
+                                    help="The number of workers started next to the coordinator (default 0)")
+    worker_parser = subparsers.add_parser('worker', help="Search the leases handed out by a coordinator")
+    worker_parser.add_argument('coordinator', help="The host:port of the coordinator")
+    worker_parser.add_argument('--archive', default=None,
+                               help="The path of the local copy of the archive (default: the coordinator's path)")
+    worker_parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                               help="The number of worker processes started on this host (default: one per CPU)")
+    for subparser in (coordinator_parser, worker_parser):
+        subparser.add_argument('--authkey', default=os.environ.get('FIND_MISSING_BYTES_AUTHKEY'),
+                               help="The secret key shared by the coordinator and the workers "
+                                    "(default: $FIND_MISSING_BYTES_AUTHKEY). Required")
+    arguments = parser.parse_args()
+    if not arguments.authkey:
+        # The coordinator unpickles what its clients send: whoever knows the key can run code on it
+        parser.error("a secret --authkey (or $FIND_MISSING_BYTES_AUTHKEY) is required")
+    authkey = arguments.authkey.encode('utf-8')
+
+    if arguments.role == 'worker':
+        address = parse_address(arguments.coordinator)
+        processes = [Process(target=worker, args=(address, authkey, arguments.archive))
+                     for _ in range(arguments.processes)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        exit(0)
+
+    file_extension = get_file_extension(arguments.archive)
+    if file_extension not in accepted_extensions:
+        print("Please send a file with one of the following extensions:", list(accepted_extensions.keys()))
+        exit(1)
+    archive_open_function = accepted_extensions[file_extension]
+    file_hash = arguments.hash or compute_hash_unopened_file(arguments.original_file, arguments.hash_method)
+    prefix = map_archive_prefix(arguments.archive, arguments.bytes_missing)
+    job = {'archive_name': arguments.archive, 'extension': file_extension, 'bytes_missing': arguments.bytes_missing,
+           'prefix_size': len(prefix), 'file_name': arguments.file_name, 'file_hash': file_hash,
+           'hash_method': arguments.hash_method, 'needs_password': arguments.password is not None,
+           'password': arguments.password}
+
+    if archive_open_function == zipfile.ZipFile:
+        solved_tail = solve_zip_tail(prefix, arguments.file_name, file_hash, arguments.hash_method,
+                                     archive_open_function, job['needs_password'], arguments.password)
+        if solved_tail is not None:
+            print("The ZIP tail solver rebuilt the end of the archive")
+            print_found_file(prefix, solved_tail, archive_open_function, arguments.file_name, job['needs_password'],
+                             arguments.password)
+            exit(0)
+
+    coordinator = coordinate(job, prefix, build_keyspace(arguments.archive, prefix, arguments.max_length),
+                             parse_address(arguments.listen), authkey, arguments.lease_size, arguments.lease_timeout,
+                             arguments.local_workers, slow_factor=arguments.slow_factor)
+    if coordinator.state == 'found':
+        print_found_file(prefix, coordinator.result, archive_open_function, arguments.file_name,
+                         job['needs_password'], arguments.password)
+        exit(0)
+    if coordinator.state == 'wrong password':
+        print("The password provided was wrong! Start the coordinator again with the right password")
+        exit(2)
+    if coordinator.state == 'no live worker':
+        print("Every worker stopped before the keyspace was searched. Start the coordinator and the workers again")
+        exit(1)
+    print(f"Failed to unpack with up to {arguments.max_length} missing bytes")
+    exit(1)
@@ -1,10 +1,13 @@
+import errno
 import hashlib
-import shutil
-import traceback
+import mmap
 import os
 from time import sleep
-from zipfile import BadZipFile
-from rarfile import BadRarFile
+
+# The size of the reads made while a file is hashed or copied
+READ_SIZE = 1 << 20
+# The errors of os.copy_file_range that mean the kernel can't copy between these two files
+COPY_FILE_RANGE_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EPERM)
 
 
 def get_file_extension(file):
@@ -68,10 +71,14 @@ def trim_archive(archive, removed_bytes_number, copy=False, c_name='truncated_ar
     try:
         if copy:
             copy_name = f"{c_name}.{archive.split('.')[-1]}"
-            shutil.copyfile(archive, copy_name)  # create a copy of the archive
+            # Only the bytes that are kept are copied
+            size = os.path.getsize(archive)
+            copy_prefix(archive, copy_name, max(0, size - removed_bytes_number))
             if save_bytes:
-                return trim_file(copy_name, removed_bytes_number, save_bytes)
-            return trim_file(copy_name, removed_bytes_number)
+                with open(archive, 'rb') as f:
+                    f.seek(max(0, size - removed_bytes_number))
+                    return copy_name, f.read()
+            return copy_name
         if save_bytes:
             return trim_file(archive, removed_bytes_number, save_bytes=save_bytes)
         return trim_file(archive, removed_bytes_number)
@@ -81,6 +88,55 @@ def trim_archive(archive, removed_bytes_number, copy=False, c_name='truncated_ar
             return -1
 
 
+def copy_prefix(source, destination, length):
+    """Writes the first length bytes of source to destination.
+    os.copy_file_range lets the kernel copy the bytes without passing them through the process (and share the
+    extents instead of copying them on file systems with reflinks, like Btrfs and XFS). The bytes it could not
+    copy are copied with large buffered reads.
+
+    :param source: The name of the file that is copied
+    :param destination: The name of the copy
+    :param length: The number of bytes that are copied
+    :return: The number of bytes copied by the kernel
+    """
+    copied = 0
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while copied < length:
+                    count = os.copy_file_range(src.fileno(), dst.fileno(), length - copied, copied, copied)
+                    if count == 0:
+                        break
+                    copied += count
+            except OSError as e:
+                if e.errno not in COPY_FILE_RANGE_ERRORS:
+                    raise
+        kernel_copied = copied
+        src.seek(copied)
+        dst.seek(copied)
+        while copied < length:
+            chunk = src.read(min(READ_SIZE, length - copied))
+            if not chunk:
+                break
+            dst.write(chunk)
+            copied += len(chunk)
+    return kernel_copied
+
+
+def map_archive_prefix(archive, removed_bytes_number):
+    """Map the archive in memory (read-only) without its last bytes.
+    The pages of the mapping are shared through the page cache by every process that maps the same archive,
+    so the archive is read from disk once no matter how many workers use it. The file on disk is not modified.
+
+    :param archive: The name of the archive
+    :param removed_bytes_number: The number of bytes that are considered missing from the end of the archive
+    :return: A read-only memoryview of the truncated archive
+    """
+    with open(archive, 'rb') as f:
+        archive_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(archive_map)[:len(archive_map) - removed_bytes_number]
+
+
 def compute_hash_unopened_file(file, hash_type):
     """Compute the hash of a file that is not already opened
 
@@ -106,7 +162,7 @@ def compute_hash_opened_file(file, hash_type):
     :return: The hash of the file as a string
     """
     m = hashlib.new(hash_type)
-    while chunk := file.read(1024):
+    while chunk := file.read(READ_SIZE):
         m.update(chunk)
     return m.hexdigest()
 
@@ -139,52 +195,3 @@ def append_bytes_to_file(file, bytes_to_append):
             continue
     print("Failed to open file. Consumer will close...")
     exit(-1)
-
-
-def check_archive_validity(archive, bytes_to_add, file_name, file_hash, hash_method, archive_function,
-                           needs_password=False,
-                           password=None):
-    """Verifies if adding the bytes_to_add byte string to the end of the archive returns
-    a valid archive and if the file given can be extracted from the archive.
-
-    :param archive: The name of the archive which will be modified
-    :param bytes_to_add: The byte string that will be appended to the end of the archive
-    :param file_name: The name of the file to be extracted from the archive
-    :param file_hash: The hash of the initial file
-    :param hash_method: The method of generating the file_hash (any hashlib method sent as a string e.g. 'md5')
-    :return: True if file_name can be extracted from the archive (THE ARCHIVE WON'T BE MODIFIED)
-    :param archive_function: A function that will be used to open the archive
-    :param needs_password: A boolean value telling if a password is needed to open the archive. (default False)
-    :param password: String representation of the password (default False)
-    """
-    added_bytes_length = append_bytes_to_file(archive, bytes_to_add)
-    try:
-        z = archive_function(archive)
-        if needs_password:
-            f = z.open(file_name, pwd=bytes(password, 'utf-8'))
-        else:
-            f = z.open(file_name)
-        computed_hash = compute_hash_opened_file(f, hash_method)
-        if computed_hash == file_hash:
-            return True
-        return False
-    except Exception as e:
-        # BadZipFile when a ZIP archive is corrupted
-        # BadRarFile when a RAR archive is corrupted or the password is incorrect
-        # Errno 22 when the archive is valid but the file inside is corrupted
-        if type(e) == BadZipFile or type(e) == BadRarFile or '[Errno 22]' in str(e):
-            # When the password is wrong for a RAR file the returned error is failed to read instead of Bad password
-            if type(e) == BadRarFile and 'Failed the read' in str(e):
-                print("The password provided is incorrect! Try sending a valid password")
-                return -1  # Returns -1 when the password is wrong
-            pass
-        elif 'Bad password' in str(e):
-            print("The password provided is incorrect! Try sending a valid password")
-            return -1  # Returns -1 when the password is wrong
-        else:
-            print(e)
-            print(archive)
-            traceback.print_exc()
-            exit()
-    finally:
-        trim_archive(archive, added_bytes_length)
@@ -1,33 +1,70 @@
-def initialize_generator_power(start_number):
-    """Set the start upper limit of the generator
+from crc32_math import byte_contributions, crc32_with_zeros
 
-    :param start_number: The start value of the generator
-    :return: The lowest power bigger than the number given
+
+def crc32_solution_space(data, free_positions, crc, expected_crc):
+    """Solves the bytes at free_positions of data so that the CRC-32 of data is expected_crc.
+    CRC-32 is affine over GF(2): every bit of a free byte flips a fixed set of bits of the CRC-32, so the
+    bits of the free bytes are the solution of a system of 32 linear equations, solved by Gaussian elimination.
+    Up to 4 consecutive free bytes have at most one solution (exactly one for 4). Otherwise every solution is
+    the particular one xor a combination of the null space vectors.
+
+    :param data: The byte string (the values at free_positions are ignored)
+    :param free_positions: The positions of the bytes that are solved
+    :param crc: The CRC-32 of the bytes before data
+    :param expected_crc: The CRC-32 expected after data
+    :return: A tuple (particular solution, list of null space vectors) where the bit 8 * i + j of a solution is
+        the bit j of the byte at free_positions[i], or None if no value of the free bytes gives expected_crc
     """
-    power = 1
-    while 256 ** power <= start_number:
-        power += 1
-    return power
+    target = expected_crc ^ crc32_with_zeros(data, free_positions, crc)
+    # pivots[bit] = (a combination of the columns with bit as its highest bit, the columns combined)
+    pivots = {}
+    null_space = []
+    for i, position in enumerate(free_positions):
+        contributions = byte_contributions(len(data) - 1 - position)
+        for bit in range(8):
+            column, combination = contributions[1 << bit], 1 << (8 * i + bit)
+            while column:
+                top = column.bit_length() - 1
+                if top not in pivots:
+                    pivots[top] = (column, combination)
+                    break
+                column ^= pivots[top][0]
+                combination ^= pivots[top][1]
+            else:
+                null_space.append(combination)
+    solution = 0
+    while target:
+        top = target.bit_length() - 1
+        if top not in pivots:
+            return None
+        target ^= pivots[top][0]
+        solution ^= pivots[top][1]
+    return solution, null_space
 
 
-def byte_generator(start, stop):
-    """A generator that yields returns a number converted to a bytestring.
-    It generates all bytes starting from the start value until stop (e.g. between 0 and 256^2
-    It will return all bytes from x\00 to x\ff\xff, by returning first all the 1-byte sequences
-     then all the 2-byte sequence. (Including both x\00 and x\00\x00)
+def crc32_inversion_generator(data, free_positions, crc, expected_crc, max_solutions=1 << 16):
+    """A generator that yields the byte strings made of data with the bytes at free_positions solved so that
+    their CRC-32 is expected_crc, instead of trying the 256^n values of the free bytes.
 
-    :param start: The first value that will be converted to a bytestring
-    :param stop: The upper limit (Will not be returned by the generator)
+    :param data: The byte string (the values at free_positions are ignored)
+    :param free_positions: The positions of the bytes that are solved
+    :param crc: The CRC-32 of the bytes before data
+    :param expected_crc: The CRC-32 expected after data
+    :param max_solutions: The maximum number of solutions that are yielded (default 65536)
+    :raise ValueError: If the free bytes have more than max_solutions solutions
     """
-    number = start
-    power = initialize_generator_power(number)
-    reset_number = False
-    while number < stop:
-        while 256 ** power <= number:
-            power += 1
-            reset_number = True
-        if power != 1 and reset_number:
-            number = 0
-            reset_number = False
-        yield number.to_bytes(power, 'big')
-        number += 1
\ No newline at end of file
+    space = crc32_solution_space(data, free_positions, crc, expected_crc)
+    if space is None:
+        return
+    solution, null_space = space
+    if 1 << len(null_space) > max_solutions:
+        raise ValueError(f"{len(free_positions)} free bytes have {1 << len(null_space)} solutions")
+    result = bytearray(data)
+    for mask in range(1 << len(null_space)):
+        value = solution
+        for i, vector in enumerate(null_space):
+            if mask >> i & 1:
+                value ^= vector
+        for i, position in enumerate(free_positions):
+            result[position] = (value >> (8 * i)) & 0xFF
+        yield bytes(result)
@@ -0,0 +1,73 @@
+import errno
+import io
+
+
+class TailOverlayFile(io.RawIOBase):
+    """A read-only file object that shows a prefix buffer followed by a candidate tail.
+    The prefix is never copied into a new buffer: every read is served from a slice of it,
+    so testing a new candidate only costs building this small object.
+    """
+
+    def __init__(self, prefix, tail=b''):
+        """
+        :param prefix: A bytes-like object with the surviving part of the archive
+        :param tail: The byte string that is virtually appended after the prefix
+        """
+        super().__init__()
+        self._prefix = memoryview(prefix)
+        self._prefix_length = len(self._prefix)
+        self._tail = bytes(tail)
+        self._size = self._prefix_length + len(self._tail)
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        """Move the cursor like a regular file would.
+        A negative final position raises the same error a real file raises ([Errno 22]),
+        because zipfile relies on it to detect archives that are too small.
+        """
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self._size + offset
+        else:
+            raise ValueError(f"Invalid whence value {whence}")
+        if position < 0:
+            raise OSError(errno.EINVAL, 'Invalid argument')
+        self._position = position
+        return position
+
+    def read(self, size=-1):
+        start = self._position
+        if start >= self._size:
+            return b''
+        if size is None or size < 0:
+            end = self._size
+        else:
+            end = min(self._size, start + size)
+        if end <= self._prefix_length:
+            data = self._prefix[start:end].tobytes()
+        elif start >= self._prefix_length:
+            data = self._tail[start - self._prefix_length:end - self._prefix_length]
+        else:
+            data = self._prefix[start:].tobytes() + self._tail[:end - self._prefix_length]
+        self._position = end
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def readall(self):
+        return self.read()
@@ -4,6 +4,8 @@ from rarfile import RarFile
 
 from file_processing import get_file_extension, compute_hash_unopened_file
 
+accepted_extensions = {'.zip': zipfile.ZipFile, '.rar': RarFile}
+
 
 def read_input_from_keyboard():
     # Archive name
@@ -11,7 +13,6 @@ def read_input_from_keyboard():
         archive_name=input("Provide the path to the archive:\n")
         file_extension = get_file_extension(archive_name)
 
-        accepted_extensions = {'.zip': zipfile.ZipFile, '.rar': RarFile}
         if file_extension not in accepted_extensions:
             print("Please send a file with one of the following extensions:", list(accepted_extensions.keys()))
         try:
@@ -65,16 +66,12 @@ def read_input_from_keyboard():
         except Exception as e:
             print(e)
 
-    print("What is the number of producers that you want to use?")
-    numbers_of_producers = read_positive_integer()
-
     print("What is the number of consumers that you want to use?")
     numbers_of_consumers = read_positive_integer()
 
 
     return archive_name,archive_open_function,file_name,needs_password,\
-           password,bytes_missing,hash_method,file_hash,numbers_of_producers,\
-           numbers_of_consumers
+           password,bytes_missing,hash_method,file_hash,numbers_of_consumers
 
 
 def read_positive_integer():
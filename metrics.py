@@ -0,0 +1,171 @@
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Array
+
+from archive_verifier import STAGES
+
+# The counters of a worker, in the order they are stored in its slot of the shared array
+METRIC_FIELDS = (('candidates', 'chunks', 'hits') + tuple(f"{stage}_rejects" for stage in STAGES)
+                 + tuple(f"{stage}_seconds" for stage in STAGES))
+
+
+class WorkerMetrics:
+    """The counters of every worker, kept in an array of doubles shared by the processes.
+    A worker only writes its own slot, once per chunk, and the main process only reads the slots,
+    so no lock is ever taken: a snapshot may mix the counters of two consecutive chunks of a worker,
+    which is good enough for a status line.
+    """
+
+    def __init__(self, number_of_workers):
+        """
+        :param number_of_workers: The number of worker slots
+        """
+        self.number_of_workers = number_of_workers
+        self._values = Array('d', number_of_workers * len(METRIC_FIELDS), lock=False)
+
+    def worker_values(self, worker_id):
+        """Returns the counters of a worker as a list in the order of METRIC_FIELDS"""
+        offset = worker_id * len(METRIC_FIELDS)
+        return self._values[offset:offset + len(METRIC_FIELDS)]
+
+    def publish(self, worker_id, base, chunks, hits, verifier):
+        """Writes the counters of a worker
+
+        :param worker_id: The number of the worker
+        :param base: The counters left in the slot by the previous workers with the same number
+        :param chunks: The number of chunks the worker searched
+        :param hits: The number of candidates that rebuilt the archive
+        :param verifier: The ArchiveVerifier of the worker
+        """
+        rejects = [verifier.stage_rejects[stage] for stage in STAGES]
+        values = [sum(rejects) + hits, chunks, hits] + rejects + [verifier.stage_seconds[stage] for stage in STAGES]
+        offset = worker_id * len(METRIC_FIELDS)
+        self._values[offset:offset + len(METRIC_FIELDS)] = [b + v for b, v in zip(base, values)]
+
+
+class MetricsReporter:
+    """Aggregates the WorkerMetrics in the main process. Every interval seconds it prints a status line
+    with the total rate, the ETA of the current tail length and the imbalance between the workers, and
+    optionally writes the snapshot to a JSON file. The snapshot can also be served on a local HTTP endpoint.
+    """
+
+    def __init__(self, metrics, interval=5.0, snapshot_path=None, http_port=None):
+        """
+        :param metrics: The WorkerMetrics of the workers
+        :param interval: The number of seconds between two status lines, 0 to print none (default 5)
+        :param snapshot_path: The JSON file rewritten with every snapshot (default None)
+        :param http_port: The port of the local HTTP endpoint that serves the snapshot (default None)
+        """
+        self.metrics = metrics
+        self.interval = interval
+        self.snapshot_path = snapshot_path
+        self.http_port = http_port
+        self.start_time = time.monotonic()
+        self._stop = threading.Event()
+        self._thread = None
+        self._server = None
+        self._last = (self.start_time, 0)
+        self._rate = 0.0
+        self._round = {'source': None, 'length': None, 'candidates': 0, 'start_total': 0,
+                       'start_workers': [0] * metrics.number_of_workers}
+
+    def start_round(self, source_name, length, candidates):
+        """Starts measuring the search of a tail length
+
+        :param source_name: The name of the candidate source
+        :param length: The length of the tails
+        :param candidates: The number of candidates left to search for this length
+        """
+        workers = [self.metrics.worker_values(i)[0] for i in range(self.metrics.number_of_workers)]
+        self._round = {'source': source_name, 'length': length, 'candidates': candidates,
+                       'start_total': sum(workers), 'start_workers': workers}
+
+    def snapshot(self):
+        """Returns a dictionary with the aggregated counters of the workers"""
+        now = time.monotonic()
+        workers = [dict(zip(METRIC_FIELDS, self.metrics.worker_values(i)))
+                   for i in range(self.metrics.number_of_workers)]
+        totals = {field: sum(worker[field] for worker in workers) for field in METRIC_FIELDS}
+        elapsed = now - self.start_time
+        rate = self._rate or (totals['candidates'] / elapsed if elapsed > 0 else 0.0)
+        round_searched = totals['candidates'] - self._round['start_total']
+        round_left = max(0, self._round['candidates'] - round_searched)
+        round_workers = [worker['candidates'] - start for worker, start in zip(workers, self._round['start_workers'])]
+        mean = sum(round_workers) / len(round_workers) if round_workers else 0
+        return {'elapsed_seconds': round(elapsed, 3), 'candidates': int(totals['candidates']),
+                'candidates_per_second': round(rate, 2),
+                'hash_computations': int(totals['hash_rejects'] + totals['hits']),
+                'stage_rejects': {stage: int(totals[f"{stage}_rejects"]) for stage in STAGES},
+                'stage_seconds': {stage: round(totals[f"{stage}_seconds"], 3) for stage in STAGES},
+                'source': self._round['source'], 'length': self._round['length'],
+                'length_candidates': self._round['candidates'], 'length_searched': int(round_searched),
+                'eta_seconds': round(round_left / rate, 1) if rate > 0 else None,
+                # How much more than the average the busiest worker searched (0 when the load is even)
+                'imbalance': round(max(round_workers) / mean - 1, 3) if mean > 0 else 0.0,
+                'workers': [{'candidates': int(worker['candidates']), 'chunks': int(worker['chunks'])}
+                            for worker in workers]}
+
+    @staticmethod
+    def status_line(snapshot):
+        eta = 'unknown' if snapshot['eta_seconds'] is None else f"{snapshot['eta_seconds']:.0f}s"
+        return (f"[{snapshot['elapsed_seconds']:.0f}s] {snapshot['candidates']} candidates, "
+                f"{snapshot['candidates_per_second']:.0f}/s | length {snapshot['length']} ({snapshot['source']}): "
+                f"{snapshot['length_searched']}/{snapshot['length_candidates']}, ETA {eta} | "
+                f"imbalance {snapshot['imbalance']:.0%} | rejects {snapshot['stage_rejects']}")
+
+    def write_snapshot(self, snapshot):
+        temporary_path = f"{self.snapshot_path}.tmp"
+        with open(temporary_path, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(temporary_path, self.snapshot_path)
+
+    def _report(self):
+        while not self._stop.wait(self.interval or 1.0):
+            now = time.monotonic()
+            total = sum(self.metrics.worker_values(i)[0] for i in range(self.metrics.number_of_workers))
+            last_time, last_total = self._last
+            self._rate = (total - last_total) / (now - last_time)
+            self._last = (now, total)
+            snapshot = self.snapshot()
+            if self.interval:
+                print(self.status_line(snapshot))
+            if self.snapshot_path is not None:
+                self.write_snapshot(snapshot)
+
+    def _serve(self):
+        reporter = self
+
+        class SnapshotHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(reporter.snapshot()).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', self.http_port), SnapshotHandler)
+        print(f"Serving the metrics on http://127.0.0.1:{self._server.server_address[1]}/")
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._report, daemon=True)
+        self._thread.start()
+        if self.http_port is not None:
+            self._serve()
+
+    def stop(self):
+        """Stops the reporter and writes the last snapshot"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._server is not None:
+            self._server.shutdown()
+        if self.snapshot_path is not None:
+            self.write_snapshot(self.snapshot())
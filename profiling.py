@@ -0,0 +1,126 @@
+import cProfile
+import glob
+import os
+import pstats
+import signal
+import threading
+
+# The stages of the verification that the profile is summarised by, in the order a candidate goes through them
+PROFILE_STAGES = ('generate', 'append', 'structure', 'open', 'member open', 'decrypt', 'decompress', 'hash',
+                  'extractor', 'other')
+
+# The functions of zipfile.py that read (and decompress) a member and those that open it
+ZIPFILE_READ_FUNCTIONS = {'read', 'read1', '_read1', '_read2', '_update_crc', 'peek', 'readinto'}
+ZIPFILE_OPEN_FUNCTIONS = {'open', '_init_decrypter', '_get_decompressor', '_check_compression', 'seek', 'tell'}
+# The functions of the verifier that are stages on their own
+VERIFIER_FUNCTIONS = {'open_candidate': 'append', 'find_end_record': 'structure', 'check_end_record': 'structure',
+                      'open_member': 'member open', 'check_local_header': 'member open',
+                      'check_member_crc': 'decompress', 'check_stored_member_data': 'hash', 'check_stored_data': 'hash'}
+
+
+def profile_stage(function):
+    """Returns the stage a profiled function belongs to
+
+    :param function: A (file name, line, function name) key of pstats
+    """
+    file_name, _, name = function
+    base_name = os.path.basename(file_name)
+    if base_name == 'candidate_sources.py':
+        return 'generate'
+    if base_name == 'in_memory_archive.py':
+        return 'append'
+    if base_name == 'rar_headers.py':
+        return 'structure'
+    if base_name == 'zip_directory.py':
+        return 'open'
+    if base_name in ('zipcrypto.py', 'zip_encryption.py', 'hmac.py') or 'pbkdf2' in name:
+        return 'decrypt'
+    if base_name == 'crc_screening.py':
+        return 'decompress'
+    if base_name == 'archive_verifier.py':
+        return VERIFIER_FUNCTIONS.get(name, 'other')
+    if base_name == 'zipfile.py':
+        if name in ZIPFILE_READ_FUNCTIONS:
+            return 'decompress'
+        return 'member open' if name in ZIPFILE_OPEN_FUNCTIONS else 'open'
+    if base_name == 'rarfile.py':
+        return 'open'
+    if base_name in ('subprocess.py', 'selectors.py') or 'posix.' in name or 'fork_exec' in name:
+        return 'extractor'
+    if base_name in ('hashlib.py', 'file_processing.py') or '_hashlib' in name:
+        return 'hash'
+    if 'decompress' in name.lower() or 'crc32' in name or base_name in ('bz2.py', 'lzma.py', '_compression.py'):
+        return 'decompress'
+    return 'other'
+
+
+def exit_on_terminate(signal_number, frame):
+    """Turns the termination of a profiled process into a SystemExit, so that it still writes its profile"""
+    raise SystemExit(128 + signal_number)
+
+
+def profile_path_of(profile_directory, pid):
+    """Returns the name of the profile written by the process pid"""
+    return os.path.join(profile_directory, f"process-{pid}.prof")
+
+
+def run_profiled(profile_directory, function, *args):
+    """Runs function(*args) under cProfile and writes the profile to profile_directory.
+    It is only used as the target of the processes when profiling is enabled, so the search
+    pays nothing for it otherwise. A process terminated because it did not stop in time (SIGTERM) writes its
+    profile too: these are the busiest consumers.
+
+    :param profile_directory: The directory where the profile of the process is written
+    :param function: The function that is profiled
+    """
+    if hasattr(signal, 'SIGTERM') and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, exit_on_terminate)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args)
+    finally:
+        profiler.dump_stats(profile_path_of(profile_directory, os.getpid()))
+
+
+def merge_profiles(profile_directory, output_path, pids=()):
+    """Merges the profiles of the processes into one pstats file.
+    The processes of pids that wrote no profile (e.g. killed, or terminated where SIGTERM can't be handled)
+    are printed, since the merged profile leaves them out.
+
+    :param profile_directory: The directory where the processes wrote their profiles
+    :param output_path: The name of the merged pstats file
+    :param pids: The process ids of the profiled processes (default ())
+    :return: The merged pstats.Stats or None if no process wrote a profile
+    """
+    missing = [pid for pid in pids if not os.path.exists(profile_path_of(profile_directory, pid))]
+    if missing:
+        print(f"The merged profile leaves out the processes {missing}: they did not write their profile")
+    profiles = sorted(glob.glob(os.path.join(profile_directory, '*.prof')))
+    if not profiles:
+        return None
+    stats = pstats.Stats(*profiles)
+    stats.dump_stats(output_path)
+    for profile in profiles:
+        os.remove(profile)
+    return stats
+
+
+def print_profile_summary(stats, top=20):
+    """Prints the time spent in every stage (own time of the functions of the stage) and the top
+    functions by own time
+
+    :param stats: A pstats.Stats object
+    :param top: The number of functions printed (default 20)
+    """
+    stage_seconds = dict.fromkeys(PROFILE_STAGES, 0.0)
+    stage_calls = dict.fromkeys(PROFILE_STAGES, 0)
+    for function, (_, calls, own_time, _, _) in stats.stats.items():
+        stage = profile_stage(function)
+        stage_seconds[stage] += own_time
+        stage_calls[stage] += calls
+    total = sum(stage_seconds.values()) or 1.0
+    print(f"{'stage':<12} {'seconds':>10} {'share':>7} {'calls':>12}")
+    for stage in PROFILE_STAGES:
+        print(f"{stage:<12} {stage_seconds[stage]:>10.3f} {stage_seconds[stage] / total:>7.1%} "
+              f"{stage_calls[stage]:>12}")
+    stats.sort_stats('tottime').print_stats(top)
@@ -0,0 +1,275 @@
+import struct
+from zlib import crc32
+
+from rarfile import UnicodeFilename, DEFAULT_CHARSET
+
+from candidate_sources import RAR4_SIGNATURE, RAR5_SIGNATURE
+
+# The signature of self-extracting archives is searched in their first MiB (the size of the extractor)
+SIGNATURE_SEARCH_SIZE = 1 << 20
+
+RAR4_MAIN_HEADER = 0x73
+RAR4_FILE_HEADER = 0x74
+RAR4_END_OF_ARCHIVE = 0x7b
+# signature of the header (CRC-16), type, flags, size
+RAR4_BLOCK_STRUCT = struct.Struct('<HBHH')
+# packed size, unpacked size, host OS, CRC-32, time, version, method, name size, attributes
+RAR4_FILE_STRUCT = struct.Struct('<IIBIIBBHI')
+RAR4_LONG_BLOCK_FLAG = 0x8000
+RAR4_ENCRYPTED_HEADERS_FLAG = 0x0080
+RAR4_SPLIT_FLAGS = 0x0003
+RAR4_ENCRYPTED_FLAG = 0x0004
+RAR4_DIRECTORY_FLAGS = 0x00E0
+RAR4_LARGE_FLAG = 0x0100
+RAR4_UNICODE_FLAG = 0x0200
+RAR4_STORED_METHOD = 0x30
+
+RAR5_FILE_HEADER = 2
+RAR5_ENCRYPTION_HEADER = 4
+RAR5_END_OF_ARCHIVE = 5
+RAR5_EXTRA_AREA_FLAG = 0x0001
+RAR5_DATA_AREA_FLAG = 0x0002
+RAR5_SPLIT_FLAGS = 0x0018
+RAR5_DIRECTORY_FLAG = 0x0001
+RAR5_TIME_FLAG = 0x0002
+RAR5_CRC_FLAG = 0x0004
+RAR5_ENCRYPTION_RECORD = 0x01
+# RAR 5.0 headers can't be bigger than 2 MiB
+RAR5_MAX_HEADER_SIZE = 2 << 20
+
+
+class RarBlock:
+    """A header block of a RAR archive (and the data area that follows it)"""
+
+    def __init__(self, offset, block_type, flags, data_start, data_size, name=None, crc=None, stored=False,
+                 encrypted=False, split=False, directory=False):
+        self.offset = offset
+        self.block_type = block_type
+        self.flags = flags
+        self.data_start = data_start
+        self.data_size = data_size
+        self.name = name
+        self.crc = crc
+        self.stored = stored
+        self.encrypted = encrypted
+        self.split = split
+        self.directory = directory
+
+    @property
+    def data_end(self):
+        return self.data_start + self.data_size
+
+
+def read_vint(data, position):
+    """Reads a RAR 5.0 variable length integer (7 bits per byte, the high bit tells that another byte follows)
+
+    :param data: A byte string
+    :param position: The position of the integer
+    :return: A tuple (value, position after the integer)
+    """
+    value = 0
+    for shift in range(0, 70, 7):
+        if position >= len(data):
+            raise ValueError("Truncated variable length integer")
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, position
+    raise ValueError("Variable length integer too long")
+
+
+def parse_rar5_block(read, offset):
+    """Parses the RAR 5.0 block that starts at offset
+
+    :param read: A function (position, size) returning the bytes of the archive
+    :param offset: The position of the block
+    :return: A RarBlock or None if the header is truncated or its CRC-32 does not match
+    """
+    head = read(offset, 7)
+    try:
+        header_size, position = read_vint(head, 4)
+    except ValueError:
+        return None
+    if not 0 < header_size <= RAR5_MAX_HEADER_SIZE:
+        return None
+    header = read(offset + 4, position - 4 + header_size)
+    if len(header) != position - 4 + header_size or crc32(header) != struct.unpack_from('<I', head)[0]:
+        return None
+    data_start = offset + position + header_size
+    fields = header[position - 4:]
+    try:
+        block_type, p = read_vint(fields, 0)
+        flags, p = read_vint(fields, p)
+        extra_size = data_size = 0
+        if flags & RAR5_EXTRA_AREA_FLAG:
+            extra_size, p = read_vint(fields, p)
+        if flags & RAR5_DATA_AREA_FLAG:
+            data_size, p = read_vint(fields, p)
+        if block_type != RAR5_FILE_HEADER:
+            return RarBlock(offset, block_type, flags, data_start, data_size)
+        file_flags, p = read_vint(fields, p)
+        _, p = read_vint(fields, p)  # unpacked size
+        _, p = read_vint(fields, p)  # attributes
+        if file_flags & RAR5_TIME_FLAG:
+            p += 4
+        crc = None
+        if file_flags & RAR5_CRC_FLAG:
+            crc = struct.unpack_from('<I', fields, p)[0]
+            p += 4
+        compression, p = read_vint(fields, p)
+        _, p = read_vint(fields, p)  # host OS
+        name_length, p = read_vint(fields, p)
+        name = fields[p:p + name_length].decode('utf-8', 'replace')
+        encrypted = False
+        extra = fields[len(fields) - extra_size:] if extra_size else b''
+        e = 0
+        while e < len(extra):
+            record_size, record_start = read_vint(extra, e)
+            record_type, _ = read_vint(extra, record_start)
+            encrypted = encrypted or record_type == RAR5_ENCRYPTION_RECORD
+            e = record_start + record_size
+    except (ValueError, struct.error):
+        return None
+    return RarBlock(offset, block_type, flags, data_start, data_size, name, crc,
+                    stored=(compression >> 7) & 7 == 0, encrypted=encrypted, split=bool(flags & RAR5_SPLIT_FLAGS),
+                    directory=bool(file_flags & RAR5_DIRECTORY_FLAG))
+
+
+def parse_rar4_block(read, offset):
+    """Parses the RAR 4.x block that starts at offset
+
+    :param read: A function (position, size) returning the bytes of the archive
+    :param offset: The position of the block
+    :return: A RarBlock or None if the header is truncated or its CRC-16 does not match
+    """
+    head = read(offset, RAR4_BLOCK_STRUCT.size)
+    if len(head) != RAR4_BLOCK_STRUCT.size:
+        return None
+    header_crc, block_type, flags, header_size = RAR4_BLOCK_STRUCT.unpack(head)
+    if header_size < RAR4_BLOCK_STRUCT.size:
+        return None
+    header = read(offset, header_size)
+    if len(header) != header_size or crc32(header[2:]) & 0xFFFF != header_crc:
+        return None
+    data_size = 0
+    if block_type == RAR4_FILE_HEADER or flags & RAR4_LONG_BLOCK_FLAG:
+        if header_size < RAR4_BLOCK_STRUCT.size + 4:
+            return None
+        data_size = struct.unpack_from('<I', header, RAR4_BLOCK_STRUCT.size)[0]
+    if block_type != RAR4_FILE_HEADER:
+        return RarBlock(offset, block_type, flags, offset + header_size, data_size)
+    try:
+        (data_size, _, _, crc, _, _, method, name_size, _) = RAR4_FILE_STRUCT.unpack_from(header,
+                                                                                          RAR4_BLOCK_STRUCT.size)
+        name_start = RAR4_BLOCK_STRUCT.size + RAR4_FILE_STRUCT.size
+        if flags & RAR4_LARGE_FLAG:
+            data_size |= struct.unpack_from('<I', header, name_start)[0] << 32
+            name_start += 8
+    except struct.error:
+        return None
+    name = header[name_start:name_start + name_size]
+    if flags & RAR4_UNICODE_FLAG and b'\0' in name:
+        name = UnicodeFilename(*name.split(b'\0', 1)).decode()
+    else:
+        name = name.decode('utf-8' if flags & RAR4_UNICODE_FLAG else DEFAULT_CHARSET, 'replace')
+    return RarBlock(offset, block_type, flags, offset + header_size, data_size, name.replace('\\', '/'), crc,
+                    stored=method == RAR4_STORED_METHOD, encrypted=bool(flags & RAR4_ENCRYPTED_FLAG),
+                    split=bool(flags & RAR4_SPLIT_FLAGS),
+                    directory=flags & RAR4_DIRECTORY_FLAGS == RAR4_DIRECTORY_FLAGS)
+
+
+class RarLayout:
+    """The header blocks of a truncated RAR archive.
+    The prefix is parsed once. For every candidate tail only the blocks that are not entirely in the
+    prefix are parsed, and their header CRCs are verified, up to the end of archive block. The end of archive
+    block is optional in RAR 4.x (rar -en and older writers), so there the blocks may also end with the archive.
+    """
+
+    def __init__(self, prefix):
+        """
+        :param prefix: A bytes-like object with the truncated archive
+        :raise ValueError: If the prefix is not a RAR archive or its headers are encrypted
+        """
+        self.prefix = prefix
+        start = bytes(prefix[:SIGNATURE_SEARCH_SIZE]).find(b'Rar!\x1a\x07')
+        if start == -1:
+            raise ValueError("no RAR signature")
+        if bytes(prefix[start:start + len(RAR5_SIGNATURE)]) == RAR5_SIGNATURE:
+            self.rar5 = True
+            self.parse_block = parse_rar5_block
+            self.end_block_type = RAR5_END_OF_ARCHIVE
+            offset = start + len(RAR5_SIGNATURE)
+        elif bytes(prefix[start:start + len(RAR4_SIGNATURE)]) == RAR4_SIGNATURE:
+            self.rar5 = False
+            self.parse_block = parse_rar4_block
+            self.end_block_type = RAR4_END_OF_ARCHIVE
+            offset = start + len(RAR4_SIGNATURE)
+        else:
+            raise ValueError("unknown RAR version")
+
+        # The blocks whose header lies entirely in the prefix (their data may run into the tail)
+        self.blocks = []
+        read = lambda position, size: bytes(prefix[position:position + size])
+        while offset < len(prefix):
+            block = self.parse_block(read, offset)
+            if block is None:
+                break
+            if self.rar5 and block.block_type == RAR5_ENCRYPTION_HEADER:
+                raise ValueError("the headers are encrypted")
+            if not self.rar5 and block.block_type == RAR4_MAIN_HEADER and block.flags & RAR4_ENCRYPTED_HEADERS_FLAG:
+                raise ValueError("the headers are encrypted")
+            self.blocks.append(block)
+            offset = block.data_end
+            if block.block_type == self.end_block_type:
+                break
+        # The position of the first block that depends on the tail
+        self.resume_offset = offset
+        self.members = {block.name: block for block in self.blocks
+                        if block.name is not None and not block.directory}
+
+    def read(self, tail, position, size):
+        """Returns size bytes from position of the archive rebuilt with the tail"""
+        prefix_length = len(self.prefix)
+        if position + size <= prefix_length:
+            return bytes(self.prefix[position:position + size])
+        if position >= prefix_length:
+            return tail[position - prefix_length:position - prefix_length + size]
+        return bytes(self.prefix[position:]) + tail[:position + size - prefix_length]
+
+    def parse_tail(self, tail):
+        """Parses the blocks of the archive rebuilt with the tail that are not entirely in the prefix
+
+        :param tail: The candidate tail
+        :return: The list of the blocks up to the end of archive block, or None if a header is corrupted or the
+            archive ends before its end of archive block (in the middle of a block, for a RAR 4.x archive)
+        """
+        if self.blocks and self.blocks[-1].block_type == self.end_block_type:
+            return []
+        size = len(self.prefix) + len(tail)
+        read = lambda position, length: self.read(tail, position, length)
+        blocks = []
+        offset = self.resume_offset
+        while offset < size:
+            block = self.parse_block(read, offset)
+            if block is None or block.data_end > size:
+                return None
+            blocks.append(block)
+            if block.block_type == self.end_block_type:
+                return blocks
+            offset = block.data_end
+        # A RAR 4.x archive without end of archive block ends right after the data of its last block
+        if not self.rar5 and offset == size:
+            return blocks
+        return None
+
+    def find_member(self, name, tail_blocks):
+        """Returns the block of the member named name or None if the archive does not hold it
+
+        :param name: The name of the member
+        :param tail_blocks: The blocks returned by parse_tail
+        """
+        for block in tail_blocks:
+            if block.name == name and not block.directory:
+                return block
+        return self.members.get(name)
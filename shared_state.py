@@ -0,0 +1,206 @@
+import contextlib
+import struct
+from multiprocessing import Lock
+from multiprocessing.shared_memory import SharedMemory
+
+from archive_verifier import STAGES
+
+# Why the search stopped, in the status word of the block
+SEARCH_RUNNING = 0
+SEARCH_FOUND = 1
+SEARCH_WRONG_PASSWORD = -1
+SEARCH_TIME_BUDGET = 2
+# The states of a worker slot. A slot is zero (starting) until its worker has mapped the archive
+WORKER_STARTING = 0
+WORKER_RUNNING = 1
+WORKER_DONE = 2
+# The status of the search, the length of the tail in the result slot (0 while it is empty) and the source index,
+# length and chunk start of that tail, which rank it in the order of the search
+HEADER_STRUCT = struct.Struct('<iIiiq')
+# The state, outcome (one of the search statuses), source index and length of the outcome of a worker,
+# followed by its counters: chunks, hits and the rejects of every verification stage
+WORKER_STRUCT = struct.Struct(f'<4i{2 + len(STAGES)}q')
+WORKER_COUNTERS_OFFSET = struct.calcsize('<4i')
+# The number of seconds a process waits for the lock of the block before it gives up on it: a worker terminated
+# while it held the lock never releases it
+LOCK_TIMEOUT = 1.0
+
+
+class SearchState:
+    """The state of a search shared by the consumers and the main process in one block of shared memory:
+    the status of the search, a result slot with the tail that rebuilt the archive and a slot per worker with
+    its state, its outcome and its counters.
+    A worker only writes its own slot and the main process polls the block without blocking, so a slow or
+    crashed worker can't hold up the others and adding workers adds no pipe or message.
+    The status and the result slot are only written under the lock. A process that waits more than LOCK_TIMEOUT
+    seconds for it (the worker that held it was terminated) reads and writes them without it from then on, so a
+    terminated worker can't stall the others or the collection of the result. The first outcome reported (or the time
+    budget running out) sets the status, and the result slot keeps the tail that comes first in the order of the
+    search, so a longer tail found while shorter ones are still searched is replaced by a shorter one. The other
+    fields are written without lock: a snapshot may mix the counters of two consecutive chunks of a worker,
+    but the state of a worker is written last, so a worker seen done has all its fields written.
+    """
+
+    def __init__(self, number_of_workers, max_tail_length):
+        """
+        :param number_of_workers: The number of worker slots
+        :param max_tail_length: The length of the longest tail the result slot has to hold
+        """
+        self.number_of_workers = number_of_workers
+        self.max_tail_length = max_tail_length
+        # The worker slots start at a multiple of 8 bytes after the result slot
+        self._workers_offset = (HEADER_STRUCT.size + max_tail_length + 7) // 8 * 8
+        self._lock = Lock()
+        self._lock_broken = False
+        self._memory = SharedMemory(create=True, size=self._workers_offset + number_of_workers * WORKER_STRUCT.size)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        acquired = not self._lock_broken and self._lock.acquire(timeout=LOCK_TIMEOUT)
+        if not acquired:
+            self._lock_broken = True
+        try:
+            yield
+        finally:
+            if acquired:
+                self._lock.release()
+
+    def _slot_offset(self, worker_id):
+        return self._workers_offset + worker_id * WORKER_STRUCT.size
+
+    @property
+    def status(self):
+        """The status of the search: SEARCH_RUNNING until it stops"""
+        return struct.unpack_from('<i', self._memory.buf, 0)[0]
+
+    def stop(self, status):
+        """Sets the status of the search if it is still running
+
+        :param status: The status telling why the search stopped
+        :return: True if the status was set, False if the search had already stopped
+        """
+        with self._locked():
+            if self.status != SEARCH_RUNNING:
+                return False
+            struct.pack_into('<i', self._memory.buf, 0, status)
+            return True
+
+    def start(self, worker_id):
+        """Marks a worker as running"""
+        struct.pack_into('<i', self._memory.buf, self._slot_offset(worker_id), WORKER_RUNNING)
+
+    def publish(self, worker_id, chunks, hits, stage_rejects):
+        """Writes the counters of a worker
+
+        :param worker_id: The number of the worker
+        :param chunks: The number of chunks the worker searched
+        :param hits: The number of candidates that rebuilt the archive
+        :param stage_rejects: The number of candidates rejected by every verification stage
+        """
+        struct.pack_into(f'<{2 + len(STAGES)}q', self._memory.buf,
+                         self._slot_offset(worker_id) + WORKER_COUNTERS_OFFSET,
+                         chunks, hits, *(stage_rejects[stage] for stage in STAGES))
+
+    def report(self, worker_id, outcome, source_index, length, start, tail=None):
+        """Records the outcome of a worker that stops the search. The first outcome reported becomes the status
+        of the search and the result slot keeps the tail that comes first in the order of the search (by source
+        index, then by length, then by chunk start)
+
+        :param worker_id: The number of the worker
+        :param outcome: SEARCH_FOUND or SEARCH_WRONG_PASSWORD
+        :param source_index: The index of the candidate source of the chunk
+        :param length: The tail length of the chunk
+        :param start: The start of the chunk
+        :param tail: The tail that rebuilt the archive (default None)
+        :return: True if the tail is now in the result slot
+        """
+        with self._locked():
+            struct.pack_into('<3i', self._memory.buf, self._slot_offset(worker_id) + 4, outcome, source_index,
+                             length)
+            status, tail_length, *rank = HEADER_STRUCT.unpack_from(self._memory.buf, 0)
+            kept = tail is not None and (tail_length == 0 or (source_index, length, start) < tuple(rank))
+            if kept:
+                self._memory.buf[HEADER_STRUCT.size:HEADER_STRUCT.size + len(tail)] = tail
+                tail_length = len(tail)
+                rank = [source_index, length, start]
+            if status == SEARCH_RUNNING:
+                status = outcome
+            # The status and the length are written after the tail they describe
+            HEADER_STRUCT.pack_into(self._memory.buf, 0, status, tail_length, *rank)
+            return kept
+
+    def found_before(self, source_index, length, start):
+        """Returns True if the tail in the result slot comes before a chunk in the order of the search, so the
+        candidates of the chunk don't need to be tested
+
+        :param source_index: The index of the candidate source of the chunk
+        :param length: The tail length of the chunk
+        :param start: The start of the chunk
+        """
+        if self.status != SEARCH_FOUND:
+            return False
+        with self._locked():
+            tail_length, *rank = HEADER_STRUCT.unpack_from(self._memory.buf, 0)[1:]
+        return tail_length != 0 and tuple(rank) < (source_index, length, start)
+
+    def finish(self, worker_id):
+        """Marks a worker as done: it will not write its slot anymore"""
+        struct.pack_into('<i', self._memory.buf, self._slot_offset(worker_id), WORKER_DONE)
+
+    def worker_state(self, worker_id):
+        """Returns the state of a worker (WORKER_STARTING, WORKER_RUNNING or WORKER_DONE)"""
+        return struct.unpack_from('<i', self._memory.buf, self._slot_offset(worker_id))[0]
+
+    def result(self):
+        """Returns the (tail, source index, length) in the result slot or None if no worker rebuilt the archive"""
+        with self._locked():
+            _, tail_length, source_index, length, _ = HEADER_STRUCT.unpack_from(self._memory.buf, 0)
+            if tail_length == 0:
+                return None
+            return bytes(self._memory.buf[HEADER_STRUCT.size:HEADER_STRUCT.size + tail_length]), source_index, length
+
+    def reported(self, sources, outcome):
+        """Returns the (source name, length) of the chunks where the workers reported an outcome, whether the
+        workers are done or not
+
+        :param sources: The candidate sources, indexed like the source indexes of the outcomes
+        :param outcome: SEARCH_FOUND or SEARCH_WRONG_PASSWORD
+        """
+        sections = []
+        for worker_id in range(self.number_of_workers):
+            _, worker_outcome, source_index, length = struct.unpack_from('<4i', self._memory.buf,
+                                                                          self._slot_offset(worker_id))
+            if worker_outcome == outcome:
+                sections.append((sources[source_index].name, length))
+        return sections
+
+    def responses(self, sources):
+        """Returns the outcome and the counters of every worker that is done. The outcome of the search is
+        decided by the status and the result slot, which don't depend on the workers being done
+
+        :param sources: The candidate sources, indexed like the source indexes of the outcomes
+        :return: A list of (result, source name, length, stage rejects) tuples where the result is the tail,
+            'Wrong password' or 'Not found'. The source name and the length are None when the result is 'Not found'.
+            Every worker that found a tail gets the tail of the result slot
+        """
+        result = self.result()
+        responses = []
+        for worker_id in range(self.number_of_workers):
+            state, outcome, source_index, length, _, _, *rejects = WORKER_STRUCT.unpack_from(
+                self._memory.buf, self._slot_offset(worker_id))
+            if state != WORKER_DONE:
+                continue
+            stage_rejects = dict(zip(STAGES, rejects))
+            if outcome == SEARCH_FOUND:
+                tail, source_index, length = result
+                responses.append((tail, sources[source_index].name, length, stage_rejects))
+            elif outcome == SEARCH_WRONG_PASSWORD:
+                responses.append(('Wrong password', sources[source_index].name, length, stage_rejects))
+            else:
+                responses.append(('Not found', None, None, stage_rejects))
+        return responses
+
+    def close(self):
+        """Releases the shared memory once the workers are stopped"""
+        self._memory.close()
+        self._memory.unlink()
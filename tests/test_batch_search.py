@@ -0,0 +1,63 @@
+import hashlib
+import os
+import threading
+import zipfile
+
+import batch_search
+from batch_search import BatchJob, search_batch
+
+
+def crash_first_consumer(scheduler, worker_id, *args):
+    if worker_id == 0:
+        os._exit(3)
+    return ORIGINAL_BATCH_CONSUMER(scheduler, worker_id, *args)
+
+
+ORIGINAL_BATCH_CONSUMER = batch_search.batch_consumer
+
+
+def test_crashed_consumer_does_not_hang_the_batch(tmp_path, monkeypatch):
+    archive = tmp_path / 'truncated.zip'
+    with zipfile.ZipFile(archive, 'w') as z:
+        z.writestr('member.txt', b'content ' * 50)
+    data = archive.read_bytes()
+    archive.write_bytes(data[:-1])
+    job = BatchJob(str(archive), 'md5')
+    job.file_names.append('member.txt')
+    # No tail rebuilds the member with this hash, so the search only ends when every consumer is finished
+    job.file_hashes.append('0' * 32)
+    # The consumers are forked, so they run the patched function
+    monkeypatch.setattr(batch_search, 'batch_consumer', crash_first_consumer)
+    results = []
+    search = threading.Thread(target=lambda: results.append(
+        search_batch([job], 2, max_missing_bytes=1, use_solver=False, use_format_source=False, status_interval=0)),
+        daemon=True)
+    search.start()
+    search.join(60)
+    assert not search.is_alive()
+    assert results[0]['jobs'][0]['status'] == 'not found'
+    assert results[0]['candidates_tested'] == 256
+
+
+def test_every_archive_gets_the_first_tail_of_its_own_search(tmp_path):
+    jobs = []
+    tails = []
+    for name, bytes_missing in (('short.zip', 2), ('long.zip', 3)):
+        archive = tmp_path / name
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as z:
+            z.writestr('member.txt', b'batch member ' * 40)
+        data = archive.read_bytes()
+        archive.write_bytes(data[:-bytes_missing])
+        tails.append(data[-bytes_missing:])
+        job = BatchJob(str(archive), 'md5')
+        job.file_names.append('member.txt')
+        job.file_hashes.append(hashlib.md5(b'batch member ' * 40).hexdigest())
+        jobs.append(job)
+    # The tails are the first raw candidates of their length and the lengths are searched in turn, so the 3 byte
+    # tail is found before the shorter tails of its archive are exhausted
+    result = search_batch(jobs, 3, max_missing_bytes=3, use_solver=False, use_format_source=False, interleave=2,
+                          status_interval=0)
+    assert [job['status'] for job in result['jobs']] == ['found', 'found']
+    assert [job['tail'] for job in result['jobs']] == tails
+    assert result['shutdown_seconds'] is not None
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['long.zip', 'short.zip']
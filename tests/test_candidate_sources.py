@@ -0,0 +1,71 @@
+import itertools
+
+import pytest
+
+from candidate_sources import HintedCandidateSource, RankOrderedPattern, RawCandidateSource, TailHints
+
+DOMAINS = [b'abc', b'\x00\x01', b'wxyz', b'q']
+
+
+def rank_sum(pattern, tail):
+    return sum(domain.index(value) for domain, value in zip(pattern.domains, tail))
+
+
+@pytest.mark.parametrize('domains', [DOMAINS, [b'\x00\xff'] * 5, [bytes(range(7)), b'k', bytes(range(5))]])
+def test_every_index_of_a_rank_ordered_pattern_is_one_tail(domains):
+    pattern = RankOrderedPattern(domains)
+    tails = [pattern.tail_at(index) for index in range(pattern.size)]
+    assert sorted(tails) == sorted(bytes(values) for values in itertools.product(*domains))
+    assert list(pattern.tails(0, pattern.size)) == tails
+    # Best-first: the sums of the ranks never decrease
+    sums = [rank_sum(pattern, tail) for tail in tails]
+    assert sums == sorted(sums)
+    for start, stop in [(0, 1), (1, pattern.size), (pattern.size // 2, pattern.size - 1), (3, 3)]:
+        assert list(pattern.tails(start, stop)) == tails[start:stop]
+
+
+def test_rank_ordered_pattern_puts_one_unlikely_byte_after_likely_ones():
+    pattern = RankOrderedPattern([bytes(range(256))] * 3)
+    assert pattern.tail_at(0) == b'\x00\x00\x00'
+    assert pattern.tail_at(pattern.size - 1) == b'\xff\xff\xff'
+    assert pattern.tail_at(10 ** 5) == list(pattern.tails(10 ** 5, 10 ** 5 + 1))[0]
+    assert list(pattern.tails(1, 4)) == [b'\x00\x00\x01', b'\x00\x01\x00', b'\x01\x00\x00']
+
+
+@pytest.mark.parametrize('text, hint', [('0=41', (0, b'A', True)),
+                                        ('-1=42,41', (-1, b'BA', True)),
+                                        ('2=30-39', (2, b'0123456789', False)),
+                                        ('1=40/f0', (1, bytes(range(0x40, 0x50)), False))])
+def test_hints_are_parsed_and_written_back(text, hint):
+    assert TailHints.parse_hint(text) == hint
+    assert TailHints.parse_hint(str(TailHints([hint]))) == hint
+
+
+@pytest.mark.parametrize('text', ['41', '0=', '0=41-40', '0=zz'])
+def test_bad_hints_are_refused(text):
+    with pytest.raises(ValueError):
+        TailHints.parse_hint(text)
+
+
+def test_hints_restrict_the_domains():
+    hints = TailHints([(-1, b'zw', True), (0, b'cb', False)])
+    # The last byte of a four byte tail is q, which the hint does not allow
+    assert hints.restrict(DOMAINS) is None
+    assert hints.restrict(DOMAINS[:3]) == [b'bc', b'\x00\x01', b'zw']
+    assert TailHints(known_prefix=b'b').restrict(DOMAINS) == [b'b'] + DOMAINS[1:]
+    assert TailHints([(5, b'a', True)]).restrict(DOMAINS) is None
+    assert TailHints([(0, b'd', True)]).restrict(DOMAINS) is None
+
+
+def test_hinted_source_enumerates_the_hinted_tails_best_first():
+    hints = TailHints([(0, b'\x41\x42', True), (-1, bytes(range(0x30, 0x3a)), False)])
+    source = HintedCandidateSource(RawCandidateSource(), hints)
+    assert source.name == 'raw+hints'
+    assert source.keyspace_size(1) == 0
+    size = source.keyspace_size(3)
+    assert size == 2 * 256 * 10
+    tails = list(source.candidates(3, 0, size))
+    assert sorted(tails) == sorted(bytes([first, middle, last]) for first in b'AB' for middle in range(256)
+                                   for last in range(0x30, 0x3a))
+    assert tails[0] == b'A\x000'
+    assert list(source.candidates(3, 1000, 1010)) == tails[1000:1010]
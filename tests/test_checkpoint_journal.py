@@ -0,0 +1,106 @@
+import json
+
+import pytest
+
+from checkpoint_journal import CheckpointJournal
+from FindMissingBytes import plan_keyspace
+
+SEARCH_KEY = {'archive': 'archive.zip', 'file': 'file.txt', 'hash': '00ff'}
+
+
+class Source:
+    def __init__(self, name, max_length=None):
+        self.name = name
+        self.max_length = max_length
+
+    @staticmethod
+    def keyspace_size(length):
+        return 256 ** length
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'archive.zip.journal')
+
+
+def test_ranges_are_merged_and_the_rest_remains(path):
+    journal = CheckpointJournal(path, SEARCH_KEY)
+    journal.add('raw', 2, 100, 200)
+    journal.add('raw', 2, 0, 50)
+    journal.add('raw', 2, 50, 100)
+    journal.add('raw', 2, 300, 400)
+    assert journal.completed == {'raw:2': [(0, 200), (300, 400)]}
+    assert journal.remaining('raw', 2, 65536) == [(200, 300), (400, 65536)]
+    assert journal.remaining('raw', 1, 256) == [(0, 256)]
+    journal.add('raw', 1, 0, 256)
+    assert journal.remaining('raw', 1, 256) == []
+
+
+def test_resume_skips_the_finished_ranges(path):
+    journal = CheckpointJournal(path, SEARCH_KEY)
+    journal.add('raw', 1, 0, 256)
+    journal.add('raw', 2, 0, 1000)
+    journal.save(force=True)
+
+    resumed = CheckpointJournal(path, dict(SEARCH_KEY))
+    assert resumed.load()
+    assert plan_keyspace([Source('raw')], 3, resumed) == [(0, 2, 1000, 65536), (0, 3, 0, 256 ** 3)]
+    # A journal written for another search is ignored
+    other = CheckpointJournal(path, dict(SEARCH_KEY, hash='ff00'))
+    assert not other.load()
+    assert plan_keyspace([Source('raw', max_length=2)], 3, other) == [(0, 1, 0, 256), (0, 2, 0, 65536)]
+
+
+def test_reset_forgets_a_length_and_is_saved(path):
+    journal = CheckpointJournal(path, SEARCH_KEY)
+    journal.add('raw', 1, 0, 256)
+    journal.add('raw', 2, 0, 1000)
+    journal.save(force=True)
+    journal.reset('raw', 2)
+    journal.reset('zip', 4)
+    assert journal.remaining('raw', 2, 65536) == [(0, 65536)]
+    assert journal.remaining('raw', 1, 256) == []
+    journal.save(force=True)
+    with open(path) as f:
+        assert json.load(f)['completed'] == {'raw:1': [[0, 256]]}
+
+
+def test_save_waits_for_the_sync_interval(path, tmp_path):
+    journal = CheckpointJournal(path, SEARCH_KEY, sync_interval=3600)
+    journal.add('raw', 1, 0, 10)
+    journal.save()
+    journal.add('raw', 1, 10, 20)
+    journal.save()
+    with open(path) as f:
+        assert json.load(f)['completed'] == {'raw:1': [[0, 10]]}
+    assert [p.name for p in tmp_path.iterdir()] == ['archive.zip.journal']
+
+
+def test_journal_without_a_path_writes_nothing(tmp_path):
+    journal = CheckpointJournal(None, SEARCH_KEY)
+    assert not journal.load()
+    journal.add('raw', 1, 0, 10)
+    journal.save(force=True)
+    journal.remove()
+    assert journal.remaining('raw', 1, 256) == [(10, 256)]
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_unwritable_journal_does_not_stop_the_search(tmp_path, capsys):
+    journal = CheckpointJournal(str(tmp_path / 'missing' / 'archive.zip.journal'), SEARCH_KEY)
+    journal.add('raw', 1, 0, 10)
+    journal.save(force=True)
+    assert 'can not be written' in capsys.readouterr().out
+    assert journal.path is None
+    journal.add('raw', 1, 10, 20)
+    journal.save(force=True)
+    assert journal.remaining('raw', 1, 256) == [(20, 256)]
+
+
+def test_remove_deletes_the_journal(path, tmp_path):
+    journal = CheckpointJournal(path, SEARCH_KEY)
+    journal.add('raw', 1, 0, 10)
+    journal.save(force=True)
+    journal.remove()
+    assert list(tmp_path.iterdir()) == []
+    journal.remove()
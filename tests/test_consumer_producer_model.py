@@ -0,0 +1,72 @@
+import queue
+import threading
+import time
+from multiprocessing import Event, Lock
+
+from archive_verifier import STAGES
+from consumer_producer_model import consumer
+from shared_state import SearchState, SEARCH_FOUND
+from work_scheduler import WorkScheduler
+
+
+class StubVerifier:
+    """Accepts the tails of a set and rejects the others at the structure stage"""
+
+    def __init__(self, valid_tails):
+        self.valid_tails = valid_tails
+        self.stage_rejects = dict.fromkeys(STAGES, 0)
+
+    def share(self):
+        return StubVerifier(self.valid_tails)
+
+    def check(self, tail):
+        if tail in self.valid_tails:
+            return 1
+        self.stage_rejects['structure'] += 1
+        return False
+
+
+class StubSource:
+    """Every byte string of the requested length, where the 1 byte tails are slow to generate"""
+
+    name = 'stub'
+
+    def __init__(self):
+        self.slow_chunk_started = threading.Event()
+
+    def candidates(self, length, start, stop):
+        for index in range(start, stop):
+            if length == 1:
+                self.slow_chunk_started.set()
+                time.sleep(0.001)
+            yield index.to_bytes(length, 'big')
+
+
+def test_shorter_tail_searched_after_a_longer_hit_wins():
+    short_tail, long_tail = bytes([200]), bytes(2)
+    source = StubSource()
+    # One chunk per length: the first consumer takes the slow 1 byte chunk, the second one finds the 2 byte tail
+    scheduler = WorkScheduler([(0, 1, 0, 256), (0, 2, 0, 256)], 2, min_chunk=256, max_chunk=256)
+    state = SearchState(2, 2)
+    verifier = StubVerifier({short_tail, long_tail})
+    progress_queue = queue.Queue()
+    cancel = Event()
+    lock = Lock()
+
+    def run(worker_id):
+        consumer(scheduler, worker_id, lock, state, progress_queue, None, 0, [source], 'file', 'hash', 'md5', cancel,
+                 None, shared_verifier=verifier)
+
+    try:
+        first = threading.Thread(target=run, args=(0,))
+        first.start()
+        assert source.slow_chunk_started.wait(5)
+        second = threading.Thread(target=run, args=(1,))
+        second.start()
+        first.join(10)
+        second.join(10)
+        assert state.status == SEARCH_FOUND
+        assert state.result() == (short_tail, 0, 1)
+        assert not cancel.is_set()
+    finally:
+        state.close()
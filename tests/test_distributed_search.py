@@ -0,0 +1,106 @@
+import os
+import subprocess
+import sys
+import zipfile
+
+import pytest
+
+import distributed_search
+from distributed_search import LeaseCoordinator, coordinate
+from file_processing import compute_hash_unopened_file, map_archive_prefix
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+def test_slow_lease_is_taken_back_and_its_remainder_handed_out(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(distributed_search.time, 'monotonic', clock.monotonic)
+    coordinator = LeaseCoordinator({}, [('raw', 2, 500)], lease_size=100, lease_timeout=60.0, slow_factor=4.0)
+    # Three leases searched at 100 candidates per second set the median rate
+    for _ in range(3):
+        lease_id = coordinator.acquire_lease('fast')[0]
+        clock.now += 1.0
+        coordinator.complete_lease('fast', lease_id)
+    lease_id, _, _, start, stop = coordinator.acquire_lease('slow')
+    assert (start, stop) == (300, 400)
+    # Slow progress is tolerated until the lease takes longer than at the median rate
+    clock.now += 0.5
+    assert coordinator.renew_lease('slow', lease_id, 305)
+    clock.now += 1.5
+    assert not coordinator.renew_lease('slow', lease_id, 310)
+    assert coordinator.reassigned_leases == 1
+    assert coordinator.candidates_searched == 310
+    # The candidates the slow worker did not search come before the fresh leases
+    assert coordinator.acquire_lease('fast')[1:] == ('raw', 2, 310, 400)
+
+
+def test_steady_lease_is_renewed(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(distributed_search.time, 'monotonic', clock.monotonic)
+    coordinator = LeaseCoordinator({}, [('raw', 2, 500)], lease_size=100, slow_factor=4.0)
+    for _ in range(3):
+        lease_id = coordinator.acquire_lease('fast')[0]
+        clock.now += 1.0
+        coordinator.complete_lease('fast', lease_id)
+    lease_id = coordinator.acquire_lease('steady')[0]
+    clock.now += 2.0
+    assert coordinator.renew_lease('steady', lease_id, 360)
+    assert coordinator.reassigned_leases == 0
+
+
+def test_command_line_requires_an_authkey():
+    environment = {key: value for key, value in os.environ.items() if key != 'FIND_MISSING_BYTES_AUTHKEY'}
+    completed = subprocess.run([sys.executable, distributed_search.__file__, 'worker', '127.0.0.1:1'],
+                               env=environment, capture_output=True, text=True)
+    assert completed.returncode == 2
+    assert '--authkey' in completed.stderr
+
+
+def test_search_is_given_up_when_every_worker_is_silent(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(distributed_search.time, 'monotonic', clock.monotonic)
+    coordinator = LeaseCoordinator({}, [('raw', 2, 500)], lease_size=100, lease_timeout=60.0)
+    # Nobody joined yet: the coordinator keeps waiting for workers
+    clock.now += 120.0
+    coordinator.expire_leases()
+    assert not coordinator.should_stop()
+    coordinator.acquire_lease('crashed')
+    clock.now += 30.0
+    coordinator.expire_leases()
+    assert coordinator.status()['live_workers'] == 1
+    clock.now += 31.0
+    coordinator.expire_leases()
+    assert coordinator.reassigned_leases == 1
+    assert coordinator.state == 'no live worker'
+    assert coordinator.acquire_lease('late') is None
+
+
+# The thread of the manager server leaves with sys.exit() once the coordinator stops it
+@pytest.mark.filterwarnings('ignore::pytest.PytestUnhandledThreadExceptionWarning')
+def test_local_workers_find_the_tail(tmp_path):
+    member = tmp_path / 'member.txt'
+    member.write_bytes(b'distributed search ' * 20)
+    archive = str(tmp_path / 'archive.zip')
+    with zipfile.ZipFile(archive, 'w') as z:
+        z.write(member, 'member.txt')
+    bytes_missing = 2
+    prefix = map_archive_prefix(archive, bytes_missing)
+    job = {'archive_name': archive, 'extension': '.zip', 'bytes_missing': bytes_missing, 'prefix_size': len(prefix),
+           'file_name': 'member.txt', 'file_hash': compute_hash_unopened_file(str(member), 'md5'),
+           'hash_method': 'md5', 'needs_password': False, 'password': None}
+    # The raw tails of 1 byte come first, so both workers search leases before the tail is found
+    keyspace = [('raw', 1, 256), ('raw', 2, 65536)]
+    coordinator = coordinate(job, prefix, keyspace, ('127.0.0.1', 0), b'test key', lease_size=64, local_workers=2,
+                             status_interval=60.0)
+    with open(archive, 'rb') as f:
+        tail = f.read()[-bytes_missing:]
+    assert coordinator.state == 'found'
+    assert coordinator.result == tail
+    assert coordinator.winner in ('local-0', 'local-1')
+    assert coordinator.candidates_searched >= 256
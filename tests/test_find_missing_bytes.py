@@ -0,0 +1,28 @@
+import os
+import subprocess
+import sys
+
+SPAWNED_PROGRESS = """
+import multiprocessing
+from FindMissingBytes import stdout_to_stderr
+
+if __name__ == '__main__':
+    with stdout_to_stderr():
+        print('progress of the main process')
+        process = multiprocessing.get_context('spawn').Process(target=print, args=('progress of a consumer',))
+        process.start()
+        process.join()
+    print('result')
+"""
+
+
+def test_only_the_result_is_written_to_stdout_with_spawned_consumers(tmp_path):
+    script = tmp_path / 'spawned_progress.py'
+    script.write_text(SPAWNED_PROGRESS)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    completed = subprocess.run([sys.executable, str(script)], capture_output=True, text=True, timeout=60,
+                               env=dict(os.environ, PYTHONPATH=root))
+    assert completed.returncode == 0, completed.stderr
+    assert completed.stdout == 'result\n'
+    assert 'progress of the main process' in completed.stderr
+    assert 'progress of a consumer' in completed.stderr
@@ -0,0 +1,49 @@
+import random
+import zlib
+
+import pytest
+
+from generator import crc32_inversion_generator, crc32_solution_space
+
+PREFIX = b'PK\x03\x04 the bytes before the solved data'
+
+
+@pytest.fixture
+def data():
+    return bytes(random.Random(17).randrange(256) for _ in range(64))
+
+
+@pytest.mark.parametrize('free_positions', [[0, 1, 2, 3], [60, 61, 62, 63], [5, 20, 41, 63]])
+def test_four_free_bytes_are_solved_back(data, free_positions):
+    crc = zlib.crc32(PREFIX)
+    expected_crc = zlib.crc32(data, crc)
+    blanked = bytearray(data)
+    for position in free_positions:
+        blanked[position] = 0
+    solution, null_space = crc32_solution_space(bytes(blanked), free_positions, crc, expected_crc)
+    assert solution == int.from_bytes(bytes(data[position] for position in free_positions), 'little')
+    assert list(crc32_inversion_generator(bytes(blanked), free_positions, crc, expected_crc)) == [data]
+
+
+def test_every_solution_of_more_free_bytes_has_the_expected_crc(data):
+    free_positions = [10, 11, 12, 13, 14]
+    expected_crc = zlib.crc32(data)
+    solutions = list(crc32_inversion_generator(data, free_positions, 0, expected_crc))
+    assert len(solutions) == 256
+    assert len(set(solutions)) == 256
+    assert data in solutions
+    for solution in solutions:
+        assert zlib.crc32(solution) == expected_crc
+        assert solution[:10] == data[:10] and solution[15:] == data[15:]
+
+
+def test_unreachable_crc_has_no_solution(data):
+    reachable = {zlib.crc32(data[:7] + bytes([value]) + data[8:]) for value in range(256)}
+    expected_crc = next(value for value in range(1 << 32) if value not in reachable)
+    assert crc32_solution_space(data, [7], 0, expected_crc) is None
+    assert list(crc32_inversion_generator(data, [7], 0, expected_crc)) == []
+
+
+def test_too_many_solutions_are_refused(data):
+    with pytest.raises(ValueError):
+        next(crc32_inversion_generator(data, list(range(8)), 0, zlib.crc32(data), max_solutions=1 << 16))
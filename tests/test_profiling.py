@@ -0,0 +1,27 @@
+import os
+import time
+from multiprocessing import Event, Process
+
+from profiling import merge_profiles, profile_path_of, run_profiled
+
+
+def wait_forever(started):
+    started.set()
+    while True:
+        time.sleep(0.01)
+
+
+def test_terminated_process_writes_its_profile(tmp_path, capsys):
+    started = Event()
+    process = Process(target=run_profiled, args=(str(tmp_path), wait_forever, started))
+    process.start()
+    assert started.wait(10)
+    process.terminate()
+    process.join(10)
+    assert os.path.exists(profile_path_of(str(tmp_path), process.pid))
+
+    # A process that wrote no profile is named in the output
+    stats = merge_profiles(str(tmp_path), str(tmp_path / 'merged.pstats'), [process.pid, -1])
+    assert stats is not None
+    assert "leaves out the processes [-1]" in capsys.readouterr().out
+    assert not os.path.exists(profile_path_of(str(tmp_path), process.pid))
@@ -0,0 +1,39 @@
+import struct
+import zlib
+
+import pytest
+
+from rar_headers import RarLayout
+
+DATA = b'hello world ' * 50
+
+
+def rar4_block(block_type, flags, body):
+    header = struct.pack('<BHH', block_type, flags, 7 + len(body)) + body
+    return struct.pack('<H', zlib.crc32(header) & 0xffff) + header
+
+
+def build_rar4(end_of_archive):
+    name = b'notes.txt'
+    archive = b'Rar!\x1a\x07\x00' + rar4_block(0x73, 0, bytes(6))
+    body = struct.pack('<IIBIIBBHI', len(DATA), len(DATA), 2, zlib.crc32(DATA), 0, 20, 0x30, len(name), 0x20)
+    archive += rar4_block(0x74, 0x8000, body + name) + DATA
+    if end_of_archive:
+        archive += rar4_block(0x7b, 0x4000, b'')
+    return archive
+
+
+@pytest.mark.parametrize('end_of_archive', [True, False])
+def test_rar4_tail_is_parsed_with_or_without_end_of_archive_block(end_of_archive):
+    archive = build_rar4(end_of_archive)
+    layout = RarLayout(archive[:30])
+    blocks = layout.parse_tail(archive[30:])
+    assert blocks is not None
+    assert layout.find_member('notes.txt', blocks).block_type == 0x74
+
+
+def test_rar4_tail_ending_inside_a_block_is_rejected():
+    archive = build_rar4(False)
+    layout = RarLayout(archive[:30])
+    assert layout.parse_tail(archive[30:-1]) is None
+    assert layout.parse_tail(archive[30:] + b'\0') is None
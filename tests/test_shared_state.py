@@ -0,0 +1,90 @@
+import time
+from multiprocessing import Event, Process
+
+import pytest
+
+import shared_state
+from shared_state import SearchState, SEARCH_FOUND, SEARCH_RUNNING, SEARCH_TIME_BUDGET, SEARCH_WRONG_PASSWORD, \
+    WORKER_DONE, WORKER_RUNNING
+
+
+class Source:
+    def __init__(self, name):
+        self.name = name
+
+
+SOURCES = [Source('zip'), Source('raw')]
+
+
+@pytest.fixture
+def state():
+    state = SearchState(3, 8)
+    yield state
+    state.close()
+
+
+def test_report_keeps_the_first_status_and_the_first_tail_in_search_order(state):
+    assert state.status == SEARCH_RUNNING
+    assert state.report(0, SEARCH_FOUND, 1, 3, 4096, b'abc')
+    # A tail that comes later in the order of the search does not replace the one in the slot
+    assert not state.report(1, SEARCH_FOUND, 1, 3, 8192, b'xyz')
+    assert not state.report(1, SEARCH_FOUND, 1, 4, 0, b'long')
+    assert state.result() == (b'abc', 1, 3)
+    # One that comes before it does, and the status stays the first one reported
+    assert state.report(2, SEARCH_FOUND, 0, 5, 0, b'zipzz')
+    assert state.result() == (b'zipzz', 0, 5)
+    state.report(1, SEARCH_WRONG_PASSWORD, 1, 2, 0)
+    assert not state.stop(SEARCH_TIME_BUDGET)
+    assert state.status == SEARCH_FOUND
+    assert state.found_before(1, 1, 0)
+    assert not state.found_before(0, 4, 0)
+
+
+def test_outcome_survives_a_worker_that_is_not_done(state):
+    state.start(0)
+    state.publish(0, 2, 1, {'structure': 10, 'headers': 1, 'crc': 0, 'hash': 0})
+    state.report(0, SEARCH_FOUND, 1, 2, 256, b'\x01\x02')
+    # The worker is terminated before it marks its slot done
+    assert state.worker_state(0) == WORKER_RUNNING
+    assert state.responses(SOURCES) == []
+    assert state.status == SEARCH_FOUND
+    assert state.result() == (b'\x01\x02', 1, 2)
+    assert state.reported(SOURCES, SEARCH_FOUND) == [('raw', 2)]
+
+
+def test_responses_of_done_workers(state):
+    for worker_id in range(3):
+        state.start(worker_id)
+    state.publish(1, 1, 0, {'structure': 5, 'headers': 0, 'crc': 0, 'hash': 0})
+    state.report(1, SEARCH_WRONG_PASSWORD, 0, 7, 16)
+    state.finish(1)
+    state.finish(2)
+    assert state.worker_state(1) == WORKER_DONE
+    assert state.status == SEARCH_WRONG_PASSWORD
+    assert state.result() is None
+    assert state.responses(SOURCES) == [
+        ('Wrong password', 'zip', 7, {'structure': 5, 'headers': 0, 'crc': 0, 'hash': 0}),
+        ('Not found', None, None, {'structure': 0, 'headers': 0, 'crc': 0, 'hash': 0})]
+    assert state.reported(SOURCES, SEARCH_WRONG_PASSWORD) == [('zip', 7)]
+
+
+
+def hold_the_lock(state, acquired):
+    with state._lock:
+        acquired.set()
+        time.sleep(60)
+
+
+def test_worker_terminated_with_the_lock_does_not_stall_the_result(state, monkeypatch):
+    monkeypatch.setattr(shared_state, 'LOCK_TIMEOUT', 0.1)
+    state.report(0, SEARCH_FOUND, 0, 2, 0, b'ab')
+    acquired = Event()
+    worker = Process(target=hold_the_lock, args=(state, acquired))
+    worker.start()
+    assert acquired.wait(10)
+    worker.terminate()
+    worker.join()
+    assert state.result() == (b'ab', 0, 2)
+    assert state.report(1, SEARCH_FOUND, 0, 1, 0, b'a')
+    assert state.found_before(0, 2, 0)
+    assert state.result() == (b'a', 0, 1)
@@ -0,0 +1,76 @@
+import pytest
+
+from work_scheduler import MAX_KEYSPACE_SIZE, WorkScheduler
+
+
+def drain(scheduler):
+    chunks = []
+    while (chunk := scheduler.next_chunk()) is not None:
+        chunks.append(chunk)
+    return chunks
+
+
+def covered(chunks, source_index, length):
+    return [(start, stop) for source, chunk_length, start, stop in chunks
+            if (source, chunk_length) == (source_index, length)]
+
+
+def test_chunks_cover_every_segment_once_in_order():
+    scheduler = WorkScheduler([(0, 1, 0, 256), (0, 2, 0, 0), (0, 2, 0, 65536), (1, 2, 100, 5000)], 4,
+                              min_chunk=16, max_chunk=1024)
+    assert scheduler.number_of_segments == 3
+    assert scheduler.remaining() == 256 + 65536 + 4900
+    assert scheduler.front() == (0, 1, 256)
+    chunks = drain(scheduler)
+    assert [chunk[:2] for chunk in chunks] == sorted(chunk[:2] for chunk in chunks)
+    for (source_index, length), (first, last) in {(0, 1): (0, 256), (0, 2): (0, 65536), (1, 2): (100, 5000)}.items():
+        ranges = covered(chunks, source_index, length)
+        assert ranges[0][0] == first and ranges[-1][1] == last
+        assert all(stop == start for (_, stop), (start, _) in zip(ranges, ranges[1:]))
+        assert all(stop - start <= 1024 and (stop - start >= 16 or stop == last) for start, stop in ranges)
+    # The chunks get smaller towards the end of a segment
+    ranges = covered(chunks, 0, 2)
+    assert ranges[0][1] - ranges[0][0] > ranges[-1][1] - ranges[-1][0]
+    assert scheduler.next_chunk() is None
+    assert scheduler.remaining() == 0
+    assert scheduler.front() is None
+
+
+def test_interleaved_segments_are_taken_in_turn():
+    scheduler = WorkScheduler([(0, 1, 0, 64), (0, 2, 0, 64)], 1, interleave=2, min_chunk=16, max_chunk=16)
+    assert [chunk[1] for chunk in drain(scheduler)] == [1, 2] * 4
+
+
+def test_too_big_keyspace_is_refused():
+    with pytest.raises(ValueError):
+        WorkScheduler([(0, 8, 0, MAX_KEYSPACE_SIZE + 1)], 1)
+
+
+def test_cancel_drops_the_chunks_of_a_source():
+    scheduler = WorkScheduler([(0, 1, 0, 1000), (1, 1, 0, 1000), (0, 2, 0, 1000)], 2, min_chunk=100)
+    assert scheduler.next_chunk() == (0, 1, 0, 100)
+    scheduler.cancel({0})
+    assert scheduler.remaining() == 1000
+    assert scheduler.front() == (1, 1, 1000)
+    chunks = drain(scheduler)
+    assert {chunk[0] for chunk in chunks} == {1}
+    assert covered(chunks, 1, 1)[-1][1] == 1000
+
+
+def test_truncate_keeps_only_the_candidates_before_a_hit():
+    scheduler = WorkScheduler([(0, 1, 0, 1000), (0, 2, 0, 1000), (0, 3, 0, 1000), (1, 1, 0, 1000)], 2,
+                              interleave=2, min_chunk=100)
+    assert scheduler.next_chunk() == (0, 1, 0, 100)
+    assert scheduler.next_chunk() == (0, 2, 0, 100)
+    scheduler.truncate(0, 2, 500)
+    chunks = drain(scheduler)
+    assert covered(chunks, 0, 1)[-1][1] == 1000
+    assert covered(chunks, 0, 2)[-1][1] == 500
+    assert covered(chunks, 0, 3) == [] and covered(chunks, 1, 1) == []
+
+
+def test_truncate_among_some_sources_keeps_the_others():
+    scheduler = WorkScheduler([(0, 1, 0, 100), (1, 1, 0, 100), (0, 2, 0, 100), (1, 2, 0, 100)], 1, min_chunk=100)
+    scheduler.truncate(0, 1, 0, source_indexes={0})
+    chunks = drain(scheduler)
+    assert [chunk[:2] for chunk in chunks] == [(1, 1), (1, 2)]
@@ -0,0 +1,66 @@
+import io
+import random
+import zipfile
+
+import pytest
+
+from zip_tail_solver import CENTRAL_DIRECTORY_SIGNATURE, END_OF_CENTRAL_DIRECTORY_SIGNATURE, zip_tail_candidates
+
+MEMBERS = {
+    'notes.txt': (zipfile.ZIP_DEFLATED, b'hello world ' * 50),
+    'data.bin': (zipfile.ZIP_STORED, bytes(random.Random(1).randrange(256) for _ in range(300))),
+}
+
+
+def build_archive(names):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for name in names:
+            method, data = MEMBERS[name]
+            info = zipfile.ZipInfo(name, (2024, 1, 2, 3, 4, 6))
+            info.compress_type = method
+            archive.writestr(info, data)
+    return buffer.getvalue()
+
+
+def read_members(archive):
+    """Returns the content of every member, or None if the archive is not valid"""
+    try:
+        with zipfile.ZipFile(io.BytesIO(archive)) as z:
+            return {info.filename: z.read(info) for info in z.infolist()}
+    except (zipfile.BadZipFile, ValueError):
+        return None
+
+
+@pytest.mark.parametrize('last', ['notes.txt', 'data.bin'])
+@pytest.mark.parametrize('structure, offset', [(END_OF_CENTRAL_DIRECTORY_SIGNATURE, 12),
+                                               (END_OF_CENTRAL_DIRECTORY_SIGNATURE, 0),
+                                               (CENTRAL_DIRECTORY_SIGNATURE, 10),
+                                               (CENTRAL_DIRECTORY_SIGNATURE, 0)])
+def test_lost_structures_are_rebuilt_into_one_tail(last, structure, offset):
+    names = [name for name in MEMBERS if name != last] + [last]
+    archive = build_archive(names)
+    cut = archive.find(structure) + offset
+    candidates = list(zip_tail_candidates(archive[:cut]))
+    assert len(candidates) == 1
+    assert read_members(archive[:cut] + candidates[0]) == {name: MEMBERS[name][1] for name in names}
+
+
+def test_lost_stored_data_is_solved_from_the_crc():
+    archive = build_archive(['notes.txt', 'data.bin'])
+    cut = archive.find(CENTRAL_DIRECTORY_SIGNATURE) - 3
+    candidates = list(zip_tail_candidates(archive[:cut]))
+    # Three lost bytes have at most one value with the CRC-32 of the member
+    assert len(candidates) == 1
+    assert candidates[0][:3] == archive[cut:cut + 3]
+    assert read_members(archive[:cut] + candidates[0]) == {name: data for name, (_, data) in MEMBERS.items()}
+
+
+def test_lost_deflate_data_is_enumerated():
+    archive = build_archive(['data.bin', 'notes.txt'])
+    data_end = archive.find(CENTRAL_DIRECTORY_SIGNATURE)
+    candidates = list(zip_tail_candidates(archive[:data_end - 2]))
+    assert len(candidates) == 1 << 16
+    candidate = next(candidate for candidate in candidates if candidate[:2] == archive[data_end - 2:data_end])
+    assert read_members(archive[:data_end - 2] + candidate) == {name: data for name, (_, data) in MEMBERS.items()}
+    assert list(zip_tail_candidates(archive[:data_end - 3], max_free_bytes=2)) == []
@@ -0,0 +1,171 @@
+import argparse
+import json
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+from file_processing import compute_hash_opened_file, copy_prefix, get_file_extension
+from input_parser import accepted_extensions
+
+
+def parse_truncations(text):
+    """Parses a list of truncation lengths like '1-4,8,16'
+
+    :param text: Comma separated lengths and inclusive ranges of lengths
+    :return: The sorted list of the lengths
+    :raise ValueError: If a length is not a positive integer
+    """
+    truncations = set()
+    for part in text.split(','):
+        first, _, last = part.strip().partition('-')
+        first = int(first)
+        last = int(last) if last else first
+        if first < 1 or last < first:
+            raise ValueError(f"{part!r} is not a positive length or range of lengths")
+        truncations.update(range(first, last + 1))
+    return sorted(truncations)
+
+
+def find_archives(paths):
+    """Returns the archives among paths and inside the directories of paths, with the name their truncated copies
+    are based on: the path relative to the directory it was found in, with the separators replaced by '__'
+
+    :param paths: Names of archives and of directories that are searched recursively
+    :return: A sorted list of (archive, base name) tuples
+    """
+    archives = []
+    for path in paths:
+        if not os.path.isdir(path):
+            archives.append((path, os.path.basename(path)))
+            continue
+        for directory, _, file_names in os.walk(path):
+            for file_name in file_names:
+                if get_file_extension(file_name).lower() in accepted_extensions:
+                    archive = os.path.join(directory, file_name)
+                    archives.append((archive, os.path.relpath(archive, path).replace(os.sep, '__')))
+    return sorted(archives)
+
+
+def hash_members(task):
+    """Computes the hash of the members of an archive, streaming every member with large reads
+
+    :param task: A tuple (archive, hash method, password, names of the members or None for every file member)
+    :return: A tuple (archive, list of (member, hash)) where the list is None if the archive can't be read
+    """
+    archive, hash_method, password, member_names = task
+    pwd = None if password is None else password.encode('utf-8')
+    try:
+        with accepted_extensions[get_file_extension(archive).lower()](archive) as a:
+            if member_names is None:
+                member_names = [info.filename for info in a.infolist() if not info.is_dir()]
+            hashes = []
+            for member_name in member_names:
+                if member_name not in a.namelist():
+                    continue
+                with a.open(member_name, pwd=pwd) as f:
+                    hashes.append((member_name, compute_hash_opened_file(f, hash_method)))
+            return archive, hashes
+    except Exception as e:
+        print(f"{archive} can't be read: {e}")
+        return archive, None
+
+
+def write_truncated_copy(task):
+    """Writes a copy of an archive without its last bytes and reads the bytes that were removed
+
+    :param task: A tuple (archive, destination, number of bytes removed)
+    :return: A tuple (archive, destination, number of bytes removed, removed bytes, bytes copied by the kernel)
+    """
+    archive, destination, truncation = task
+    size = os.path.getsize(archive)
+    kernel_copied = copy_prefix(archive, destination, size - truncation)
+    with open(archive, 'rb') as f:
+        f.seek(size - truncation)
+        tail = f.read()
+    return archive, destination, truncation, tail, kernel_copied
+
+
+def generate_vectors(paths, output_directory, truncations, hash_method='sha256', workers=None, password=None,
+                     member_names=None):
+    """Writes the truncated copies of the archives of a corpus, every one with the hashes of its members and the
+    tail that was removed from it. The members are hashed once per archive and the copies and the hashes are
+    made by a pool of processes.
+    The output directory gets a manifest.txt that batch_search.py reads (one '<hash>  <archive>:<member>' line
+    per member of every copy) and a vectors.jsonl file with one test vector per line: the truncated archive, the
+    member, its hash and the true tail.
+
+    :param paths: Names of archives and of directories with archives
+    :param output_directory: The directory where the copies, the manifest and the vectors are written
+    :param truncations: The numbers of bytes removed from the end of every archive
+    :param hash_method: The hash method of the members (any hashlib method e.g. 'md5') (default 'sha256')
+    :param workers: The number of processes (default None: one per CPU)
+    :param password: String representation of the password of the encrypted members (default None)
+    :param member_names: The names of the members that are hashed (default None: every file member)
+    :return: A dictionary with the statistics of the generation
+    """
+    start_time = time.monotonic()
+    os.makedirs(output_directory, exist_ok=True)
+    # The copies of a previous run are not archives of the corpus
+    archives = [(archive, base_name) for archive, base_name in find_archives(paths)
+                if os.path.dirname(os.path.abspath(archive)) != os.path.abspath(output_directory)]
+    copy_tasks = []
+    for archive, base_name in archives:
+        size = os.path.getsize(archive)
+        stem, extension = os.path.splitext(base_name)
+        for truncation in truncations:
+            if truncation < size:
+                copy_tasks.append((archive, os.path.join(output_directory, f"{stem}-t{truncation}{extension}"),
+                                   truncation))
+    vectors = 0
+    copied_bytes = 0
+    kernel_copied_bytes = 0
+    with Pool(workers) as pool:
+        # The copies are written while the members are hashed
+        copies = pool.imap_unordered(write_truncated_copy, copy_tasks, chunksize=16)
+        member_hashes = dict(pool.imap_unordered(hash_members, [(archive, hash_method, password, member_names)
+                                                                for archive, _ in archives]))
+        with open(os.path.join(output_directory, 'manifest.txt'), 'w', encoding='utf-8') as manifest, \
+                open(os.path.join(output_directory, 'vectors.jsonl'), 'w', encoding='utf-8') as vectors_file:
+            manifest.write(f"# {hash_method} hashes of the members of the truncated archives\n")
+            for archive, destination, truncation, tail, kernel_copied in copies:
+                copied_bytes += os.path.getsize(destination)
+                kernel_copied_bytes += kernel_copied
+                name = os.path.basename(destination)
+                for member_name, member_hash in member_hashes[archive] or []:
+                    manifest.write(f"{member_hash}  {name}:{member_name}\n")
+                    vectors_file.write(json.dumps({'archive': name, 'source': archive, 'member': member_name,
+                                                   'hash_method': hash_method, 'hash': member_hash,
+                                                   'truncation': truncation, 'tail': tail.hex()}) + '\n')
+                    vectors += 1
+    return {'archives': len(archives), 'copies': len(copy_tasks), 'vectors': vectors, 'copied_bytes': copied_bytes,
+            'kernel_copied_bytes': kernel_copied_bytes, 'elapsed_seconds': time.monotonic() - start_time}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Builds a corpus of test vectors from archives: truncated copies of every archive, the hashes "
+                    "of their members (in a manifest for batch_search.py) and the tails that were removed")
+    parser.add_argument('paths', nargs='+', help="Archives and directories searched recursively for archives")
+    parser.add_argument('--output-directory', required=True,
+                        help="The directory where the truncated copies, manifest.txt and vectors.jsonl are written")
+    parser.add_argument('--truncate', default='1-4',
+                        help="The numbers of bytes removed from every archive, e.g. 1-4,8,16 (default 1-4)")
+    parser.add_argument('--hash-method', default='sha256', help="Any hashlib method (default sha256)")
+    parser.add_argument('--members', default=None,
+                        help="Comma separated names of the members that are hashed (default: every file member)")
+    parser.add_argument('--password', default=None, help="The password of the encrypted members")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="The number of processes (default: one per CPU)")
+    arguments = parser.parse_args()
+
+    try:
+        truncations = parse_truncations(arguments.truncate)
+    except ValueError as e:
+        parser.error(f"--truncate: {e}")
+    result = generate_vectors(arguments.paths, arguments.output_directory, truncations, arguments.hash_method,
+                              arguments.workers, arguments.password,
+                              None if arguments.members is None else arguments.members.split(','))
+    result['elapsed_seconds'] = round(result['elapsed_seconds'], 6)
+    print(json.dumps(result))
+    sys.exit(0 if result['vectors'] else 1)
@@ -0,0 +1,129 @@
+from multiprocessing import Array, Lock
+
+# The shared slots hold signed 64 bit integers
+MAX_KEYSPACE_SIZE = 2 ** 63 - 1
+# The fields of a segment in the shared array: the index of its candidate source, the tail length,
+# the next candidate index that was not handed out and the upper limit of the segment
+SEGMENT_FIELDS = 4
+
+
+class WorkScheduler:
+    """Hands out chunks of candidates (source, length, start, stop) to the workers of a pool that lives
+    for the whole search.
+    The keyspace is a list of segments in priority order (shorter tails first). Chunks are taken from the
+    first segment that is not exhausted, or round-robin from the first interleave ones, so the more likely
+    candidates of longer tails can be tried before the shorter tails are exhausted. The chunk size is a
+    fraction of what is left in the segment (between min_chunk and max_chunk), so chunks get smaller towards
+    the end of every segment and no worker is left with a big chunk when the others are done.
+    The shared lock is taken once per chunk and never per candidate.
+    """
+
+    def __init__(self, segments, number_of_workers, interleave=1, min_chunk=16, max_chunk=4096, chunk_divider=8):
+        """
+        :param segments: A list of (source index, length, start, stop) tuples in the order they are searched
+        :param number_of_workers: The number of workers that will ask for chunks
+        :param interleave: The number of segments the chunks are taken from in turn (default 1: one after the other)
+        :param min_chunk: The minimum number of candidates in a chunk (default 16)
+        :param max_chunk: The maximum number of candidates in a chunk (default 4096)
+        :param chunk_divider: Every worker gets 1/chunk_divider of its share of what is left in the segment
+            (default 8)
+        """
+        segments = [segment for segment in segments if segment[3] > segment[2]]
+        if any(stop > MAX_KEYSPACE_SIZE for _, _, _, stop in segments):
+            raise ValueError(f"The keyspace is too big to be scheduled (more than {MAX_KEYSPACE_SIZE} candidates)")
+        self.number_of_segments = len(segments)
+        self.number_of_workers = number_of_workers
+        self.interleave = max(1, interleave)
+        self.min_chunk = min_chunk
+        self.max_chunk = max_chunk
+        self.chunk_divider = chunk_divider
+        self._lock = Lock()
+        self._segments = Array('q', SEGMENT_FIELDS * max(1, self.number_of_segments), lock=False)
+        for i, segment in enumerate(segments):
+            self._segments[SEGMENT_FIELDS * i:SEGMENT_FIELDS * (i + 1)] = list(segment)
+        # The index of the first segment that is not exhausted and the turn of the interleaving
+        self._state = Array('q', 2, lock=False)
+
+    def _segment_left(self, i):
+        return self._segments[SEGMENT_FIELDS * i + 3] - self._segments[SEGMENT_FIELDS * i + 2]
+
+    def remaining(self):
+        """Returns the number of candidates that were not handed out yet"""
+        with self._lock:
+            return sum(self._segment_left(i) for i in range(self._state[0], self.number_of_segments))
+
+    def cancel(self, source_indexes):
+        """Drops the candidates of the given sources that were not handed out yet (e.g. when the archive
+        they rebuild was solved)
+
+        :param source_indexes: A collection of source indexes
+        """
+        with self._lock:
+            for i in range(self.number_of_segments):
+                if self._segments[SEGMENT_FIELDS * i] in source_indexes:
+                    self._segments[SEGMENT_FIELDS * i + 2] = self._segments[SEGMENT_FIELDS * i + 3]
+
+    def truncate(self, source_index, length, start, source_indexes=None):
+        """Drops the candidates that were not handed out yet and come after a candidate index in the order of
+        the search (by source index, then by length, then by index), e.g. when that candidate rebuilt the archive.
+        The candidates before it are still handed out
+
+        :param source_index: The source index of the candidate
+        :param length: The tail length of the candidate
+        :param start: The index of the candidate
+        :param source_indexes: The sources whose candidates are dropped, e.g. the sources of one archive of a batch
+            (default None: every source)
+        """
+        with self._lock:
+            for i in range(self.number_of_segments):
+                offset = SEGMENT_FIELDS * i
+                segment_source, segment_length, segment_next, segment_stop = \
+                    self._segments[offset:offset + SEGMENT_FIELDS]
+                if source_indexes is not None and segment_source not in source_indexes:
+                    continue
+                if (segment_source, segment_length) > (source_index, length):
+                    self._segments[offset + 3] = segment_next
+                elif (segment_source, segment_length) == (source_index, length) and segment_stop > start:
+                    self._segments[offset + 3] = max(segment_next, start)
+
+    def front(self):
+        """Returns the (source index, length) of the first segment that is not exhausted and the number of
+        candidates of that source and length that were not handed out yet, or None when the keyspace is exhausted
+        """
+        with self._lock:
+            first = self._state[0]
+            while first < self.number_of_segments and self._segment_left(first) <= 0:
+                first += 1
+            if first == self.number_of_segments:
+                return None
+            source_index, length = self._segments[SEGMENT_FIELDS * first:SEGMENT_FIELDS * first + 2]
+            left = sum(self._segment_left(i) for i in range(first, self.number_of_segments)
+                       if self._segments[SEGMENT_FIELDS * i:SEGMENT_FIELDS * i + 2] == [source_index, length])
+            return source_index, length, left
+
+    def next_chunk(self):
+        """Returns the next chunk of candidates
+
+        :return: A tuple (source index, length, start, stop) or None when the whole keyspace was handed out
+        """
+        with self._lock:
+            first = self._state[0]
+            while first < self.number_of_segments and self._segment_left(first) <= 0:
+                first += 1
+            self._state[0] = first
+            window = []
+            for i in range(first, self.number_of_segments):
+                if len(window) == self.interleave:
+                    break
+                if self._segment_left(i) > 0:
+                    window.append(i)
+            if not window:
+                return None
+            segment = window[self._state[1] % len(window)]
+            self._state[1] += 1
+            offset = SEGMENT_FIELDS * segment
+            source_index, length, start, stop = self._segments[offset:offset + SEGMENT_FIELDS]
+            share = (stop - start) // (self.chunk_divider * self.number_of_workers)
+            chunk_stop = min(stop, start + min(self.max_chunk, max(self.min_chunk, share)))
+            self._segments[offset + 2] = chunk_stop
+            return source_index, length, start, chunk_stop
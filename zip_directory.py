@@ -0,0 +1,174 @@
+import bisect
+import io
+import zipfile
+from collections import ChainMap
+
+from zip_tail_solver import CENTRAL_DIRECTORY_SIGNATURE, CENTRAL_DIRECTORY_STRUCT, \
+    END_OF_CENTRAL_DIRECTORY_SIGNATURE, END_OF_CENTRAL_DIRECTORY_STRUCT, ZIP64_LIMIT
+
+# zipfile reads a ZIP64 archive when this locator is right before the End of Central Directory record
+ZIP64_LOCATOR_SIGNATURE = b'PK\x06\x07'
+ZIP64_LOCATOR_SIZE = 20
+
+
+def central_directory_record_ends(buffer, start, stop):
+    """Returns the end positions of the central directory records that follow each other from start and lie
+    entirely before stop
+
+    :param buffer: A bytes-like object
+    :param start: The position of the first record
+    :param stop: The position the records must end before
+    """
+    ends = []
+    position = start
+    while position + CENTRAL_DIRECTORY_STRUCT.size <= stop and \
+            buffer[position:position + 4] == CENTRAL_DIRECTORY_SIGNATURE:
+        fields = CENTRAL_DIRECTORY_STRUCT.unpack_from(buffer, position)
+        end = position + CENTRAL_DIRECTORY_STRUCT.size + fields[10] + fields[11] + fields[12]
+        if end > stop:
+            break
+        ends.append(end)
+        position = end
+    return ends
+
+
+def parse_central_directory(data):
+    """Parses central directory records with zipfile, so the ZipInfo objects are exactly the ones it builds.
+    The records are followed by an End of Central Directory record that makes them a directory of their own,
+    so the header offsets are the ones written in the records.
+
+    :param data: The bytes of the records
+    :return: A list of ZipInfo objects
+    """
+    end_record = END_OF_CENTRAL_DIRECTORY_STRUCT.pack(END_OF_CENTRAL_DIRECTORY_SIGNATURE, 0, 0, 0, 0, len(data), 0, 0)
+    with zipfile.ZipFile(io.BytesIO(bytes(data) + end_record)) as z:
+        infos = z.filelist
+    for info in infos:
+        # Newer versions of zipfile bound every member by the next header or the directory position, which is
+        # the position of the records in data here and not in the archive
+        if getattr(info, '_end_offset', None) is not None:
+            info._end_offset = None
+    return infos
+
+
+class ZipDirectoryCache:
+    """The central directory of a truncated ZIP archive, parsed once.
+    The records that lie entirely in the prefix are parsed the first time the End of Central Directory record
+    of a candidate points at them and are kept as ZipInfo objects (with their name table), so a candidate
+    only has the records written in its tail parsed. For archives with many members this replaces the
+    parse of the whole directory by zipfile for every candidate.
+    """
+
+    def __init__(self, prefix):
+        """
+        :param prefix: A bytes-like object with the truncated archive
+        """
+        self.prefix = prefix
+        # The (ZipInfo list, end positions) chain of records every record start of the prefix belongs to,
+        # with the index of the record in the chain
+        self._records = {}
+        # The (start, stop) of the last prefix records returned, with their ZipInfo list and name table
+        self._last = None
+
+    def _prefix_records(self, start):
+        """Returns the chain of the records that start at start and its index in the chain, None when start is not
+        the position of a record entirely in the prefix, or False when zipfile can't parse the records
+        """
+        if start not in self._records:
+            ends = central_directory_record_ends(self.prefix, start, len(self.prefix))
+            if not ends:
+                return None
+            try:
+                infos = parse_central_directory(memoryview(self.prefix)[start:ends[-1]])
+            except (zipfile.BadZipFile, NotImplementedError, ValueError):
+                return False
+            chain = (infos, ends)
+            for index, record_start in enumerate([start] + ends[:-1]):
+                self._records.setdefault(record_start, (chain, index))
+        return self._records[start]
+
+    def _prefix_directory(self, start, stop, concat):
+        """Returns the ZipInfo list and the name table of the records of the prefix that lie between start and stop,
+        with the position where they end, or None when the cached records can't be used
+        """
+        if concat:
+            # The archive is preceded by data its offsets don't account for. zipfile shifts every header offset,
+            # which would need a copy of every record: that is rare enough to leave it to zipfile
+            return None
+        last = self._last
+        if last is not None and last[:2] == (start, stop):
+            return last[2:]
+        records = self._prefix_records(start) if start < len(self.prefix) else None
+        if records is False:
+            return None
+        infos = []
+        end = start
+        if records is not None:
+            (chain_infos, ends), index = records
+            last_index = bisect.bisect_right(ends, stop, lo=index)
+            infos = chain_infos[index:last_index]
+            if last_index > index:
+                end = ends[last_index - 1]
+        directory = (infos, {info.filename: info for info in infos}, end)
+        self._last = (start, stop) + directory
+        return directory
+
+    def read(self, candidate, start, stop, concat):
+        """Returns the table of contents of a rebuilt archive, like zipfile reads it
+
+        :param candidate: The file object of the rebuilt archive
+        :param start: The position of the central directory
+        :param stop: The position right after the central directory
+        :param concat: The number of bytes before the archive that its offsets don't account for
+        :return: A tuple (filelist, NameToInfo) or None when zipfile has to parse the directory itself
+        """
+        directory = self._prefix_directory(start, stop, concat)
+        if directory is None:
+            return None
+        infos, names, end = directory
+        if end == stop:
+            return infos, names
+        # The records written (or cut) by the tail
+        candidate.seek(end)
+        tail_infos = parse_central_directory(candidate.read(stop - end))
+        # The later records win when two members have the same name, like in zipfile
+        return infos + tail_infos, ChainMap({info.filename: info for info in tail_infos}, names)
+
+
+class CachedZipFile(zipfile.ZipFile):
+    """A ZipFile opened for reading whose table of contents comes from a ZipDirectoryCache instead of being parsed
+    from the file. The End of Central Directory record was already read (and checked) by the verifier.
+    """
+
+    def __init__(self, file, directory, end_record):
+        """
+        :param file: The file object of the rebuilt archive
+        :param directory: The ZipDirectoryCache of the archive prefix
+        :param end_record: The (position, entries, central directory size, central directory offset,
+            comment length) of the End of Central Directory record
+        """
+        self._directory = directory
+        self._end_record = end_record
+        super().__init__(file)
+
+    def _RealGetContents(self):
+        position, entries, size, offset, comment_length = self._end_record
+        if self._end_record_is_zip64():
+            return super()._RealGetContents()
+        self.fp.seek(position + END_OF_CENTRAL_DIRECTORY_STRUCT.size)
+        comment = self.fp.read(comment_length)
+        contents = self._directory.read(self.fp, position - size, position, position - size - offset)
+        if contents is None:
+            return super()._RealGetContents()
+        self._comment = comment
+        self.start_dir = position - size
+        self.filelist, self.NameToInfo = contents
+
+    def _end_record_is_zip64(self):
+        position, entries, size, offset, _ = self._end_record
+        if entries == 0xFFFF or ZIP64_LIMIT in (size, offset):
+            return True
+        if position < ZIP64_LOCATOR_SIZE:
+            return False
+        self.fp.seek(position - ZIP64_LOCATOR_SIZE)
+        return self.fp.read(len(ZIP64_LOCATOR_SIGNATURE)) == ZIP64_LOCATOR_SIGNATURE
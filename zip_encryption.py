@@ -0,0 +1,170 @@
+import hashlib
+import hmac
+import struct
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    # Optional: without it the WinZip AES members are only verified up to their authentication code
+    Cipher = None
+
+from zip_tail_solver import LOCAL_HEADER_SIGNATURE, LOCAL_HEADER_STRUCT, DATA_DESCRIPTOR_STRUCT, \
+    DATA_DESCRIPTOR_FLAG, ENCRYPTED_FLAG, find_data_descriptor
+from zipcrypto import ZipCryptoKeys, ENCRYPTION_HEADER_SIZE
+
+# Bit 11 of the flags tells that the member name is encoded with UTF-8 (cp437 otherwise)
+UTF8_NAME_FLAG = 0x800
+# The compression method of the members encrypted with WinZip AES. The real method is in the AES extra field
+AES_METHOD = 99
+AES_EXTRA_ID = 0x9901
+EXTRA_HEADER_STRUCT = struct.Struct('<HH')
+# version (1: AE-1 keeps the CRC-32, 2: AE-2 does not), vendor id, strength, real compression method
+AES_EXTRA_STRUCT = struct.Struct('<H2sBH')
+# The (key length, salt length) of every AES strength
+AES_STRENGTHS = {1: (16, 8), 2: (24, 12), 3: (32, 16)}
+AES_VERIFIER_SIZE = 2
+AES_AUTHENTICATION_CODE_SIZE = 10
+AES_ITERATIONS = 1000
+AES_BLOCK_SIZE = 16
+
+
+def zipcrypto_check_byte(flags, crc, time):
+    """Returns the byte the last byte of a decrypted ZipCrypto encryption header must be equal to:
+    the high byte of the CRC-32, or of the modification time when the CRC-32 is in a data descriptor
+    """
+    if flags & DATA_DESCRIPTOR_FLAG:
+        return (time >> 8) & 0xFF
+    return crc >> 24
+
+
+def aes_extra_field(extra):
+    """Returns the (version, strength, compression method) of the AES extra field or None if there is none
+
+    :param extra: The extra field of a local header or of a central directory record
+    """
+    position = 0
+    while position + EXTRA_HEADER_STRUCT.size <= len(extra):
+        header_id, size = EXTRA_HEADER_STRUCT.unpack_from(extra, position)
+        position += EXTRA_HEADER_STRUCT.size
+        if header_id == AES_EXTRA_ID and size >= AES_EXTRA_STRUCT.size and position + size <= len(extra):
+            version, _, strength, method = AES_EXTRA_STRUCT.unpack_from(extra, position)
+            if strength not in AES_STRENGTHS:
+                return None
+            return version, strength, method
+        position += size
+    return None
+
+
+class AesKeys:
+    """The keys WinZip AES derives from the password and the salt of a member.
+    The derivation (PBKDF2 with 1000 rounds of HMAC-SHA1) is the expensive part, so it is done once per member.
+    """
+
+    def __init__(self, password, salt, strength):
+        """
+        :param password: The password as a byte string
+        :param salt: The salt written before the encrypted data
+        :param strength: The AES strength of the member (1, 2 or 3 for 128, 192 or 256 bit keys)
+        """
+        key_length = AES_STRENGTHS[strength][0]
+        derived = hashlib.pbkdf2_hmac('sha1', password, salt, AES_ITERATIONS, 2 * key_length + AES_VERIFIER_SIZE)
+        self.encryption_key = derived[:key_length]
+        self.authentication_key = derived[key_length:2 * key_length]
+        self.verifier = derived[2 * key_length:]
+
+    def authenticator(self):
+        """Returns the HMAC-SHA1 object whose digest (truncated) authenticates the encrypted data"""
+        return hmac.new(self.authentication_key, digestmod=hashlib.sha1)
+
+    def decrypt(self, data, offset=0):
+        """Decrypts a part of the encrypted data (AES in counter mode, with a little-endian counter starting at 1)
+
+        :param data: The encrypted bytes
+        :param offset: The position of data in the encrypted data
+        :return: The decrypted bytes
+        """
+        if Cipher is None:
+            raise NotImplementedError("Decrypting WinZip AES members requires the cryptography package")
+        first_block, skip = divmod(offset, AES_BLOCK_SIZE)
+        blocks = (skip + len(data) + AES_BLOCK_SIZE - 1) // AES_BLOCK_SIZE
+        counters = b''.join((first_block + i + 1).to_bytes(AES_BLOCK_SIZE, 'little') for i in range(blocks))
+        encryptor = Cipher(algorithms.AES(self.encryption_key), modes.ECB()).encryptor()
+        key_stream = encryptor.update(counters)[skip:skip + len(data)]
+        return (int.from_bytes(data, 'little') ^ int.from_bytes(key_stream, 'little')).to_bytes(len(data), 'little')
+
+
+class EncryptedMember:
+    """An encrypted member whose local header lies in a (possibly truncated) archive"""
+
+    def __init__(self, name, flags, time, crc, data_start, aes):
+        self.name = name
+        self.flags = flags
+        self.time = time
+        self.crc = crc
+        self.data_start = data_start
+        # The (version, strength, compression method) of the AES extra field, None for ZipCrypto
+        self.aes = aes
+
+
+def find_encrypted_members(buffer, file_names):
+    """Walks the local headers of a (possibly truncated) ZIP archive and returns the encrypted members among
+    file_names. The walk stops at the first member whose end can't be found.
+
+    :param buffer: The bytes of the archive
+    :param file_names: The names of the members
+    :return: A list of EncryptedMember
+    """
+    members = []
+    position = bytes(buffer[:1 << 16]).find(LOCAL_HEADER_SIGNATURE)
+    size = len(buffer)
+    while position != -1 and position + LOCAL_HEADER_STRUCT.size <= size and \
+            buffer[position:position + 4] == LOCAL_HEADER_SIGNATURE:
+        (_, _, flags, method, time, _, crc, compressed_size, _, name_length,
+         extra_length) = LOCAL_HEADER_STRUCT.unpack_from(buffer, position)
+        data_start = position + LOCAL_HEADER_STRUCT.size + name_length + extra_length
+        if data_start > size:
+            break
+        name = bytes(buffer[position + LOCAL_HEADER_STRUCT.size:position + LOCAL_HEADER_STRUCT.size + name_length])
+        name = name.decode('utf-8' if flags & UTF8_NAME_FLAG else 'cp437')
+        if flags & ENCRYPTED_FLAG and name in file_names:
+            aes = aes_extra_field(bytes(buffer[data_start - extra_length:data_start])) \
+                if method == AES_METHOD else None
+            members.append(EncryptedMember(name, flags, time, crc, data_start, aes))
+        if flags & DATA_DESCRIPTOR_FLAG:
+            descriptor = find_data_descriptor(buffer, data_start)
+            if descriptor is None:
+                break
+            position = descriptor[0] + DATA_DESCRIPTOR_STRUCT.size
+        else:
+            position = data_start + compressed_size
+    return members
+
+
+def check_password(buffer, members, password):
+    """Verifies a password against the encryption headers that lie in the buffer: the check byte of the
+    ZipCrypto members and the password verifier of the WinZip AES members
+
+    :param buffer: The bytes of the archive
+    :param members: The EncryptedMember objects of the archive
+    :param password: The password as a byte string
+    :return: False if the password is wrong for one of the members, True if it is right for at least one and
+        None if no encryption header lies in the buffer
+    """
+    result = None
+    for member in members:
+        if member.aes is None:
+            header = buffer[member.data_start:member.data_start + ENCRYPTION_HEADER_SIZE]
+            if len(header) < ENCRYPTION_HEADER_SIZE:
+                continue
+            right = ZipCryptoKeys(password).decrypt(header)[-1] == zipcrypto_check_byte(member.flags, member.crc,
+                                                                                      member.time)
+        else:
+            salt_length = AES_STRENGTHS[member.aes[1]][1]
+            header = bytes(buffer[member.data_start:member.data_start + salt_length + AES_VERIFIER_SIZE])
+            if len(header) < salt_length + AES_VERIFIER_SIZE:
+                continue
+            right = AesKeys(password, header[:salt_length], member.aes[1]).verifier == header[salt_length:]
+        if not right:
+            return False
+        result = True
+    return result
@@ -0,0 +1,376 @@
+import itertools
+import struct
+from zlib import crc32
+
+from generator import crc32_inversion_generator
+
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+CENTRAL_DIRECTORY_SIGNATURE = b'PK\x01\x02'
+END_OF_CENTRAL_DIRECTORY_SIGNATURE = b'PK\x05\x06'
+DATA_DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+
+# signature, version needed, flags, method, time, date, crc, compressed size, size, name length, extra length
+LOCAL_HEADER_STRUCT = struct.Struct('<4sHHHHHIIIHH')
+# signature, version made by, version needed, flags, method, time, date, crc, compressed size, size,
+# name length, extra length, comment length, disk number, internal attributes, external attributes, header offset
+CENTRAL_DIRECTORY_STRUCT = struct.Struct('<4sHHHHHHIIIHHHHHII')
+# signature, disk number, central directory disk, entries on disk, entries, size, offset, comment length
+END_OF_CENTRAL_DIRECTORY_STRUCT = struct.Struct('<4sHHHHIIH')
+DATA_DESCRIPTOR_STRUCT = struct.Struct('<4sIII')
+
+DATA_DESCRIPTOR_FLAG = 0x08
+ENCRYPTED_FLAG = 0x01
+STORED_METHOD = 0
+ZIP64_LIMIT = 0xFFFFFFFF
+DEFAULT_VERSION_MADE_BY = (3 << 8) | 20
+
+
+class LocalEntry:
+    """A member of a ZIP archive as described by its local file header"""
+
+    def __init__(self, offset, version, flags, method, time, date, crc, compressed_size, size, name, extra,
+                 data_start, data_end, descriptor_length):
+        self.offset = offset
+        self.version = version
+        self.flags = flags
+        self.method = method
+        self.time = time
+        self.date = date
+        self.crc = crc
+        self.compressed_size = compressed_size
+        self.size = size
+        self.name = name
+        self.extra = extra
+        self.data_start = data_start
+        self.data_end = data_end
+        self.descriptor_length = descriptor_length
+
+    @property
+    def end(self):
+        """The position right after the member data (and its data descriptor)"""
+        return self.data_end + self.descriptor_length
+
+
+class ZipLayout:
+    """What survives of a truncated ZIP archive"""
+
+    def __init__(self, size, base, entries, central_directory_start, central_directory_records,
+                 end_of_central_directory_start):
+        """
+        :param size: The size of the truncated archive
+        :param base: The position of the first local header (bigger than 0 for self-extracting archives)
+        :param entries: The list of LocalEntry objects found in the archive
+        :param central_directory_start: The position of the central directory or None if it was not reached
+        :param central_directory_records: The raw central directory records that survived entirely
+        :param end_of_central_directory_start: The position of the End of Central Directory record or None if it
+            starts after the truncation point
+        """
+        self.size = size
+        self.base = base
+        self.entries = entries
+        self.central_directory_start = central_directory_start
+        self.central_directory_records = central_directory_records
+        self.end_of_central_directory_start = end_of_central_directory_start
+
+    @property
+    def truncated_entry(self):
+        """The last entry when its data runs past the truncation point, None otherwise"""
+        if self.entries and self.entries[-1].data_end > self.size:
+            return self.entries[-1]
+        return None
+
+
+class ZipTailTemplate:
+    """The reconstructed tail of a ZIP archive.
+    Every position holds the byte value that was inferred or None when it can not be inferred.
+    """
+
+    def __init__(self, tail, layout, comment_length):
+        self.tail = tail
+        self.layout = layout
+        self.comment_length = comment_length
+
+    def __len__(self):
+        return len(self.tail)
+
+    @property
+    def free_positions(self):
+        """The positions of the bytes that could not be inferred"""
+        return [i for i, value in enumerate(self.tail) if value is None]
+
+    def candidates(self):
+        """Yields every tail that matches the template, enumerating only the bytes that could not be inferred"""
+        free_positions = self.free_positions
+        tail = bytearray(0 if value is None else value for value in self.tail)
+        for values in itertools.product(range(256), repeat=len(free_positions)):
+            for position, value in zip(free_positions, values):
+                tail[position] = value
+            yield bytes(tail)
+
+
+def find_in_buffer(buffer, sub, start=0, chunk_size=1 << 20):
+    """Search a byte string in a bytes-like object without copying all of it
+
+    :param buffer: A bytes-like object
+    :param sub: The byte string that is searched
+    :param start: The position where the search starts (default 0)
+    :param chunk_size: The size of the pieces that are copied at once (default 1 MiB)
+    :return: The position of the first occurrence or -1 if there is none
+    """
+    while start < len(buffer):
+        chunk = bytes(buffer[start:start + chunk_size + len(sub) - 1])
+        position = chunk.find(sub)
+        if position != -1:
+            return start + position
+        start += chunk_size
+    return -1
+
+
+def find_data_descriptor(buffer, data_start):
+    """Search for the data descriptor that closes the data started at data_start
+
+    :param buffer: The bytes of the archive
+    :param data_start: The position where the member data starts
+    :return: A tuple (position, crc, compressed size, size) or None if the descriptor was not found
+    """
+    position = find_in_buffer(buffer, DATA_DESCRIPTOR_SIGNATURE, data_start)
+    while position != -1 and position + DATA_DESCRIPTOR_STRUCT.size <= len(buffer):
+        _, crc, compressed_size, size = DATA_DESCRIPTOR_STRUCT.unpack_from(buffer, position)
+        if compressed_size == position - data_start:
+            return position, crc, compressed_size, size
+        position = find_in_buffer(buffer, DATA_DESCRIPTOR_SIGNATURE, position + 1)
+    return None
+
+
+def parse_local_entries(buffer):
+    """Walk the local headers of a (possibly truncated) ZIP archive
+
+    :param buffer: The bytes of the archive
+    :return: A tuple (base, list of LocalEntry, position after the last entry) or None if the archive
+        has no readable local header
+    """
+    base = bytes(buffer[:1 << 16]).find(LOCAL_HEADER_SIGNATURE)
+    if base == -1:
+        return None
+    entries = []
+    position = base
+    size = len(buffer)
+    while buffer[position:position + 4] == LOCAL_HEADER_SIGNATURE:
+        if position + LOCAL_HEADER_STRUCT.size > size:
+            return None
+        (_, version, flags, method, time, date, crc, compressed_size, file_size, name_length,
+         extra_length) = LOCAL_HEADER_STRUCT.unpack_from(buffer, position)
+        data_start = position + LOCAL_HEADER_STRUCT.size + name_length + extra_length
+        if data_start > size:
+            return None
+        name = bytes(buffer[position + LOCAL_HEADER_STRUCT.size:position + LOCAL_HEADER_STRUCT.size + name_length])
+        extra = bytes(buffer[data_start - extra_length:data_start])
+        descriptor_length = 0
+        if flags & DATA_DESCRIPTOR_FLAG:
+            descriptor = find_data_descriptor(buffer, data_start)
+            if descriptor is None:
+                # The sizes and the CRC of this member were lost with the data descriptor
+                return None
+            data_end, crc, compressed_size, file_size = descriptor
+            descriptor_length = DATA_DESCRIPTOR_STRUCT.size
+        else:
+            data_end = data_start + compressed_size
+        if ZIP64_LIMIT in (compressed_size, file_size):
+            return None
+        entries.append(LocalEntry(position, version, flags, method, time, date, crc, compressed_size, file_size,
+                                  name, extra, data_start, data_end, descriptor_length))
+        position = data_end + descriptor_length
+        if position >= size:
+            break
+    return base, entries, position
+
+
+def parse_truncated_zip(buffer):
+    """Parse what survives of a truncated ZIP archive
+
+    :param buffer: The bytes of the truncated archive
+    :return: A ZipLayout or None if the surviving part can not be understood
+    """
+    parsed = parse_local_entries(buffer)
+    if parsed is None:
+        return None
+    base, entries, position = parsed
+    size = len(buffer)
+    layout = ZipLayout(size, base, entries, None, [], None)
+    if position >= size:
+        return layout
+    if not CENTRAL_DIRECTORY_SIGNATURE.startswith(bytes(buffer[position:position + 4])):
+        return None
+    layout.central_directory_start = position
+    while buffer[position:position + 4] == CENTRAL_DIRECTORY_SIGNATURE:
+        if position + CENTRAL_DIRECTORY_STRUCT.size > size:
+            break
+        fields = CENTRAL_DIRECTORY_STRUCT.unpack_from(buffer, position)
+        record_end = position + CENTRAL_DIRECTORY_STRUCT.size + fields[10] + fields[11] + fields[12]
+        if record_end > size:
+            break
+        layout.central_directory_records.append(bytes(buffer[position:record_end]))
+        position = record_end
+    signature = bytes(buffer[position:position + 4])
+    if position < size:
+        # A cut signature can belong to both records: it is a central directory record while members are missing one
+        if signature == END_OF_CENTRAL_DIRECTORY_SIGNATURE or (
+                END_OF_CENTRAL_DIRECTORY_SIGNATURE.startswith(signature)
+                and len(layout.central_directory_records) >= len(entries)):
+            layout.end_of_central_directory_start = position
+        elif not CENTRAL_DIRECTORY_SIGNATURE.startswith(signature):
+            return None
+    return layout
+
+
+def build_central_directory_record(entry, base, model_record=None):
+    """Rebuild the central directory record of a member from its local header
+
+    :param entry: A LocalEntry
+    :param base: The position of the first local header
+    :param model_record: A surviving central directory record used for the fields that are
+        not stored in the local header (default None)
+    :return: The central directory record as a byte string
+    """
+    version_made_by = DEFAULT_VERSION_MADE_BY
+    external_attributes = 0
+    if model_record is not None:
+        model_fields = CENTRAL_DIRECTORY_STRUCT.unpack_from(model_record)
+        version_made_by = model_fields[1]
+        external_attributes = model_fields[15]
+    return CENTRAL_DIRECTORY_STRUCT.pack(CENTRAL_DIRECTORY_SIGNATURE, version_made_by, entry.version, entry.flags,
+                                         entry.method, entry.time, entry.date, entry.crc, entry.compressed_size,
+                                         entry.size, len(entry.name), 0, 0, 0, 0, external_attributes,
+                                         entry.offset - base) + entry.name
+
+
+def merge_partial_record(record, partial, entry):
+    """Complete a central directory record that was cut by the truncation.
+    The surviving fixed fields decide the length of the variable fields. The name and the extra field
+    are copied from the local header when their lengths match, otherwise they can not be inferred.
+
+    :param record: The record rebuilt from the local header
+    :param partial: The surviving bytes of the record
+    :param entry: The LocalEntry of the member
+    :return: A list with the value of every byte of the record (None when it can not be inferred)
+    """
+    fixed = bytearray(record[:CENTRAL_DIRECTORY_STRUCT.size])
+    known = min(len(partial), CENTRAL_DIRECTORY_STRUCT.size)
+    fixed[:known] = partial[:known]
+    name_length, extra_length, comment_length = struct.unpack_from('<HHH', fixed, 28)
+    merged = list(fixed)
+    merged += list(entry.name) if name_length == len(entry.name) else [None] * name_length
+    merged += list(entry.extra) if extra_length == len(entry.extra) else [None] * extra_length
+    merged += [None] * comment_length
+    merged[:len(partial)] = list(partial)
+    return merged
+
+
+def build_tail_template(buffer, comment_length=0):
+    """Rebuild the missing tail of a truncated ZIP archive.
+    The End of Central Directory record is recomputed from the central directory, and the central directory
+    records that were lost are rebuilt from the local headers. Bytes of member data that were lost can not
+    be inferred.
+
+    :param buffer: The bytes of the truncated archive
+    :param comment_length: The archive comment length to assume when the comment length field was lost (default 0)
+    :return: A ZipTailTemplate or None if the archive can not be understood
+    """
+    layout = parse_truncated_zip(buffer)
+    if layout is None or not layout.entries:
+        return None
+    size = layout.size
+    entries = layout.entries
+    records = layout.central_directory_records
+    model_record = records[-1] if records else None
+
+    # The bytes of the archive from the first structure that was cut by the truncation until the end
+    reconstruction = []
+    truncated_entry = layout.truncated_entry
+    if truncated_entry is not None:
+        if truncated_entry.descriptor_length:
+            return None
+        reconstruction_start = size
+        reconstruction += [None] * (truncated_entry.data_end - size)
+        central_directory_start = truncated_entry.data_end
+    elif layout.central_directory_start is None:
+        reconstruction_start = size
+        central_directory_start = entries[-1].end
+    else:
+        central_directory_start = layout.central_directory_start
+        reconstruction_start = central_directory_start + sum(len(record) for record in records)
+
+    if layout.end_of_central_directory_start is None:
+        if len(records) > len(entries):
+            return None
+        position = central_directory_start + sum(len(record) for record in records)
+        for index in range(len(records), len(entries)):
+            record = build_central_directory_record(entries[index], layout.base, model_record)
+            if position < size:
+                # The record was cut by the truncation
+                record = merge_partial_record(record, bytes(buffer[position:size]), entries[index])
+            reconstruction += list(record)
+            position += len(record)
+        records_count = len(entries)
+        end_of_central_directory_start = position
+    else:
+        records_count = len(records)
+        end_of_central_directory_start = layout.end_of_central_directory_start
+        reconstruction_start = end_of_central_directory_start
+    if records_count >= 0xFFFF or central_directory_start - layout.base >= ZIP64_LIMIT:
+        return None
+
+    known_end_record = bytes(buffer[end_of_central_directory_start:size])
+    if len(known_end_record) >= END_OF_CENTRAL_DIRECTORY_STRUCT.size:
+        comment_length = struct.unpack_from('<H', known_end_record, 20)[0]
+    elif len(known_end_record) == END_OF_CENTRAL_DIRECTORY_STRUCT.size - 1:
+        comment_length = known_end_record[20]
+    reconstruction += list(END_OF_CENTRAL_DIRECTORY_STRUCT.pack(
+        END_OF_CENTRAL_DIRECTORY_SIGNATURE, 0, 0, records_count, records_count,
+        end_of_central_directory_start - central_directory_start, central_directory_start - layout.base,
+        comment_length))
+    reconstruction += [None] * comment_length
+    tail = reconstruction[size - reconstruction_start:]
+    return ZipTailTemplate(tail, layout, comment_length)
+
+
+def stored_data_candidates(buffer, template):
+    """Yields the tails of a template whose free bytes are all lost data of a stored member.
+    The free bytes are solved from the CRC-32 of the member instead of being enumerated.
+
+    :param buffer: The bytes of the truncated archive
+    :param template: The ZipTailTemplate of the archive
+    :raise ValueError: If the free bytes have too many solutions
+    """
+    entry = template.layout.truncated_entry
+    data_size = entry.data_end - template.layout.size
+    tail = bytes(0 if value is None else value for value in template.tail)
+    crc = crc32(memoryview(buffer)[entry.data_start:])
+    for data in crc32_inversion_generator(tail[:data_size], template.free_positions, crc, entry.crc):
+        yield data + tail[data_size:]
+
+
+def zip_tail_candidates(buffer, max_free_bytes=2):
+    """Yields the tails rebuilt by the solver for a truncated ZIP archive.
+    When the bytes that can not be inferred are the end of a stored member they are solved from its CRC-32,
+    otherwise only those bytes are enumerated.
+
+    :param buffer: The bytes of the truncated archive
+    :param max_free_bytes: The maximum number of bytes that will be enumerated (default 2)
+    """
+    template = build_tail_template(buffer)
+    if template is None:
+        return
+    free_positions = template.free_positions
+    entry = template.layout.truncated_entry
+    if free_positions and entry is not None and entry.method == STORED_METHOD and \
+            not entry.flags & ENCRYPTED_FLAG and entry.compressed_size == entry.size and \
+            free_positions[-1] < entry.data_end - template.layout.size:
+        try:
+            yield from stored_data_candidates(buffer, template)
+            return
+        except ValueError:
+            pass
+    if len(free_positions) > max_free_bytes:
+        return
+    yield from template.candidates()
@@ -0,0 +1,114 @@
+import os
+import zipfile
+
+from crc32_math import CRC_TABLE
+from zip_tail_solver import (LOCAL_HEADER_STRUCT, CENTRAL_DIRECTORY_STRUCT, END_OF_CENTRAL_DIRECTORY_STRUCT,
+                             CENTRAL_DIRECTORY_SIGNATURE, END_OF_CENTRAL_DIRECTORY_SIGNATURE)
+
+ENCRYPTION_HEADER_SIZE = 12
+ENCRYPTED_FLAG = 0x01
+DATA_DESCRIPTOR_FLAG = 0x08
+COPY_SIZE = 1 << 20
+
+
+class ZipCryptoKeys:
+    """The three keys of the traditional PKWARE encryption (ZipCrypto)"""
+
+    def __init__(self, password=b''):
+        """
+        :param password: The password as a byte string
+        """
+        self.key0, self.key1, self.key2 = 0x12345678, 0x23456789, 0x34567890
+        for byte in password:
+            self.update_keys(byte)
+
+    def copy(self):
+        keys = ZipCryptoKeys.__new__(ZipCryptoKeys)
+        keys.key0, keys.key1, keys.key2 = self.key0, self.key1, self.key2
+        return keys
+
+    def update_keys(self, byte):
+        self.key0 = (self.key0 >> 8) ^ CRC_TABLE[(self.key0 ^ byte) & 0xFF]
+        self.key1 = ((self.key1 + (self.key0 & 0xFF)) * 134775813 + 1) & 0xFFFFFFFF
+        self.key2 = (self.key2 >> 8) ^ CRC_TABLE[(self.key2 ^ (self.key1 >> 24)) & 0xFF]
+
+    def stream_byte(self):
+        temp = (self.key2 | 2) & 0xFFFF
+        return ((temp * (temp ^ 1)) >> 8) & 0xFF
+
+    def encrypt(self, data):
+        """Encrypts a byte string and advances the keys"""
+        result = bytearray(len(data))
+        for i, byte in enumerate(data):
+            result[i] = byte ^ self.stream_byte()
+            self.update_keys(byte)
+        return bytes(result)
+
+    def decrypt(self, data):
+        """Decrypts a byte string and advances the keys"""
+        result = bytearray(len(data))
+        for i, byte in enumerate(data):
+            byte ^= self.stream_byte()
+            self.update_keys(byte)
+            result[i] = byte
+        return bytes(result)
+
+
+def encrypt_archive(archive, encrypted_archive, password, random_bytes=None):
+    """Writes a copy of a ZIP archive where every member is encrypted with ZipCrypto
+    (zipfile can read such archives but can not write them).
+    The members are copied without being decompressed. ZIP64 archives are not supported.
+
+    :param archive: The name of the ZIP archive
+    :param encrypted_archive: The name of the encrypted copy
+    :param password: The password as a byte string
+    :param random_bytes: A function returning n random bytes for the encryption headers (default os.urandom)
+    """
+    if random_bytes is None:
+        random_bytes = os.urandom
+    with zipfile.ZipFile(archive) as z, open(archive, 'rb') as source, open(encrypted_archive, 'wb') as destination:
+        infos = z.infolist()
+        comment = z.comment
+        for info in infos:
+            source.seek(info.header_offset)
+            (signature, version, flags, method, time, date, crc, compressed_size, size, name_length,
+             extra_length) = LOCAL_HEADER_STRUCT.unpack(source.read(LOCAL_HEADER_STRUCT.size))
+            name = source.read(name_length)
+            extra = source.read(extra_length)
+            keys = ZipCryptoKeys(password)
+            # The last byte of the encryption header lets the readers check the password
+            encryption_header = random_bytes(ENCRYPTION_HEADER_SIZE - 1) + bytes([info.CRC >> 24])
+            info.header_offset = destination.tell()
+            info.flag_bits = (info.flag_bits | ENCRYPTED_FLAG) & ~DATA_DESCRIPTOR_FLAG
+            info.compress_size += ENCRYPTION_HEADER_SIZE
+            destination.write(LOCAL_HEADER_STRUCT.pack(signature, version, info.flag_bits, method, time, date,
+                                                       info.CRC, info.compress_size, info.file_size, name_length,
+                                                       extra_length))
+            destination.write(name + extra)
+            destination.write(keys.encrypt(encryption_header))
+            remaining = info.compress_size - ENCRYPTION_HEADER_SIZE
+            while remaining:
+                chunk = source.read(min(COPY_SIZE, remaining))
+                destination.write(keys.encrypt(chunk))
+                remaining -= len(chunk)
+
+        central_directory_start = destination.tell()
+        for info in infos:
+            name = info.filename.encode('utf-8' if info.flag_bits & 0x800 else 'cp437')
+            destination.write(CENTRAL_DIRECTORY_STRUCT.pack(
+                CENTRAL_DIRECTORY_SIGNATURE, (info.create_system << 8) | info.create_version, info.extract_version,
+                info.flag_bits, info.compress_type, *_dos_time(info.date_time), info.CRC, info.compress_size,
+                info.file_size, len(name), len(info.extra), len(info.comment), 0, info.internal_attr,
+                info.external_attr, info.header_offset))
+            destination.write(name + info.extra + info.comment)
+        central_directory_end = destination.tell()
+        destination.write(END_OF_CENTRAL_DIRECTORY_STRUCT.pack(
+            END_OF_CENTRAL_DIRECTORY_SIGNATURE, 0, 0, len(infos), len(infos),
+            central_directory_end - central_directory_start, central_directory_start, len(comment)))
+        destination.write(comment)
+
+
+def _dos_time(date_time):
+    """Returns the (time, date) MS-DOS representation of a ZipInfo date_time tuple"""
+    year, month, day, hour, minute, second = date_time
+    return (hour << 11) | (minute << 5) | (second // 2), ((year - 1980) << 9) | (month << 5) | day